@@ -0,0 +1,346 @@
+#
+# Benchmark of the processing pipelines on synthetic data, to track their
+# performance over time without needing the real (multi-GB) archives.
+#
+# It generates UNIVAF log files (provider_locations, external_ids and
+# availability_log) and VaccineSpotter history files for a range of dates,
+# at a configurable scale, and then runs each stage on them:
+#
+#   univaf         - `process_univaf.process_locations` and `do_date`
+#   vaccinespotter - `process_vaccinespotter.do_date`
+#   count_slots    - `count_slots.summarize_slots` on the availability logs
+#   aggregate      - `lib.aggregate_slots` on the output of `univaf`
+#
+# Every stage runs in a fresh process, so its peak memory use can be measured
+# on its own. The results are printed as JSON, and appended as a single line
+# to OUTPUT if given:
+#
+#   {"time": ..., "scale": {...}, "stages": {"univaf": {"rows": ...,
+#    "seconds": ..., "rows_per_second": ..., "peak_rss_mb": ...}, ...}}
+#
+# Usage:
+#
+#   python benchmark.py [-h] [-s START_DATE] [-e END_DATE] [-p PATH]
+#                       [-l LOCATIONS] [-u UPDATES_PER_HOUR]
+#                       [-n SLOTS_PER_UPDATE] [-t STAGE [STAGE ...]]
+#                       [-o OUTPUT]
+#
+
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import pytz
+# internal
+import lib
+
+STAGES = ['univaf', 'vaccinespotter', 'count_slots', 'aggregate']
+
+# (zip code, time zone, state) of the synthetic locations
+ZIPS = [('99501', 'America/Anchorage', 'AK'), ('10001', 'America/New_York', 'NY'),
+        ('80202', 'America/Denver', 'CO'), ('98101', 'America/Los_Angeles', 'WA'),
+        ('85001', 'America/Phoenix', 'AZ'), ('60601', 'America/Chicago', 'IL')]
+PROVIDERS = ['cvs', 'rite_aid', 'walgreens', 'kroger', 'safeway']
+
+
+def synthetic_locations(n, seed=0):
+    """
+    Generate `n` locations, as (uuid, zip, time zone, state) tuples.
+    """
+    rnd = random.Random(seed)
+    return [(str(uuid.UUID(int=rnd.getrandbits(128), version=4)),) + ZIPS[i % len(ZIPS)]
+            for i in range(n)]
+
+
+def synthetic_slots(rnd, check_time, timezone, n):
+    """
+    Generate up to `n` slot times in the next days after `check_time`, in the
+    location's time zone.
+    """
+    start = check_time.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+    timezone = pytz.timezone(timezone)
+    return [(start + datetime.timedelta(minutes=15 * i)).astimezone(timezone).isoformat()
+            for i in sorted(rnd.sample(range(4 * n), rnd.randint(0, n)))]
+
+
+def check_times(rnd, ds, updates_per_hour):
+    """
+    Generate the times at which a location is checked on a date, in UTC.
+    """
+    day = datetime.datetime.strptime(ds, '%Y-%m-%d').replace(tzinfo=pytz.utc)
+    step = 3600 // updates_per_hour
+    return [day + datetime.timedelta(seconds=i * step + rnd.randint(0, step - 1),
+                                     microseconds=rnd.randint(0, 999999))
+            for i in range(24 * updates_per_hour)]
+
+
+def write_json_lines(path, rows):
+    """
+    Write rows as a gzipped JSON lines file.
+    """
+    with gzip.open(path, 'wt') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+
+
+def generate_univaf(path, dates, n_locations, updates_per_hour, slots_per_update, seed=0):
+    """
+    Generate UNIVAF log files for the dates in `path`, and return the number
+    of availability log records.
+    """
+    rnd = random.Random(seed)
+    locations = synthetic_locations(n_locations, seed)
+    provider_locations = []
+    external_ids = []
+    for (i, (location_id, zip, timezone, state)) in enumerate(locations):
+        row = {'id': location_id, 'name': 'pharmacy %d' % i,
+               'provider': PROVIDERS[i % len(PROVIDERS)], 'location_type': 'PHARMACY',
+               'address_lines': ['%d main st' % i], 'city': 'city', 'county': None,
+               'state': state, 'postal_code': zip, 'time_zone': timezone}
+        # positions come both as a dictionary and as WKB hex
+        if i % 2:
+            row['position'] = {'latitude': 40.0 + i / 1e4, 'longitude': -100.0 - i / 1e4}
+        else:
+            row['position'] = (struct.pack('<bII', 1, 0x20000001, 4326) +
+                               struct.pack('<dd', -100.0 - i / 1e4, 40.0 + i / 1e4)).hex()
+        provider_locations.append(row)
+        external_ids.append({'provider_location_id': location_id,
+                             'system': 'univaf_v1', 'value': 'v1-%d' % i})
+        external_ids.append({'provider_location_id': location_id,
+                             'system': row['provider'], 'value': str(i)})
+
+    n_rows = 0
+    for ds in dates:
+        write_json_lines(path + 'provider_locations-%s.ndjson.gz' % ds, provider_locations)
+        write_json_lines(path + 'external_ids-%s.ndjson.gz' % ds, external_ids)
+        records = []
+        for (i, (location_id, zip, timezone, state)) in enumerate(locations):
+            # some records use an older id
+            for check_time in check_times(rnd, ds, updates_per_hour):
+                record = {'location_id': location_id if i % 4 else 'v1-%d' % i,
+                          'valid_at': check_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'}
+                # most records only confirm that nothing changed
+                if rnd.random() < 0.6:
+                    records.append((check_time, record))
+                    continue
+                slots = synthetic_slots(rnd, check_time, timezone, slots_per_update)
+                record['available'] = 'YES' if slots else 'NO'
+                if i % 3 == 0:
+                    record['capacity'] = [{'date': check_time.strftime('%Y-%m-%d'),
+                                           'available': record['available'],
+                                           'available_count': len(slots),
+                                           'unavailable_count': rnd.randint(0, 5)}]
+                else:
+                    record['slots'] = [{'start': slot_time, 'available': 'YES'}
+                                       for slot_time in slots]
+                records.append((check_time, record))
+        records.sort(key=lambda x: x[0])
+        write_json_lines(path + 'availability_log-%s.ndjson.gz' % ds,
+                         [record for (check_time, record) in records])
+        n_rows += len(records)
+    return n_rows
+
+
+def vaccinespotter_location(i, location_id, zip, timezone, state, check_time, slots):
+    """
+    Create a VaccineSpotter location row.
+    """
+    return {'id': location_id, 'name': 'Pharmacy %d' % i,
+            'brand': PROVIDERS[i % len(PROVIDERS)].upper(),
+            'address': '%d Main St' % i, 'city': 'city', 'state': state,
+            'postal_code': zip, 'time_zone': timezone,
+            'location': {'latitude': 40.0 + i / 1e4, 'longitude': -100.0 - i / 1e4},
+            'appointments_available': len(slots) > 0,
+            'appointments': [{'time': slot_time, 'type': 'Pfizer'} for slot_time in slots],
+            'appointments_last_fetched': check_time.isoformat(),
+            'updated_at': check_time.isoformat()}
+
+
+def generate_vaccinespotter(path, dates, n_locations, updates_per_hour, slots_per_update, seed=0):
+    """
+    Generate VaccineSpotter history files for the dates in `path`, and return
+    the number of records.
+    """
+    rnd = random.Random(seed)
+    locations = synthetic_locations(n_locations, seed)
+    previous = {}
+    audit_id = 0
+    n_rows = 0
+    for ds in dates:
+        records = []
+        # VaccineSpotter uses numeric location ids
+        for (i, (_, zip, timezone, state)) in enumerate(locations):
+            location_id = i + 1
+            for check_time in check_times(rnd, ds, updates_per_hour):
+                slots = synthetic_slots(rnd, check_time, timezone, slots_per_update)
+                data = vaccinespotter_location(i, location_id, zip, timezone, state,
+                                               check_time, slots)
+                audit_id += 1
+                if location_id not in previous:
+                    record = {'action': 'INSERT', 'changed_data': data}
+                else:
+                    record = {'action': 'UPDATE', 'data': data,
+                              'previous_data': previous[location_id],
+                              'changed_data': {'appointments': data['appointments'],
+                                               'appointments_available': data['appointments_available']}}
+                record['audit_id'] = audit_id
+                record['transaction_timestamp'] = check_time.isoformat()
+                records.append((check_time, record))
+                previous[location_id] = data
+        records.sort(key=lambda x: x[0])
+        write_json_lines(path + '%s.jsonl.gz' % ds, [record for (check_time, record) in records])
+        n_rows += len(records)
+    return n_rows
+
+
+def count_lines(pattern):
+    """
+    Count the lines in the files that match a glob pattern.
+    """
+    n = 0
+    for fn in glob.glob(pattern):
+        with open(fn, 'rb') as f:
+            n += sum(1 for line in f)
+    return n
+
+
+def run_stage(stage, path, dates, n_rows):
+    """
+    Run a single stage on the synthetic data in `path`, and return the number
+    of rows it processed. Runs in a separate process (see `measure_stage`).
+    """
+    if stage == 'univaf':
+        import process_univaf
+        process_univaf.path_raw = path + 'univaf_raw/'
+        process_univaf.path_out = path + 'univaf_clean/'
+        os.makedirs(process_univaf.path_out, exist_ok=True)
+        process_univaf.process_locations(process_univaf.path_out)
+        for ds in dates:
+            process_univaf.do_date(ds)
+        return n_rows['univaf']
+    elif stage == 'vaccinespotter':
+        import process_vaccinespotter
+        process_vaccinespotter.path_raw = path + 'vs_raw/'
+        process_vaccinespotter.path_out = path + 'vs_clean/'
+        process_vaccinespotter.locations_path = path + 'vs_clean/vs_locations.csv'
+        os.makedirs(process_vaccinespotter.path_out, exist_ok=True)
+        for ds in dates:
+            process_vaccinespotter.do_date(ds)
+        lib.write_locations(process_vaccinespotter.locations,
+                            process_vaccinespotter.locations_path)
+        return n_rows['vaccinespotter']
+    elif stage == 'count_slots':
+        import count_slots
+        import univaf_columnar
+        for ds in dates:
+            records = univaf_columnar.read_availability_log(
+                path + 'univaf_raw/availability_log-%s.ndjson.gz' % ds)
+            count_slots.summarize_slots(records, ds)
+        return n_rows['univaf']
+    elif stage == 'aggregate':
+        path_out = path + 'univaf_clean/'
+        n = count_lines(path_out + 'slots_*.csv')
+        lib.aggregate_slots(path_out, path + 'univaf_slots.csv')
+        return n
+    raise ValueError('unknown stage %s' % stage)
+
+
+def measure_stage(stage, path, dates, n_rows):
+    """
+    Run a stage, and measure its wall time and peak memory use.
+    """
+    t = time.perf_counter()
+    rows = run_stage(stage, path, dates, n_rows)
+    seconds = time.perf_counter() - t
+    # maxrss is in kilobytes on Linux, but in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss *= 1 if sys.platform == 'darwin' else 1024
+    return {'rows': rows, 'seconds': round(seconds, 3),
+            'rows_per_second': round(rows / seconds, 1),
+            'peak_rss_mb': round(peak_rss / 1024 / 1024, 1)}
+
+
+def git_commit():
+    """
+    Get the current git commit, if any.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    import lib_cli
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--start_date', type=lib_cli.cli_date, metavar='DATE',
+                        default=lib_cli.cli_date('2021-06-01'),
+                        help="first date to generate data for (format: YYYY-MM-DD)")
+    parser.add_argument('-e', '--end_date', type=lib_cli.cli_date, metavar='DATE',
+                        default=lib_cli.cli_date('2021-06-02'),
+                        help="last date to generate data for (format: YYYY-MM-DD)")
+    parser.add_argument('-p', '--path',
+                        help="directory for the synthetic data (default: a temporary one)")
+    parser.add_argument('-l', '--locations', type=int, default=1000,
+                        help="number of locations")
+    parser.add_argument('-u', '--updates_per_hour', type=int, default=6,
+                        help="number of times each location is checked per hour")
+    parser.add_argument('-n', '--slots_per_update', type=int, default=20,
+                        help="maximum number of slots in an update")
+    parser.add_argument('-t', '--stages', nargs='+', choices=STAGES, default=STAGES,
+                        help="stages to run")
+    parser.add_argument('-o', '--output',
+                        help="file to append the results to, as a JSON line")
+    args = parser.parse_args()
+    dates = lib_cli.get_dates_in_range(args.start_date, args.end_date)
+    if 'aggregate' in args.stages and 'univaf' not in args.stages:
+        parser.error("the aggregate stage needs the output of the univaf stage")
+
+    path = args.path or tempfile.mkdtemp(prefix='benchmark_')
+    path = os.path.join(path, '')
+    for subpath in ['univaf_raw/', 'vs_raw/']:
+        os.makedirs(path + subpath, exist_ok=True)
+    scale = {'dates': len(dates), 'locations': args.locations,
+             'updates_per_hour': args.updates_per_hour,
+             'slots_per_update': args.slots_per_update}
+    print("[INFO] generating synthetic data in %s" % path)
+    n_rows = {}
+    if 'univaf' in args.stages or 'count_slots' in args.stages:
+        n_rows['univaf'] = generate_univaf(path + 'univaf_raw/', dates, args.locations,
+                                           args.updates_per_hour, args.slots_per_update)
+    if 'vaccinespotter' in args.stages:
+        n_rows['vaccinespotter'] = generate_vaccinespotter(
+            path + 'vs_raw/', dates, args.locations, args.updates_per_hour,
+            args.slots_per_update)
+
+    # run every stage in a new process, so peak memory use is its own
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for stage in [stage for stage in STAGES if stage in args.stages]:
+        print("[INFO] running %s" % stage)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[stage] = executor.submit(measure_stage, stage, path, dates, n_rows).result()
+        print("[INFO]   %(rows)d rows in %(seconds).2fs (%(rows_per_second).0f rows/s, "
+              "peak RSS %(peak_rss_mb).0f MB)" % results[stage])
+
+    report = {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+              'commit': git_commit(), 'python': platform.python_version(),
+              'scale': scale, 'stages': results}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(report) + '\n')
@@ -0,0 +1,70 @@
+#
+# Benchmark of `lib.read_timestamp` against the string-splitting version it
+# replaced, on synthetic slot time stamps.
+#
+# Usage:
+#
+#   python benchmark_timestamps.py [-h] [-n ROWS]
+#
+
+import argparse
+import numpy as np
+import pandas as pd
+import time
+# internal
+import lib
+
+
+def read_timestamp_strings(string, offset=None):
+    """
+    The previous version of `lib.read_timestamp`, which splits strings.
+    """
+    DF = pd.DataFrame(data={'string': string})
+    DF[['ds', 'ts']] = DF.string.str[:16].str.split(' ', expand=True)
+    DF[['h', 'm']] = DF.ts.str.split(':', expand=True)
+    # dictionary lookup trick for efficient date parsing
+    dates = {date: pd.to_datetime(date, format='%Y-%m-%d') for date in DF.ds.unique()}
+    DF['out'] = (DF.ds.map(dates) +
+                 pd.to_timedelta(DF.h.astype(int), unit='h') +
+                 pd.to_timedelta(DF.m.astype(int), unit='m'))
+    if offset is not None:
+        DF['out'] += pd.to_timedelta(offset, unit='h')
+    return DF.out
+
+
+def synthetic_timestamps(n, seed=0):
+    """
+    Generate `n` time stamps like the ones in slot files, with offsets.
+    """
+    rng = np.random.default_rng(seed)
+    start = np.datetime64('2021-03-01T00:00', 'm')
+    minutes = start + rng.integers(0, 365 * 24 * 60, n)
+    seconds = rng.integers(0, 60, n)
+    string = pd.Series(np.datetime_as_string(minutes)).str.replace('T', ' ')
+    string = string + pd.Series(seconds).map(':{:02d}'.format)
+    offset = pd.Series(rng.choice([-10, -9, -8, -7, -6, -5, -4], n))
+    return (string, offset)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--rows', type=int, default=10_000_000,
+                        help="number of time stamps to parse")
+    parser.add_argument('-c', '--chunk_size', type=int, default=1_000_000,
+                        help="number of time stamps to parse at once (the "
+                             "string version needs ~600MB per million)")
+    args = parser.parse_args()
+
+    print("[INFO] parsing %d time stamps" % args.rows)
+    timings = {'strings': 0.0, 'bytes': 0.0}
+    for (i, start) in enumerate(range(0, args.rows, args.chunk_size)):
+        (string, offset) = synthetic_timestamps(min(args.chunk_size, args.rows - start), seed=i)
+        results = {}
+        for (name, function) in [('strings', read_timestamp_strings),
+                                 ('bytes', lib.read_timestamp)]:
+            t = time.perf_counter()
+            results[name] = function(string, offset=offset)
+            timings[name] += time.perf_counter() - t
+        assert (results['strings'].values == results['bytes'].values).all()
+    for (name, seconds) in timings.items():
+        print("[INFO]   %-8s %6.2fs (%.1fM rows/s)" % (name, seconds, args.rows / seconds / 1e6))
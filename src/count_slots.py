@@ -1,17 +1,110 @@
 from collections import defaultdict, Counter
 import concurrent.futures
 from datetime import date
-import functools
 import json
 import logging
+import numpy as np
+import os
+from pathlib import Path
 import re
+import tempfile
 from tqdm import tqdm
+import univaf_columnar
 import univaf_data
 
 logger = logging.getLogger(__name__)
 
 FILE_DATE_PATTERN = re.compile(r'-(\d\d\d\d-\d\d-\d\d)\.')
 
+# Slot counts are keyed by `location_index << DAY_BITS | day_index`.
+DAY_BITS = 24
+# Minimum number of added counts to combine at once.
+REDUCE_SIZE = 1_000_000
+
+# Version of the summaries of files, to be bumped when ``summarize_slots``
+# changes, so cached summaries are not used anymore.
+SUMMARY_VERSION = 1
+CACHE_INDEX = 'index.json'
+
+
+class SlotCounts:
+    """
+    The maximum number of slots per location and day, as compact arrays of
+    keys (see ``DAY_BITS``) and counts, with tables of the location IDs and
+    days that the keys refer to. Counts from more files can be added with
+    ``add``, and are combined with the ones that are already there (taking
+    the maximum per key) in batches, when calling ``reduce``.
+    """
+
+    def __init__(self):
+        self.location_ids = []
+        self.location_index = {}
+        self.days = []
+        self.day_index = {}
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.n_pending = 0
+
+    @staticmethod
+    def lookup(values, table, index):
+        """Get the indexes of values in a table, adding new values to it."""
+        result = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values):
+            result[i] = index.get(value, -1)
+            if result[i] < 0:
+                result[i] = index[value] = len(table)
+                table.append(value)
+        return result
+
+    def add(self, location_ids, days, locations, day_indexes, counts):
+        """
+        Add counts for ``(locations[i], day_indexes[i])``, which are indexes
+        into the arrays ``location_ids`` and ``days`` (e.g. of a single file).
+        """
+        locations = self.lookup(location_ids.tolist(), self.location_ids,
+                                self.location_index)[locations]
+        day_indexes = self.lookup(days.tolist(), self.days, self.day_index)[day_indexes]
+        self.pending.append(((locations << DAY_BITS) | day_indexes, counts.astype(np.int64)))
+        self.n_pending += len(counts)
+        # Combining is proportional to the number of keys, so wait until
+        # there are about as many new ones.
+        if self.n_pending >= max(len(self.keys), REDUCE_SIZE):
+            self.reduce()
+
+    def reduce(self):
+        """Combine added counts with the same key, keeping the maximum."""
+        if not self.pending:
+            return
+        keys = np.concatenate([self.keys] + [keys for keys, _ in self.pending])
+        counts = np.concatenate([self.counts] + [counts for _, counts in self.pending])
+        self.pending = []
+        self.n_pending = 0
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        self.keys = keys[starts]
+        self.counts = np.maximum.reduceat(counts[order], starts) if len(starts) else counts
+
+    def location_indexes(self):
+        self.reduce()
+        return self.keys >> DAY_BITS
+
+    def day_indexes(self):
+        self.reduce()
+        return self.keys & ((1 << DAY_BITS) - 1)
+
+    def to_dict(self):
+        """
+        Get the counts as a dict of dicts of counts per day, per location ID.
+        """
+        result = defaultdict(Counter)
+        for location, day, count in zip(self.location_indexes().tolist(),
+                                        self.day_indexes().tolist(),
+                                        self.counts.tolist()):
+            result[self.location_ids[location]][self.days[day]] = count
+        return result
+
 
 def deduplicate_locations(data, id_file):
     """
@@ -19,28 +112,30 @@ def deduplicate_locations(data, id_file):
     table and combine slot counts from locations that are duplicates. (This is
     important because historical logs will contain reports for different
     location IDs that we later learned were duplicates.)
+
+    ``data`` is a ``SlotCounts``, and so is the result.
     """
-    clean = {}
     lookup = {}
     for row in univaf_data.read_json_lines(id_file):
         location_id = row['provider_location_id']
         if not (location_id in lookup):
-            clean[location_id] = Counter()
-            lookup[location_id] = clean[location_id]
+            lookup[location_id] = location_id
         if row['system'].startswith('univaf_'):
-            lookup[row['value']] = clean[location_id]
+            lookup[row['value']] = location_id
 
-    for location_id, dates in data.items():
-        clean_entry = lookup.get(location_id)
-        if clean_entry is None:
+    canonical_ids = []
+    for location_id in data.location_ids:
+        if location_id not in lookup:
             print(f"WARN: no matching row for: {location_id}")
-            clean_entry = Counter()
-            lookup[location_id] = clean_entry
-            clean[location_id] = clean_entry
-
-        for day, count in dates.items():
-            clean_entry[day] = max(clean_entry[day], count)
+            lookup[location_id] = location_id
+        canonical_ids.append(lookup[location_id])
 
+    unique_ids, canonical = np.unique(np.array(canonical_ids, dtype=object).astype(str),
+                                      return_inverse=True)
+    clean = SlotCounts()
+    clean.add(unique_ids, np.array(data.days, dtype=str),
+              canonical[data.location_indexes()], data.day_indexes(), data.counts)
+    clean.reduce()
     return clean
 
 
@@ -103,29 +198,199 @@ def summarize_slots(records, default_date=None):
     return locations
 
 
-def summarize_slots_in_file(file_path, cache_directory):
-    cache_path = cache_directory / f'{file_path.name}.json'
-    if cache_path.exists():
-        logger.debug(f'Reading cache: {cache_path}...')
-        with cache_path.open(encoding='utf-8') as f:
-            return json.load(f)
-    else:
-        logger.debug(f'Reading {file_path}...')
-        file_date = FILE_DATE_PATTERN.search(file_path.name).group(1)
-        result = summarize_slots(univaf_data.read_json_lines(file_path), file_date)
+def summarize_slots_in_file(file_path, part=None, digest=None):
+    logger.debug(f'Reading {file_path}...')
+    file_date = FILE_DATE_PATTERN.search(file_path.name).group(1)
+    records = univaf_columnar.read_availability_log(file_path, part, digest)
+    result = summarize_slots(records, file_date)
+
+    # Return a plain old dict of dicts so it's pickle-able.
+    return {location_id: dict(dates)
+            for location_id, dates in result.items()}
+
+
+def summary_arrays(summary):
+    """
+    Convert a summary from ``summarize_slots`` to compact arrays:
+
+        (location_ids, days, locations, day_indexes, counts)
+
+    where ``locations`` and ``day_indexes`` index into ``location_ids`` and
+    ``days``.
+    """
+    location_ids = list(summary.keys())
+    day_index = {}
+    locations = []
+    day_indexes = []
+    counts = []
+    for i, dates in enumerate(summary.values()):
+        for day, count in dates.items():
+            locations.append(i)
+            day_indexes.append(day_index.setdefault(day, len(day_index)))
+            counts.append(count)
+    return (np.array(location_ids, dtype=str), np.array(list(day_index), dtype=str),
+            np.array(locations, dtype=np.int32), np.array(day_indexes, dtype=np.int32),
+            np.array(counts, dtype=np.int64))
+
+
+def summarize_part(file_path, part):
+    """
+    Summarize a part of a file (see ``univaf_data.split_log_file``) as compact
+    arrays, to be combined with ``combine_summaries``.
+    """
+    return summary_arrays(summarize_slots_in_file(file_path, part))
+
+
+def combine_summaries(summaries):
+    """
+    Combine the compact arrays of summaries of parts of a file, taking the
+    maximum count of each location and day.
+    """
+    counts = SlotCounts()
+    for summary in summaries:
+        counts.add(*summary)
+    counts.reduce()
+    return (np.array(counts.location_ids, dtype=str), np.array(counts.days, dtype=str),
+            counts.location_indexes().astype(np.int32), counts.day_indexes().astype(np.int32),
+            counts.counts)
+
+
+def summary_cache_name(file_path, digest):
+    return f'{file_path.name}-v{SUMMARY_VERSION}-{digest[:16]}.npz'
+
+
+def write_summary(cache_path, summary):
+    """
+    Write the compact arrays of a summary to an ``.npz`` file in the cache.
+    """
+    names = ['location_ids', 'days', 'locations', 'day_indexes', 'counts']
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first, so cached files are complete.
+    with tempfile.NamedTemporaryFile(dir=cache_path.parent, suffix='.npz',
+                                     delete=False) as f:
+        np.savez(f, **dict(zip(names, summary)))
+    os.replace(f.name, cache_path)
+
 
-        # Cache it for later use.
-        cache_path.parent.mkdir(parents=True, exist_ok=True)
-        with cache_path.open('w', encoding='utf-8') as f:
-            json.dump(result, f, separators=(',', ':'), ensure_ascii=False)
+def count_slots_in_file(file_path, cache_directory, known_digest=None):
+    """
+    Summarize a file (see ``summarize_slots_in_file``) and write the summary
+    as compact arrays (see ``summary_arrays``) to an ``.npz`` file in the
+    cache, named after the hash of the file and ``SUMMARY_VERSION``. If the
+    file's hash is ``known_digest`` and that file exists, the file is not
+    summarized again.
+
+    Returns ``(cache_name, digest)``, so only that has to be sent back from a
+    worker process.
+    """
+    digest = univaf_columnar.source_hash(file_path)
+    cache_name = summary_cache_name(file_path, digest)
+    cache_path = Path(cache_directory) / cache_name
+    if digest == known_digest and cache_path.exists():
+        return (cache_name, digest)
+
+    write_summary(cache_path, summary_arrays(summarize_slots_in_file(file_path, digest=digest)))
+    return (cache_name, digest)
 
-        # Return a plain old dict of dicts so it's pickle-able.
-        return {location_id: dict(dates)
-                for location_id, dates in result.items()}
+
+def read_summary(cache_path):
+    """
+    Read the compact arrays of a summary written by ``count_slots_in_file``.
+    """
+    with np.load(cache_path) as summary:
+        return (summary['location_ids'], summary['days'], summary['locations'],
+                summary['day_indexes'], summary['counts'])
+
+
+class SummaryCache:
+    """
+    Cache of the summaries of availability log files, in a directory of
+    ``.npz`` files (see ``count_slots_in_file``), with an index file that lists
+    them by source file:
+
+        {"version": 1, "files": {"availability_log-2021-11-01.ndjson.gz":
+            {"size": ..., "mtime_ns": ..., "sha1": ..., "cache": "...npz"}}}
+
+    A summary is used when its source file has the same size and modification
+    time, so that lookups only need the index, or else the same hash (which is
+    then checked in a worker). Summaries of other versions of
+    ``summarize_slots`` are never used, see ``SUMMARY_VERSION``.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.index_path = self.directory / CACHE_INDEX
+        self.files = {}
+        if self.index_path.exists():
+            with self.index_path.open(encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('version') == SUMMARY_VERSION:
+                self.files = index['files']
+
+    def lookup(self, file_path):
+        """
+        Get the path of the cached summary of a file, or None if it's not (or
+        not known to be) up to date.
+        """
+        entry = self.files.get(file_path.name)
+        if entry is None:
+            return None
+        stat = file_path.stat()
+        if entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            return None
+        return self.directory / entry['cache']
+
+    def known_digest(self, file_path):
+        entry = self.files.get(file_path.name)
+        return entry and entry['sha1']
+
+    def add(self, file_path, cache_name, digest):
+        stat = file_path.stat()
+        self.files[file_path.name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                      'sha1': digest, 'cache': cache_name}
+        self.save()
+
+    def remove(self, file_path):
+        self.files.pop(file_path.name, None)
+        self.save()
+
+    def save(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix('.tmp')
+        with tmp_path.open('w', encoding='utf-8') as f:
+            json.dump({'version': SUMMARY_VERSION, 'files': self.files}, f,
+                      indent=1, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def clean(self, data_path):
+        """
+        Remove the summaries of files that are no longer in ``data_path`` or
+        changed, and any other files in the cache directory (e.g. of other
+        versions, or the JSON files of older versions of this script).
+        """
+        for name in list(self.files):
+            file_path = Path(data_path) / name
+            if not file_path.exists() or self.lookup(file_path) is None:
+                del self.files[name]
+        self.save()
+        keep = {entry['cache'] for entry in self.files.values()} | {CACHE_INDEX}
+        removed = 0
+        for path in self.directory.iterdir():
+            if path.name not in keep and path.is_file():
+                path.unlink()
+                removed += 1
+        print(f'Removed {removed} files from the cache, kept {len(self.files)} summaries')
 
 
 def sum_slots_by_day(locations):
     days = Counter()
+    if isinstance(locations, SlotCounts):
+        locations.reduce()
+        totals = np.bincount(locations.day_indexes(), weights=locations.counts,
+                             minlength=len(locations.days))
+        for day, count in zip(locations.days, totals.tolist()):
+            days[day] += int(count)
+        locations = {}
     for counts in locations.values():
         for day, count in counts.items():
             days[day] += count
@@ -145,6 +410,13 @@ if __name__ == '__main__':
     parser.add_argument('--reference_date',
                         help="Date of datafiles to use for deduplication, location attributes, etc.",
                         type=lib_cli.cli_date, metavar='DATE')
+    parser.add_argument('--clean_cache', action='store_true',
+                        help="remove cached summaries of files that changed or aren't there anymore, "
+                             "and of older versions of this script")
+    parser.add_argument('--day_parts', type=int, default=1, metavar='N',
+                        help="split each day's file into N parts that are summarized in parallel "
+                             "(writes a copy of the cached files in blocks the first time, "
+                             "see `univaf_data.blockify_log_file`)")
     args = parser.parse_args()
     dates = lib_cli.get_dates_in_range(args.start_date, args.end_date)
 
@@ -157,7 +429,10 @@ if __name__ == '__main__':
     # Download raw data files if we don't already have them locally
     id_file = univaf_data.download_log_file('external_ids', reference_date)
     location_file = univaf_data.download_log_file('provider_locations', reference_date)
-    log_files = [univaf_data.download_log_file('availability_log', dt) for dt in dates]
+    log_files = univaf_data.download_log_files('availability_log', dates)
+    if args.day_parts > 1:
+        for file_path in log_files:
+            univaf_data.blockify_log_file(file_path)
 
     # Rite Aid's API sent incorrect (and very large) numbers of slots for some
     # locations from 2021-09-09 through 2021-11-17 (when it broke). We want to
@@ -167,35 +442,66 @@ if __name__ == '__main__':
     rite_aid_ids = frozenset((location['id']
                               for location in univaf_data.read_json_lines(location_file)
                               if location['provider'] == 'rite_aid'))
-    def clean_count(checked_date, location_id, count):
+    rite_aid_list = np.array(sorted(rite_aid_ids), dtype=str)
+    def clean_counts(checked_date, location_ids, locations, counts):
         # Substitute the median number of slots for locations with anomalously
         # high slot counts. (Calculated from the month after fixing issues.)
-        if (
-            checked_date in rite_aid_bad_days and
-            location_id in rite_aid_ids and
-            count > 500
-        ):
-            return 13
-        return count
-    
-    # Process each file, then combine the results into a dict of slot counts by
-    # day by location ID:
-    #   {
-    #     'location_id': {'2021-11-01': 15, '2021-11-02': 13, ...},
-    #     'location_id': {'2021-11-01': 28, '2021-11-02': 10, ...},
-    #     ...
-    #   }
-    locations = defaultdict(Counter)
+        if checked_date not in rite_aid_bad_days:
+            return counts
+        is_rite_aid = np.isin(location_ids, rite_aid_list)
+        return np.where(is_rite_aid[locations] & (counts > 500), 13, counts)
+
+    # Summarize each file that isn't in the cache yet in a worker, which
+    # writes its slot counts by day by location ID as compact arrays to the
+    # cache, then combine them by taking the maximum count of each location
+    # and day (see `SlotCounts`). Files that are split into parts are
+    # summarized by a worker per part, and combined here before they're
+    # written to the cache.
+    cache = SummaryCache(cache_path)
+    if args.clean_cache:
+        cache.clean(data_path)
+    cached = {file_path: cache.lookup(file_path) for file_path in log_files}
+    locations = SlotCounts()
     with concurrent.futures.ProcessPoolExecutor() as executor:
-        summarizer = functools.partial(summarize_slots_in_file, cache_directory=cache_path)
-        summaries = zip(log_files, executor.map(summarizer, log_files))
-        for file_path, summary in tqdm(summaries, total=len(log_files), unit='days'):
+        futures = {}
+        for file_path in log_files:
+            if cached[file_path] is not None:
+                continue
+            parts = univaf_data.split_log_file(file_path, args.day_parts)
+            if len(parts) == 1:
+                futures[file_path] = executor.submit(count_slots_in_file, file_path, cache_path,
+                                                     cache.known_digest(file_path))
+            else:
+                futures[file_path] = (executor.submit(univaf_columnar.source_hash, file_path),
+                                      [executor.submit(summarize_part, file_path, part)
+                                       for part in parts])
+        for file_path in tqdm(log_files, unit='days'):
             file_date = FILE_DATE_PATTERN.search(file_path.name).group(1)
-            for location_id, dates in summary.items():
-                for day, count in dates.items():
-                    # Modify counts that are known to be bad data.
-                    count = clean_count(file_date, location_id, count)
-                    locations[location_id][day] = max(locations[location_id][day], count)
+            summary_path = cached[file_path]
+            if summary_path is None and isinstance(futures[file_path], tuple):
+                (digest_future, part_futures) = futures[file_path]
+                digest = digest_future.result()
+                cache_name = summary_cache_name(file_path, digest)
+                write_summary(cache_path / cache_name,
+                              combine_summaries(future.result() for future in part_futures))
+                cache.add(file_path, cache_name, digest)
+                summary_path = cache_path / cache_name
+            elif summary_path is None:
+                cache_name, digest = futures[file_path].result()
+                cache.add(file_path, cache_name, digest)
+                summary_path = cache_path / cache_name
+            try:
+                summary = read_summary(summary_path)
+            except FileNotFoundError:
+                # The summary was removed from the cache, so make it again.
+                logger.warning(f'Cached summary {summary_path} is missing')
+                cache_name, digest = count_slots_in_file(file_path, cache_path)
+                cache.add(file_path, cache_name, digest)
+                summary = read_summary(cache_path / cache_name)
+            (location_ids, days, file_locations, day_indexes, counts) = summary
+            # Modify counts that are known to be bad data.
+            counts = clean_counts(file_date, location_ids, file_locations, counts)
+            locations.add(location_ids, days, file_locations, day_indexes, counts)
 
     locations = deduplicate_locations(locations, id_file)
 
@@ -7,21 +7,37 @@
 #   Jan Overgoor - jsovergoor@usdigitalresponse.org
 #
 
+import concurrent.futures
 import csv
 import datetime
 import dateutil
+import functools
 import hashlib
 import json
+import numpy as np
 import os
 import pandas as pd
+import re
+import shutil
 import urllib.request
 from glob import glob
 from urllib.parse import urljoin
 from uuid import UUID
+# pyarrow is only needed to read columnar output files
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as pds
+except ImportError:
+    pa = None
+# internal
+import lib_metrics
 
 # root path of where the data lives
 path_root = '../data'
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
 
 def read_external_ids(path):
     """
@@ -92,6 +108,60 @@ def write_external_ids(eid_to_id, path):
             sink = writer.writerow(x)
 
 
+def write_id_index(eid_to_id, locations, path, systems=('uuid', 'univaf_v1', 'univaf_v0')):
+    """
+    Write an index that resolves the raw location ids of availability logs to
+    internal ids and time zones. A raw id can be an external id of any of the
+    given systems; earlier systems take precedence. The index is stored as
+    NumPy arrays (sorted by raw id), so it can be memory-mapped.
+    """
+    resolve = {}
+    for system in reversed(systems):
+        prefix = system + ':'
+        for (eid, iid) in eid_to_id.items():
+            if eid.startswith(prefix) and iid in locations:
+                resolve[eid[len(prefix):]] = iid
+    keys = sorted(resolve.keys())
+    timezones = sorted({str(locations[iid]['timezone']) for iid in resolve.values()})
+    tz_codes = {tz: i for (i, tz) in enumerate(timezones)}
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'keys.npy'), np.array(keys, dtype=str))
+    np.save(os.path.join(path, 'ids.npy'), np.array([resolve[k] for k in keys], dtype=np.int64))
+    np.save(os.path.join(path, 'timezones.npy'),
+            np.array([tz_codes[str(locations[resolve[k]]['timezone'])] for k in keys], dtype=np.int16))
+    with open(os.path.join(path, 'timezones.json'), 'w') as f:
+        json.dump(timezones, f)
+    print("[INFO] wrote %d location ids to %s" % (len(keys), path))
+
+
+def read_id_index(path):
+    """
+    Memory-map an index written by `write_id_index`. Returns the arrays of raw
+    ids, internal ids and time zone codes, and the list of time zone names.
+    """
+    arrays = [np.load(os.path.join(path, fn), mmap_mode='r')
+              for fn in ['keys.npy', 'ids.npy', 'timezones.npy']]
+    with open(os.path.join(path, 'timezones.json'), 'r') as f:
+        timezones = json.load(f)
+    return tuple(arrays) + (timezones,)
+
+
+def resolve_ids(index, raw_ids):
+    """
+    Look up an array of raw location ids in an index from `read_id_index`.
+    Returns arrays of internal ids and time zone codes, and a mask of which
+    raw ids were found.
+    """
+    (keys, iids, tz_codes, timezones) = index
+    raw_ids = np.asarray(raw_ids, dtype=str)
+    if len(keys) == 0:
+        found = np.zeros(len(raw_ids), dtype=bool)
+        return (np.zeros(len(raw_ids), dtype=np.int64), np.zeros(len(raw_ids), dtype=np.int16), found)
+    i = np.minimum(np.searchsorted(keys, raw_ids), len(keys) - 1)
+    found = keys[i] == raw_ids
+    return (iids[i], tz_codes[i], found)
+
+
 def read_previous_state(path_raw, ds, source):
     """
     Read a previous state, if it exists
@@ -120,66 +190,411 @@ def read_previous_state(path_raw, ds, source):
         return {}
 
 
+def days_from_civil(year, month, day):
+    """
+    Compute days since epoch for arrays of dates in the proleptic Gregorian
+    calendar. http://howardhinnant.github.io/date_algorithms.html#days_from_civil
+    """
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
 def read_timestamp(string, offset=None):
     """
     Efficiently read a large column of time stamps and incorporate offset.
+
+    Time stamps are read directly from the bytes of their fixed
+    "YYYY-MM-DD HH:MM" layout (anything after that is ignored), and the offset
+    (in hours) is added as an integer number of nanoseconds.
     """
-    DF = pd.DataFrame(data={'string': string})
-    DF[['ds', 'ts']] = DF.string.str[:16].str.split(' ', expand=True)
-    DF[['h', 'm']] = DF.ts.str.split(':', expand=True)
-    # dictionary lookup trick for efficient date parsing
-    dates = {date: pd.to_datetime(date, format='%Y-%m-%d') for date in DF.ds.unique()}
-    DF['out'] = (DF.ds.map(dates) +
-                 pd.to_timedelta(DF.h.astype(int), unit='h') +
-                 pd.to_timedelta(DF.m.astype(int), unit='m'))
+    index = string.index if isinstance(string, pd.Series) else None
+    chars = np.asarray(string, dtype='S16').view(np.uint8).reshape(-1, 16)
+    digits = chars[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15]].astype(np.int64) - ord('0')
+    if ((digits < 0) | (digits > 9)).any():
+        raise ValueError('time stamps should look like "YYYY-MM-DD HH:MM"')
+    (year, month, day, hour, minute) = [
+        digits[:, i] * 10 + digits[:, i + 1] for i in range(2, 12, 2)]
+    year += (digits[:, 0] * 10 + digits[:, 1]) * 100
+    days = days_from_civil(year, month, day)
+    out = ((days * 24 + hour) * 60 + minute) * (60 * 10 ** 9)
     if offset is not None:
-        DF['out'] += pd.to_timedelta(offset, unit='h')
-    return DF.out
+        offset = np.asarray(offset, dtype=np.float64)
+        out += np.where(np.isnan(offset), 0, offset * (60 * 60 * 10 ** 9)).astype(np.int64)
+        out[np.isnan(offset)] = np.iinfo(np.int64).min  # NaT
+    return pd.Series(out.view('datetime64[ns]'), index=index)
 
 
-def aggregate_slots(path_in, fn_out):
+def read_output(path, start_date=None, end_date=None, columns=None):
     """
-    Aggregate slot records over multiple days.
+    Read a directory of columnar output files (see `lib_output`), e.g. the
+    `avs/` or `slots/` of a processing script or aggregated slots, as a
+    DataFrame. Only the dates (partitions) from `start_date` to `end_date`
+    are read, if given; the date is in column `ds`.
+    """
+    if pa is None:
+        raise RuntimeError('pyarrow is needed to read columnar output')
+    fmt = 'feather' if glob(path + 'ds=*/*.feather') else 'parquet'
+    fns = [fn for fn in sorted(glob(path + 'ds=*/*.' + fmt))
+           if (start_date is None or output_file_date(fn) >= start_date) and
+              (end_date is None or output_file_date(fn) <= end_date)]
+    dataset = pds.dataset(fns, format='ipc' if fmt == 'feather' else 'parquet',
+                          partition_base_dir=path,
+                          partitioning=pds.partitioning(pa.schema([('ds', pa.string())]),
+                                                        flavor='hive'))
+    with lib_metrics.timer('read_output'):
+        return dataset.to_table(columns=columns).to_pandas()
+
+
+def output_file_date(fn):
+    """
+    Get the date of a per-day output file, from its name.
+    """
+    return re.findall(r'\d{4}-\d{2}-\d{2}', fn)[-1]
+
+
+def slot_files(path_in):
+    """
+    Get the per-day slot files of a processing script: the CSV files, and the
+    columnar files of dates without a CSV file.
     """
-    print("[INFO] aggregating slots")
-    # read individual files
     fns = glob(path_in + "slots*.csv")
-    li = [pd.read_csv(x, dtype={'checked_time': str, 'slot_time': str},
-                         names=['id', 'slot_time', 'first_check', 'last_check',
-                                'offset', 'available']) for x in fns]
-    DF = pd.concat(li, axis=0, ignore_index=True)
-    print("[INFO]   read %d records from %s" % (DF.shape[0], path_in))
+    dates = set(output_file_date(fn) for fn in fns)
+    for fn in sorted(glob(path_in + "slots/ds=*/part-0.*")):
+        ds = output_file_date(fn)
+        if ds not in dates and not fn.endswith('.tmp'):
+            fns.append(fn)
+            dates.add(ds)
+    return fns
+
+
+def read_slots(fn):
+    """
+    Read a file of slot records, as written by the processing scripts.
+    """
+    if not fn.endswith('.csv'):
+        return read_columnar_slots(fn)
+    return pd.read_csv(fn, dtype={'checked_time': str, 'slot_time': str},
+                       names=['id', 'slot_time', 'first_check', 'last_check',
+                              'offset', 'available'])
+
+
+def read_columnar_slots(fn):
+    """
+    Read a columnar file of slot records, with the same columns and values as
+    `read_slots` gets from a CSV file.
+    """
+    fmt = 'ipc' if fn.endswith('.feather') else 'parquet'
+    table = pds.dataset(fn, format=fmt).to_table()
+    columns = {'id': table.column('id').to_numpy()}
+    for (column, name, time_format) in [('slot_time', 'slot_time', '%Y-%m-%d %H:%M'),
+                                        ('first_checked_time', 'first_check', '%Y-%m-%d %H:%M:%S'),
+                                        ('last_checked_time', 'last_check', '%Y-%m-%d %H:%M:%S')]:
+        columns[name] = pc.strftime(table.column(column), format=time_format).to_pandas()
+    columns['offset'] = table.column('offset').to_pandas().astype(float)
+    DF = pd.DataFrame(columns)
+    DF['available'] = np.nan
+    return DF
+
+
+def aggregate_slot_records(DF):
+    """
+    Combine slot records of the same slot, and convert them to local time.
+    """
+    return localize_slot_records(combine_slot_records(DF))
+
+
+def combine_slot_records(DF):
+    """
+    Combine slot records of the same slot (in UTC).
+    """
     # group by slot_time
-    DF = (DF.groupby(['id', 'slot_time', 'offset'])
-            .agg(first_check=('first_check', min),
-                 last_check=('last_check', max),
-                 available=('available', max))
-            .reset_index())
+    return (DF.groupby(['id', 'slot_time', 'offset'])
+              .agg(first_check=('first_check', min),
+                   last_check=('last_check', max),
+                   available=('available', max))
+              .reset_index())
+
+
+def localize_slot_records(DF):
+    """
+    Convert combined slot records to local time, in the aggregated format.
+    """
     # parse time stamps and integrate offset
-    DF['slot_time'] = read_timestamp(DF.slot_time, offset=DF.offset)
-    DF['first_check'] = read_timestamp(DF.first_check, offset=DF.offset)
-    DF['last_check'] = read_timestamp(DF.last_check, offset=DF.offset)
+    DF = DF.assign(slot_time=read_timestamp(DF.slot_time, offset=DF.offset),
+                   first_check=read_timestamp(DF.first_check, offset=DF.offset),
+                   last_check=read_timestamp(DF.last_check, offset=DF.offset))
     # compute hod and dow
-    DF = (DF.assign(hod=DF.slot_time.dt.hour,
-                    dow=DF.slot_time.dt.dayofweek)
-            [['id', 'slot_time', 'hod', 'dow', 'first_check', 'last_check']])
+    return (DF.assign(hod=DF.slot_time.dt.hour,
+                      dow=DF.slot_time.dt.dayofweek)
+              [['id', 'slot_time', 'hod', 'dow', 'first_check', 'last_check']])
+
+
+def aggregate_slots(path_in, fn_out, memory_budget=None, workers=1, incremental=False):
+    """
+    Aggregate slot records over multiple days.
+
+    With a `memory_budget` (in bytes), records are aggregated in buckets of
+    locations instead of all at once, see `aggregate_slots_in_buckets`.
+    """
+    if memory_budget is not None and memory_budget <= 0:
+        raise ValueError('memory budget should be positive, not %r' % memory_budget)
+    print("[INFO] aggregating slots")
+    if memory_budget is not None:
+        aggregate_slots_in_buckets(path_in, fn_out, memory_budget, workers, incremental)
+        lib_metrics.report(step='aggregate', path=fn_out)
+        return
+    # read individual files
+    fns = slot_files(path_in)
+    with lib_metrics.timer('read_slots'):
+        li = [read_slots(x) for x in fns]
+        DF = pd.concat(li, axis=0, ignore_index=True)
+    print("[INFO]   read %d records from %s" % (DF.shape[0], path_in))
+    with lib_metrics.timer('aggregate'):
+        DF = aggregate_slot_records(DF)
     # write out
-    DF.to_csv(fn_out, index=False, header=False, date_format="%Y-%m-%d %H:%M")
+    with lib_metrics.timer('csv_write'):
+        DF.to_csv(fn_out, index=False, header=False, date_format="%Y-%m-%d %H:%M")
     print("[INFO]   wrote %d records to %s" % (DF.shape[0], fn_out))
+    lib_metrics.count('slot_records', DF.shape[0])
+    lib_metrics.report(step='aggregate', path=fn_out)
+
+
+def aggregate_slots_with_tail(path_in, fn_out, cutoff):
+    """
+    Aggregate slot records over multiple days, so that records of later days
+    can be merged in with `merge_slots`.
+
+    The output has the same records as `aggregate_slots`, but slots before
+    `cutoff` (a UTC date) come first, followed by the "tail" of later slots,
+    which is also kept in `{fn_out}.tail.pkl` in combined (UTC) form.
+    """
+    print("[INFO] aggregating slots")
+    fns = slot_files(path_in)
+    DF = pd.concat([read_slots(x) for x in fns], axis=0, ignore_index=True)
+    print("[INFO]   read %d records from %s" % (DF.shape[0], path_in))
+    write_slots_with_tail(combine_slot_records(DF), fn_out, 0, cutoff)
+
+
+def merge_slots(fns, fn_out, cutoff):
+    """
+    Merge the slot records in `fns` into an aggregated slots file that was
+    written by `aggregate_slots_with_tail` (or a previous merge), and move the
+    slots before `cutoff` out of the tail.
+
+    Only the tail is read and rewritten, so this takes time proportional to
+    the new records. Returns False without changing anything when the records
+    can't be merged, because there is no tail or they include slots before the
+    previous cutoff, in which case the file needs to be aggregated again.
+    """
+    fn_tail = fn_out + '.tail.pkl'
+    if not os.path.exists(fn_tail) or not os.path.exists(fn_out):
+        return False
+    tail = pd.read_pickle(fn_tail)
+    DF = pd.concat([read_slots(fn) for fn in fns], axis=0, ignore_index=True)
+    if (DF.slot_time < tail['cutoff']).any():
+        print("[INFO]   new slot records are before %s, so can't be merged" % tail['cutoff'])
+        return False
+    print("[INFO] merging %d slot records into %s" % (DF.shape[0], fn_out))
+    DF = combine_slot_records(pd.concat([tail['records'], DF], axis=0, ignore_index=True))
+    write_slots_with_tail(DF, fn_out, tail['head_size'], cutoff)
+    return True
+
+
+def write_slots_with_tail(DF, fn_out, head_size, cutoff):
+    """
+    Write combined slot records to the end of an aggregated slots file,
+    starting at byte `head_size`: first the ones before `cutoff`, which are
+    final, then the tail of later ones.
+    """
+    final = DF.slot_time < cutoff
+    with open(fn_out, 'r+' if head_size > 0 else 'w') as f:
+        f.seek(head_size)
+        f.truncate()
+        localize_slot_records(DF[final]).to_csv(f, index=False, header=False,
+                                                date_format="%Y-%m-%d %H:%M")
+        head_size = f.tell()
+        localize_slot_records(DF[~final]).to_csv(f, index=False, header=False,
+                                                 date_format="%Y-%m-%d %H:%M")
+    # written after the output file, and merging records again has no effect,
+    # so an interrupted merge can just be repeated
+    pd.to_pickle({'cutoff': cutoff, 'head_size': head_size,
+                  'records': DF[~final].reset_index(drop=True)}, fn_out + '.tail.pkl')
+    print("[INFO]   wrote %d final records and %d records in the tail to %s" %
+          (final.sum(), (~final).sum(), fn_out))
+
+
+# rough ratio between the size of slot records in memory and on disk
+SLOTS_MEMORY_FACTOR = 10
+
+
+def aggregate_slots_in_buckets(path_in, fn_out, memory_budget, workers=1, incremental=False):
+    """
+    Aggregate slot records over multiple days, with bounded memory.
+
+    Records of each file are first split by location id into buckets, which
+    are stored in `{path_in}slots_parts/{bucket}/`. Then each bucket is
+    aggregated separately (optionally with multiple workers), and the results
+    are appended to `fn_out`. The number of buckets is chosen so a bucket fits
+    in the memory budget of a worker.
+
+    In incremental mode, only files that changed since the last run are split
+    up again, and only buckets with changed files are aggregated again.
+    """
+    path_parts = path_in + 'slots_parts/'
+    fn_manifest = path_parts + 'manifest.json'
+    fns = sorted(slot_files(path_in))
+    stats = {os.path.relpath(fn, path_in): [os.stat(fn).st_size, os.stat(fn).st_mtime_ns]
+             for fn in fns}
+    # use a power of two, so the number of buckets doesn't change every day
+    size = sum(x[0] for x in stats.values()) * SLOTS_MEMORY_FACTOR
+    n_buckets = 1
+    while size / n_buckets > memory_budget / workers:
+        n_buckets *= 2
+
+    manifest = {'n_buckets': n_buckets, 'files': {}}
+    if incremental and os.path.exists(fn_manifest):
+        with open(fn_manifest, 'r') as f:
+            manifest = json.load(f)
+    if manifest['n_buckets'] != n_buckets:
+        manifest = {'n_buckets': n_buckets, 'files': {}}
+    if not manifest['files'] and os.path.exists(path_parts):
+        shutil.rmtree(path_parts)
+    for bucket in range(n_buckets):
+        os.makedirs('%s%04d' % (path_parts, bucket), exist_ok=True)
+
+    # split changed files into buckets, and remove parts of deleted files
+    changed = [name for name in stats if manifest['files'].get(name) != stats[name]]
+    changed += [name for name in manifest['files'] if name not in stats]
+    dirty = set()
+    for name in changed:
+        for bucket in range(n_buckets):
+            fn_part = '%s%04d/%s.pkl' % (path_parts, bucket, name.replace('/', '_'))
+            if os.path.exists(fn_part):
+                os.remove(fn_part)
+                dirty.add(bucket)
+        if name not in stats:
+            continue
+        with lib_metrics.timer('split'):
+            DF = read_slots(path_in + name)
+            for (bucket, part) in DF.groupby(DF.id % n_buckets):
+                part.to_pickle('%s%04d/%s.pkl' % (path_parts, bucket, name.replace('/', '_')))
+                dirty.add(bucket)
+    print("[INFO]   split %d of %d files into %d buckets" % (len(changed), len(fns), n_buckets))
+
+    # aggregate buckets that changed
+    buckets = [bucket for bucket in range(n_buckets)
+               if bucket in dirty or not os.path.exists('%s%04d.csv' % (path_parts, bucket))]
+    with lib_metrics.timer('aggregate'):
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(aggregate_bucket, [path_parts] * len(buckets), buckets))
+        else:
+            for bucket in buckets:
+                aggregate_bucket(path_parts, bucket)
+    print("[INFO]   aggregated %d of %d buckets" % (len(buckets), n_buckets))
+    with open(fn_manifest, 'w') as f:
+        json.dump({'n_buckets': n_buckets, 'files': stats}, f)
+
+    # combine buckets into the output file
+    n_records = 0
+    with lib_metrics.timer('combine'), open(fn_out, 'w') as f_out:
+        for bucket in range(n_buckets):
+            with open('%s%04d.csv' % (path_parts, bucket), 'r') as f:
+                for line in f:
+                    f_out.write(line)
+                    n_records += 1
+    print("[INFO]   wrote %d records to %s" % (n_records, fn_out))
+    lib_metrics.count('buckets', len(buckets))
+    lib_metrics.count('slot_records', n_records)
+
+
+def aggregate_bucket(path_parts, bucket):
+    """
+    Aggregate the slot records in one bucket.
+    """
+    fns = glob('%s%04d/*.pkl' % (path_parts, bucket))
+    if len(fns) == 0:
+        DF = pd.DataFrame(columns=['id', 'slot_time', 'hod', 'dow', 'first_check', 'last_check'])
+    else:
+        DF = pd.concat([pd.read_pickle(fn) for fn in fns], axis=0, ignore_index=True)
+        DF = aggregate_slot_records(DF)
+    DF.to_csv('%s%04d.csv' % (path_parts, bucket), index=False, header=False,
+              date_format="%Y-%m-%d %H:%M")
+    return DF.shape[0]
+
+
+def zipmap_key(fn='vaccinespotter-zipdump.csv'):
+    """
+    Get the key of the version of the zip map file, as [size, mtime_ns], to
+    tell whether results derived from it are still up to date.
+    """
+    stat = os.stat(fn)
+    return [stat.st_size, stat.st_mtime_ns]
 
 
-def read_zipmap():
+@functools.lru_cache(maxsize=1)
+def read_zipmap(fn='vaccinespotter-zipdump.csv'):
     """
     Read map of zipcodes to timezones.
+
+    The map is kept in a pickle next to the data, which is used as long as the
+    CSV file doesn't change (see `zipmap_key`), and only read once per process.
+    It should not be modified.
     """
+    fn_cache = path_root + '/zipmap.pkl'
+    key = zipmap_key(fn)
+    if os.path.exists(fn_cache):
+        cache = pd.read_pickle(fn_cache)
+        if cache['key'] == key:
+            return cache['zipmap']
     zipmap = {}
-    with open('vaccinespotter-zipdump.csv', 'r') as f:
+    with open(fn, 'r') as f:
         reader = csv.DictReader(f, delimiter=',')
         for row in reader:
             zipmap[row['postal_code']] = (row['time_zone'], row['city'], row['county_name'])
+    if os.path.exists(path_root):
+        pd.to_pickle({'key': key, 'zipmap': zipmap}, fn_cache)
     return zipmap
 
 
+def wkb_points(hex_strings):
+    """
+    Decode 2D points from hex (E)WKB strings in a batch, as arrays of x and y
+    coordinates. Anything that isn't a 2D point decodes as NaN.
+    """
+    x = np.full(len(hex_strings), np.nan)
+    y = np.full(len(hex_strings), np.nan)
+    by_length = {}
+    for (i, s) in enumerate(hex_strings):
+        by_length.setdefault(len(s), []).append(i)
+    # a point is a byte order, a type (optionally with the SRID flag), an
+    # optional SRID, and two doubles
+    for (length, offset, point_type) in [(42, 5, 0x00000001), (50, 9, 0x20000001)]:
+        if length not in by_length:
+            continue
+        index = np.array(by_length[length])
+        blobs = []
+        for i in index.tolist():
+            try:
+                blobs.append(bytes.fromhex(hex_strings[i]))
+            except ValueError:
+                blobs.append(b'\xff' * (length // 2))
+        data = np.frombuffer(b''.join(blobs), dtype=np.uint8).reshape(len(index), length // 2)
+        little = data[:, 0] == 1
+        header = np.ascontiguousarray(data[:, 1:5])
+        types = np.where(little, header.view('<u4')[:, 0], header.view('>u4')[:, 0])
+        coords = np.ascontiguousarray(data[:, offset:offset + 16])
+        values = np.where(little[:, None], coords.view('<f8'), coords.view('>f8'))
+        valid = (types == point_type) & ((data[:, 0] == 0) | little)
+        x[index[valid]] = values[valid, 0]
+        y[index[valid]] = values[valid, 1]
+    return (x, y)
+
+
 # inspired by https://stackoverflow.com/a/33245493
 def is_uuid(s, version=4):
     if not isinstance(s, str):
@@ -235,3 +650,26 @@ def add_days(ds, days=1):
     next_day = datetime.datetime.strptime(ds, "%Y-%m-%d")
     next_day = next_day + datetime.timedelta(days=days)
     return next_day.strftime("%Y-%m-%d")
+
+
+def epoch_seconds(ts):
+    """
+    Convert a UTC time stamp string ("YYYY-MM-DD HH:MM[:SS]") to seconds
+    since epoch.
+    """
+    return int((datetime.datetime.fromisoformat(ts) - EPOCH).total_seconds())
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def format_minutes(minutes):
+    """
+    Format minutes since epoch as a UTC time stamp string ("YYYY-MM-DD HH:MM").
+    """
+    return (EPOCH + datetime.timedelta(minutes=minutes)).strftime("%Y-%m-%d %H:%M")
+
+
+def format_seconds(seconds):
+    """
+    Format seconds since epoch as a UTC time stamp string ("YYYY-MM-DD HH:MM:SS").
+    """
+    return '%s:%02d' % (format_minutes(seconds // 60), seconds % 60)
@@ -8,6 +8,14 @@ def cli_date(text):
     return dateutil.parser.parse(text).date()
 
 
+def positive_int(text):
+    """Parse a positive integer"""
+    value = int(text)
+    if value <= 0:
+        raise argparse.ArgumentTypeError("should be positive, not %d" % value)
+    return value
+
+
 def create_agument_parser(**kwargs):
     """Create an argument parser with basic start/end date options."""
     parser = argparse.ArgumentParser(**kwargs)
@@ -20,6 +28,64 @@ def create_agument_parser(**kwargs):
     return parser
 
 
+def add_aggregation_arguments(parser):
+    """Add options for aggregating slot records (see `lib.aggregate_slots`)."""
+    parser.add_argument('--memory_budget', type=positive_int, metavar='MB',
+                        help="aggregate slots in buckets that fit in this much memory")
+    parser.add_argument('--incremental_aggregation', action='store_true',
+                        help="only aggregate slots of files that changed since the last run "
+                             "(requires --memory_budget)")
+    return parser
+
+
+def check_aggregation_arguments(parser, args):
+    """Exit with a usage error if the aggregation options don't go together."""
+    if args.incremental_aggregation and args.memory_budget is None:
+        parser.error("--incremental_aggregation requires --memory_budget")
+
+
+def aggregation_options(args):
+    """Get the keyword arguments for `lib.aggregate_slots` from parsed options."""
+    return {'memory_budget': args.memory_budget and args.memory_budget * 1024 * 1024,
+            'incremental': args.incremental_aggregation}
+
+
+def add_output_arguments(parser):
+    """Add options for the formats of the output files (see `lib_output`)."""
+    parser.add_argument('--output_format', nargs='+', default=['csv'], metavar='FORMAT',
+                        choices=['csv', 'parquet', 'feather'],
+                        help="formats to write the output files in: csv (default), "
+                             "parquet and/or feather")
+    return parser
+
+
+def add_avs_engine_argument(parser):
+    """Add the option to merge availability records per row or all at once."""
+    parser.add_argument('--avs_engine', choices=['rows', 'arrays'], default='rows',
+                        help="merge availability records one row at a time (default), or all "
+                             "rows of a date at once with array operations "
+                             "(see `lib_state.merge_availability`)")
+    return parser
+
+
+def add_slot_time_cache_argument(parser):
+    """Add the option for the size of the slot time cache (see `lib_tz.SlotTimeCache`)."""
+    parser.add_argument('--slot_time_cache_size', type=int, metavar='N',
+                        help="number of slot start times to keep parsed (default: "
+                             "lib_tz.SLOT_TIME_CACHE_SIZE); its hits and misses are counted "
+                             "in the --metrics")
+    return parser
+
+
+def add_metrics_arguments(parser):
+    """Add options for instrumenting a run (see `lib_metrics`)."""
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="append per-day timers, counters and peak memory to FILE as JSON lines")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="profile the run with cProfile and write the stats to FILE")
+    return parser
+
+
 def get_dates_in_range(start_date, end_date=None):
     """
     Given a start and end datetime, create a list of date strings representing
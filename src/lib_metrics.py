@@ -0,0 +1,174 @@
+#
+# Opt-in instrumentation of the processing pipelines.
+#
+# When enabled (with `enable`, or by setting the PIPELINE_METRICS environment
+# variable to a file name, which also enables it in worker processes), the
+# pipelines record the time spent per stage (gzip, JSON decoding, time zones,
+# CSV writing, ...), counters of rows and records, and the memory high-water
+# mark, and append them per processed day to that file as JSON lines:
+#
+#   {"time": ..., "pid": ..., "pipeline": "univaf", "date": "2021-06-01",
+#    "step": "merge", "timers": {"read_state": 0.12, ...},
+#    "counters": {"updates": 142000, ...}, "peak_rss_mb": 412.3}
+#
+# Stages can be nested (e.g. `merge` includes `csv_write`). When disabled,
+# `timer` returns a shared no-op context manager and `timed` returns functions
+# unchanged, so instrumented code runs at full speed. Hot loops should only be
+# instrumented through `timed`, or per block or chunk.
+#
+
+import collections
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+
+metrics_path = os.getenv('PIPELINE_METRICS') or None
+enabled = metrics_path is not None
+
+timers = collections.defaultdict(float)  # { stage : seconds }
+counters = collections.Counter()         # { name : count }
+
+NULL_TIMER = contextlib.nullcontext()
+
+
+def enable(path):
+    """
+    Enable instrumentation, writing metrics to `path`.
+    """
+    global metrics_path, enabled
+    metrics_path = path
+    enabled = True
+    # so processes that are spawned later enable it too
+    os.environ['PIPELINE_METRICS'] = path
+    reset()
+
+
+class Timer:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        timers[self.stage] += time.perf_counter() - self.start
+
+
+def timer(stage):
+    """
+    Get a context manager that adds the time spent in it to a stage.
+    """
+    return Timer(stage) if enabled else NULL_TIMER
+
+
+def add_time(stage, start):
+    """
+    Add the time since `start` (a `time.perf_counter` value) to a stage.
+    """
+    if enabled:
+        timers[stage] += time.perf_counter() - start
+
+
+def timed(stage, function):
+    """
+    Wrap a function so the time spent in it is added to a stage. Returns the
+    function itself when instrumentation is disabled.
+    """
+    if not enabled:
+        return function
+    perf_counter = time.perf_counter
+
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timers[stage] += perf_counter() - start
+    return wrapper
+
+
+def count(name, n=1):
+    """
+    Add `n` to a counter.
+    """
+    if enabled:
+        counters[name] += n
+
+
+def peak_rss():
+    """
+    Get the memory high-water mark of this process (in bytes), since the last
+    `reset` where the OS supports resetting it, or else since it started.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # maxrss is in kilobytes on Linux, but in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset():
+    """
+    Reset the timers, counters and (on Linux) the memory high-water mark.
+    """
+    timers.clear()
+    counters.clear()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def report(**fields):
+    """
+    Append the current metrics, with the given fields (e.g. pipeline and
+    date), to the metrics file as a JSON line, and reset them.
+    """
+    if not enabled:
+        return
+    record = {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+              'pid': os.getpid()}
+    record.update(fields)
+    record['timers'] = {stage: round(seconds, 4) for (stage, seconds) in timers.items()}
+    record['counters'] = dict(counters)
+    record['peak_rss_mb'] = round(peak_rss() / 1024 / 1024, 1)
+    # a single write per line, so lines of multiple processes don't interleave
+    with open(metrics_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    reset()
+
+
+@contextlib.contextmanager
+def profile(path, n_functions=30):
+    """
+    Profile the code in the context with cProfile, if `path` is set. The
+    stats are written to `path` (to be read with `pstats` or e.g. snakeviz),
+    and the functions with the most cumulative time are printed.
+    """
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print("[INFO] wrote profile to %s" % path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(n_functions)
@@ -0,0 +1,255 @@
+#
+# Output files of the processing scripts, as CSV and/or columnar files.
+#
+# The availability and slot records of each day are written as CSV files
+# (`avs_{DATE}.csv`, `slots_{DATE}.csv`), and/or buffered in typed columns and
+# written as Parquet or Feather files, partitioned by date:
+#
+#   avs/ds={DATE}/part-0.parquet   - (id, first_checked_time, last_checked_time,
+#                                     offset, availability)
+#   slots/ds={DATE}/part-0.parquet - (id, slot_time, first_checked_time,
+#                                     last_checked_time, offset)
+#
+# Ids are int32, offsets int8, and times int64 UTC time stamps (in seconds).
+# Availability is kept as text, like in the CSV files ('+', a count, or empty).
+# The aggregated slots file can be converted the same way, partitioned by the
+# (local) date of the slots, see `write_aggregated_slots`.
+#
+# Columnar files are read back with `lib.read_output` (or e.g. with
+# `arrow::open_dataset` in R), and the slot files of days without CSV files
+# are aggregated from their columnar version (see `lib.slot_files`).
+#
+
+import csv
+import os
+import shutil
+import numpy as np
+import pandas as pd
+# pyarrow is only needed for columnar output
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+# internal
+import lib_metrics
+
+FORMATS = ('csv', 'parquet', 'feather')
+COLUMNAR_FORMATS = ('parquet', 'feather')
+
+# number of records buffered before they're written to a columnar file
+OUTPUT_BATCH_SIZE = 1 << 20
+
+# columns of the output files, with their types (see `arrow_type`)
+COLUMNS = {
+    'avs': [('id', 'id'), ('first_checked_time', 'time'), ('last_checked_time', 'time'),
+            ('offset', 'offset'), ('availability', 'text')],
+    'slots': [('id', 'id'), ('slot_time', 'time'), ('first_checked_time', 'time'),
+              ('last_checked_time', 'time'), ('offset', 'offset')],
+    'aggregated': [('id', 'id'), ('slot_time', 'local_time'), ('hod', 'small'),
+                   ('dow', 'small'), ('first_check', 'local_time'),
+                   ('last_check', 'local_time')]
+}
+
+
+def arrow_type(kind):
+    return {'id': pa.int32(),
+            'time': pa.timestamp('s', tz='UTC'),
+            'local_time': pa.timestamp('s'),
+            'offset': pa.int8(),
+            'small': pa.int8(),
+            'text': pa.dictionary(pa.int32(), pa.string())}[kind]
+
+
+def schema(name):
+    """
+    Get the Arrow schema of an output file.
+    """
+    return pa.schema([(column, arrow_type(kind)) for (column, kind) in COLUMNS[name]])
+
+
+def check_formats(formats):
+    """
+    Check that the output formats are known, and can be written.
+    """
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise ValueError('unknown output format "%s"' % fmt)
+        if fmt in COLUMNAR_FORMATS and pa is None:
+            raise RuntimeError('pyarrow is needed for %s output' % fmt)
+    return formats
+
+
+def csv_path(path, name, ds):
+    return '%s%s_%s.csv' % (path, name, ds)
+
+
+def columnar_path(path, name, ds, fmt):
+    return '%s%s/ds=%s/part-0.%s' % (path, name, ds, fmt)
+
+
+def output_exists(path, name, ds, formats):
+    """
+    Check whether the output file of a date exists in all formats.
+    """
+    return all(os.path.exists(csv_path(path, name, ds) if fmt == 'csv' else
+                               columnar_path(path, name, ds, fmt))
+               for fmt in formats)
+
+
+def to_seconds(values, units):
+    """
+    Convert a column of times to an array of seconds since epoch. Times are
+    either integers in `units` ('s' or 'min'), or UTC time stamp strings.
+    """
+    if type(values[0]) == str:
+        times = pd.to_datetime(pd.Series(values, dtype=object), utc=True, cache=True)
+        return pa.array(times.values.astype('int64') // 10 ** 9, mask=times.isna().values)
+    seconds = np.array(values, dtype=np.int64)
+    return pa.array(seconds * 60 if units == 'min' else seconds)
+
+
+def to_text(values):
+    return pa.array([None if value is None else str(value) for value in values],
+                    pa.string()).dictionary_encode()
+
+
+class ColumnarWriter:
+    """
+    Writer of records to a Parquet or Feather file, which buffers them and
+    writes them in batches of typed columns.
+
+    The file only appears once it's closed, so it's complete when it exists.
+    """
+
+    def __init__(self, fn, name, fmt, units=None):
+        self.fn = fn
+        self.schema = schema(name)
+        self.columns = COLUMNS[name]
+        self.units = units or {}
+        self.rows = []
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        if fmt == 'parquet':
+            self.writer = pq.ParquetWriter(fn + '.tmp', self.schema)
+        else:
+            self.writer = pa.ipc.new_file(fn + '.tmp', self.schema,
+                                          options=pa.ipc.IpcWriteOptions(compression='lz4'))
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= OUTPUT_BATCH_SIZE:
+            self.flush()
+
+    def write_frame(self, DF):
+        """
+        Write a DataFrame with the columns of the file right away.
+        """
+        with lib_metrics.timer('columnar_write'):
+            self.writer.write_table(pa.Table.from_pandas(DF, schema=self.schema,
+                                                         preserve_index=False))
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        with lib_metrics.timer('columnar_write'):
+            arrays = []
+            for ((column, kind), values) in zip(self.columns, zip(*self.rows)):
+                if kind == 'time':
+                    array = to_seconds(values, self.units.get(column, 's'))
+                elif kind == 'text':
+                    array = to_text(values)
+                else:
+                    array = pa.array(values)
+                arrays.append(array.cast(arrow_type(kind)))
+            self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        os.replace(self.fn + '.tmp', self.fn)
+
+
+class CsvWriter:
+    """
+    Writer of records to a CSV file, formatting them with `format_row`.
+    """
+
+    def __init__(self, fn, format_row=None):
+        self.f = open(fn, 'w')
+        writerow = csv.writer(self.f, delimiter=',', quoting=csv.QUOTE_MINIMAL).writerow
+        if format_row is None:
+            self.write = lib_metrics.timed('csv_write', writerow)
+        else:
+            self.write = lib_metrics.timed('csv_write', lambda row: writerow(format_row(row)))
+
+    def close(self):
+        self.f.close()
+
+
+class OutputFile:
+    """
+    Writer of the records of one output file (e.g. 'avs') of a date, in one or
+    more formats. Records are sequences of values in the order of the columns,
+    which aren't changed after they're written; `format_row` converts them to
+    CSV rows, and `units` gives the units of integer time columns.
+    """
+
+    def __init__(self, path, name, ds, formats=('csv',), format_row=None, units=None):
+        self.fn = csv_path(path, name, ds)
+        self.writers = []
+        for fmt in check_formats(formats):
+            if fmt == 'csv':
+                self.writers.append(CsvWriter(self.fn, format_row))
+            else:
+                self.writers.append(ColumnarWriter(columnar_path(path, name, ds, fmt),
+                                                   name, fmt, units))
+        if 'csv' not in formats:
+            self.fn = self.writers[0].fn
+        if len(self.writers) == 1:
+            self.write = self.writers[0].write
+        else:
+            writes = [writer.write for writer in self.writers]
+
+            def write(row):
+                for write_format in writes:
+                    write_format(row)
+            self.write = write
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def write_aggregated_slots(fn_slots, formats):
+    """
+    Write an aggregated slots file (as written by `lib.aggregate_slots`) in
+    columnar formats, partitioned by the date of the slots, to a directory
+    with the same name as the file (without `.csv`).
+    """
+    for fmt in check_formats(formats):
+        if fmt == 'csv':
+            continue
+        path = fn_slots[:-len('.csv')] + '/'
+        tmp_path = path[:-1] + '.tmp/'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        writers = {}
+        reader = pd.read_csv(fn_slots, names=[column for (column, kind) in COLUMNS['aggregated']],
+                             parse_dates=['slot_time', 'first_check', 'last_check'],
+                             chunksize=OUTPUT_BATCH_SIZE)
+        n = 0
+        for DF in reader:
+            n += DF.shape[0]
+            for (ds, part) in DF.groupby(DF.slot_time.dt.strftime('%Y-%m-%d')):
+                if ds not in writers:
+                    writers[ds] = ColumnarWriter('%sds=%s/part-0.%s' % (tmp_path, ds, fmt),
+                                                 'aggregated', fmt)
+                writers[ds].write_frame(part)
+        for writer in writers.values():
+            writer.close()
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(tmp_path, exist_ok=True)
+        os.rename(tmp_path, path)
+        print("[INFO]   wrote %d records to %s" % (n, path))
@@ -0,0 +1,387 @@
+#
+# Compact data structures for the state that is kept while processing the
+# availability logs.
+#
+
+from array import array
+from bisect import bisect_left
+import numpy as np
+import os
+import pandas as pd
+import struct
+import tempfile
+import zipfile
+
+# version of the checkpoint format, to be bumped when it changes
+CHECKPOINT_VERSION = 2
+# availability values that aren't counts, by how their kind is stored in
+# checkpoints (counts are kind 0)
+AVAILABILITY_KINDS = {1: '+', 2: None}
+# how they were stored in the counts of version 1 checkpoints
+V1_AVAILABILITY_CODES = {-1: '+', -2: None}
+
+
+class OpenSlots:
+    """
+    The open slots of a single location, stored as parallel arrays that are
+    sorted by slot time. Times are integers (see `process_univaf`) and offsets
+    are in whole hours.
+
+    Marking all slots as seen (`touch`) only records the time, which is
+    written to `last` when it's used, so methods that change `times` have to
+    get `last` first. The last list of slots that was merged
+    with `update` is kept as long as the open slots are exactly its available
+    ones, so the same list again only has to touch them.
+    """
+    __slots__ = ('times', 'first', '_last', 'offset', '_touched', 'seen_slots')
+
+    def __init__(self, records=()):
+        self.times = array('q')
+        self.first = array('q')
+        self.last = array('q')
+        self.offset = array('b')
+        for (slot_time, first, last, offset) in sorted(records):
+            self.times.append(slot_time)
+            self.first.append(first)
+            self.last.append(last)
+            self.offset.append(offset)
+
+    @property
+    def last(self):
+        if self._touched is not None:
+            self._last = array('q', [self._touched]) * len(self.times)
+            self._touched = None
+        return self._last
+
+    @last.setter
+    def last(self, value):
+        self._last = value
+        self._touched = None
+        self.seen_slots = None
+
+    @classmethod
+    def from_arrays(cls, times, first, last, offset):
+        """
+        Create from NumPy arrays that are already sorted by slot time.
+        """
+        location_slots = cls()
+        location_slots.times.frombytes(times.astype(np.int64).tobytes())
+        location_slots.first.frombytes(first.astype(np.int64).tobytes())
+        location_slots.last.frombytes(last.astype(np.int64).tobytes())
+        location_slots.offset.frombytes(offset.astype(np.int8).tobytes())
+        return location_slots
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        """
+        Iterate over the records as (slot_time, first, last, offset) tuples.
+        """
+        return zip(self.times, self.first, self.last, self.offset)
+
+    def find(self, slot_time):
+        """
+        Get the index of a slot time, or -1 if it is not open.
+        """
+        i = bisect_left(self.times, slot_time)
+        if i < len(self.times) and self.times[i] == slot_time:
+            return i
+        return -1
+
+    def open(self, slot_time, check_time, offset):
+        """
+        Open a new slot, first seen at `check_time`.
+        """
+        last = self.last
+        i = bisect_left(self.times, slot_time)
+        self.times.insert(i, slot_time)
+        self.first.insert(i, check_time)
+        last.insert(i, check_time)
+        self.offset.insert(i, offset)
+        self.seen_slots = None
+
+    def close(self, i):
+        """
+        Close the slot at index `i`, and return its record.
+        """
+        last = self.last
+        record = (self.times[i], self.first[i], last[i], self.offset[i])
+        del self.times[i], self.first[i], last[i], self.offset[i]
+        self.seen_slots = None
+        return record
+
+    def touch(self, check_time):
+        """
+        Mark all open slots as seen at `check_time`.
+        """
+        self._touched = check_time
+
+    def discard_before(self, slot_time):
+        """
+        Remove the slots before `slot_time`, without closing them.
+        """
+        last = self.last
+        i = bisect_left(self.times, slot_time)
+        if i > 0:
+            del self.times[:i], self.first[:i], last[:i], self.offset[:i]
+            self.seen_slots = None
+
+    def close_unseen(self, check_time):
+        """
+        Close all slots that were not seen at `check_time`, and return their
+        records.
+        """
+        if self.last.count(check_time) == len(self.last):
+            return []
+        records = list(self)
+        self.__init__()
+        closed = []
+        for record in records:
+            if record[2] == check_time:
+                self.times.append(record[0])
+                self.first.append(record[1])
+                self.last.append(record[2])
+                self.offset.append(record[3])
+            else:
+                closed.append(record)
+        return closed
+
+    def update(self, row_slots, check_time, offset):
+        """
+        Merge a list of (slot_time, available) of the location at `check_time`:
+        open the available slots that aren't open yet, mark the ones that are
+        as seen, and close the unavailable ones and the ones that weren't
+        seen. Returns the closed records (the unavailable ones in the order of
+        the list, then the others by slot time), or None if the list has
+        duplicate slot times, which have to be merged one by one.
+
+        The open and closed slots are found as set differences of slot times,
+        and a list that is the same as the previous one only touches them.
+        """
+        if row_slots == self.seen_slots:
+            self.touch(check_time)
+            return []
+        available = {slot_time for (slot_time, is_available) in row_slots if is_available}
+        unavailable = [slot_time for (slot_time, is_available) in row_slots if not is_available]
+        if len(available) + len(set(unavailable)) != len(row_slots) or \
+                not available.isdisjoint(unavailable):
+            return None
+
+        records = list(self)
+        is_open = {record[0]: record for record in records}
+        closed = [is_open.pop(slot_time) for slot_time in unavailable if slot_time in is_open]
+        # slots that were seen at the same time before are kept too
+        kept = []
+        for record in records:
+            if record[0] in is_open:
+                if record[0] in available:
+                    kept.append((record[0], record[1], check_time, record[3]))
+                elif record[2] == check_time:
+                    kept.append(record)
+                else:
+                    closed.append(record)
+        n_kept = len(kept)
+        kept += [(slot_time, check_time, check_time, offset)
+                 for slot_time in available if slot_time not in is_open]
+        if len(kept) > n_kept:
+            kept.sort()
+        (times, first, last, offsets) = zip(*kept) if kept else ((), (), (), ())
+        self.times = array('q', times)
+        self.first = array('q', first)
+        self.last = array('q', last)
+        self.offset = array('b', offsets)
+        # the open slots are the available ones, unless some were kept
+        if len(kept) == len(available):
+            self.seen_slots = row_slots
+        return closed
+
+
+def merge_availability(avs, iids, check_times, offsets, availabilities, changed=None):
+    """
+    Merge a day of availability updates into the avs state all at once, with
+    array operations instead of a dict update per row. This gives the same
+    result as the per-row logic of the processing scripts: an update starts a
+    new record when its availability differs from the location's open record
+    (which is then closed), and otherwise extends it. Updates that aren't
+    `changed` only extend open records, and are skipped for locations without
+    one.
+
+    `avs` is the state, {id: [first, last, offset, availability]}, and is
+    updated in place (in the same order as the per-row logic leaves it). The
+    other arguments are columns of the updates, in order. Returns the closed
+    records, [id, first, last, offset, availability], in the order in which
+    they were closed.
+    """
+    n_open = len(avs)
+    n = n_open + len(iids)
+    if len(iids) == 0:
+        return []
+    # the open records go first, as changed updates with their own first time
+    records = list(avs.values())
+    ids = np.concatenate([np.fromiter(avs.keys(), dtype=np.int64, count=n_open),
+                          np.asarray(iids, dtype=np.int64)])
+    firsts = [record[0] for record in records] + list(check_times)
+    lasts = [record[1] for record in records] + list(check_times)
+    offsets = [record[2] for record in records] + list(offsets)
+    values = [record[3] for record in records] + list(availabilities)
+    # availabilities are compared as codes (None is -1)
+    codes = pd.factorize(np.array(values, dtype=object))[0]
+    is_changed = np.ones(n, dtype=bool)
+    if changed is not None:
+        is_changed[n_open:] = np.asarray(changed, dtype=bool)
+
+    # sort by location, keeping the order of updates
+    order = np.argsort(ids, kind='stable')
+    ids = ids[order]
+    is_changed = is_changed[order]
+    group_starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    # skip updates of a location before its first changed one
+    n_changed = np.cumsum(is_changed)
+    n_before = (n_changed - is_changed)[group_starts]
+    keep = n_changed - np.repeat(n_before, np.diff(np.r_[group_starts, n])) > 0
+    (order, ids, is_changed) = (order[keep], ids[keep], is_changed[keep])
+    m = len(order)
+    if m == 0:
+        return []
+    is_group_start = np.r_[True, ids[1:] != ids[:-1]]
+
+    # unchanged updates have the availability of the last changed one, and
+    # a record starts at a location's first update, or when it changes
+    codes = codes[order]
+    last_changed = np.maximum.accumulate(np.where(is_changed, np.arange(m), 0))
+    codes = codes[last_changed]
+    starts = np.flatnonzero(is_group_start | (is_changed & (codes != np.r_[codes[:1], codes[:-1]])))
+    ends = np.r_[starts[1:], m] - 1
+    is_open = np.r_[is_group_start[starts[1:]], True]
+
+    # records are closed by the update that starts the next one
+    closed = np.flatnonzero(~is_open)
+    closed = closed[np.argsort(order[starts[closed + 1]], kind='stable')]
+    (first_rows, last_rows) = (order[starts].tolist(), order[ends].tolist())
+    record_ids = ids[starts].tolist()
+
+    def record(i):
+        (first, last) = (first_rows[i], last_rows[i])
+        return [record_ids[i], firsts[first], lasts[last], offsets[first], values[first]]
+    result = [record(i) for i in closed.tolist()]
+
+    # the open records, in order of the first update of their location
+    still_open = np.flatnonzero(is_open)
+    group_firsts = np.maximum.accumulate(np.where(is_group_start, np.arange(m), 0))
+    still_open = still_open[np.argsort(order[group_firsts[starts[still_open]]], kind='stable')]
+    avs.clear()
+    for i in still_open.tolist():
+        row = record(i)
+        avs[row[0]] = row[1:]
+    return result
+
+
+def write_checkpoint(path, avs, slots):
+    """
+    Write the avs/slots state to an uncompressed NumPy .npz file, so it can be
+    memory-mapped (see `map_arrays`). The file is replaced atomically, so a
+    checkpoint is always complete when it exists.
+    """
+    avs_rows = list(avs.items())
+    kinds = {availability: kind for (kind, availability) in AVAILABILITY_KINDS.items()}
+    slot_ids = np.repeat(np.array(list(slots.keys()), dtype=np.int64),
+                         [len(location_slots) for location_slots in slots.values()])
+    slot_columns = [np.concatenate([np.frombuffer(getattr(location_slots, column), dtype=dtype)
+                                    for location_slots in slots.values()] + [np.array([], dtype=dtype)])
+                    for (column, dtype) in [('times', np.int64), ('first', np.int64),
+                                            ('last', np.int64), ('offset', np.int8)]]
+    arrays = {
+        'version': np.array([CHECKPOINT_VERSION]),
+        'avs_id': np.array([iid for (iid, row) in avs_rows], dtype=np.int64),
+        'avs_first': np.array([row[0] for (iid, row) in avs_rows], dtype=np.int64),
+        'avs_last': np.array([row[1] for (iid, row) in avs_rows], dtype=np.int64),
+        'avs_offset': np.array([row[2] for (iid, row) in avs_rows], dtype=np.int8),
+        'avs_kind': np.array([0 if type(row[3]) == int else kinds[row[3]]
+                              for (iid, row) in avs_rows], dtype=np.int8),
+        'avs_availability': np.array([row[3] if type(row[3]) == int else 0
+                                      for (iid, row) in avs_rows], dtype=np.int64),
+        'slots_id': slot_ids,
+        'slots_time': slot_columns[0],
+        'slots_first': slot_columns[1],
+        'slots_last': slot_columns[2],
+        'slots_offset': slot_columns[3]
+    }
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def map_arrays(path):
+    """
+    Memory-map the arrays of an uncompressed .npz file (`np.load` ignores
+    `mmap_mode` for those), so only the parts that are used are read.
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('%s is compressed, so it can\'t be memory-mapped' % path)
+            # the data of a member follows its local header, which has the
+            # lengths of its name and extra field at bytes 26-29
+            f.seek(info.header_offset + 26)
+            (name_length, extra_length) = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(f)
+            else:
+                (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(f)
+            name = info.filename[:-len('.npy')]
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(f, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+    return arrays
+
+
+def read_checkpoint(path, min_slot_time=None):
+    """
+    Read the avs/slots state from a checkpoint, leaving out slots before
+    `min_slot_time`. The arrays of the checkpoint are memory-mapped, so the
+    slots that are left out aren't copied.
+    """
+    checkpoint = map_arrays(path)
+    version = int(checkpoint['version'][0])
+    if version not in [1, CHECKPOINT_VERSION]:
+        raise ValueError('checkpoint %s has version %d, expected %d' %
+                         (path, version, CHECKPOINT_VERSION))
+    availabilities = checkpoint['avs_availability'].tolist()
+    if version == 1:
+        availabilities = [V1_AVAILABILITY_CODES.get(availability, availability)
+                          for availability in availabilities]
+    else:
+        availabilities = [AVAILABILITY_KINDS.get(kind, availability) for (kind, availability)
+                          in zip(checkpoint['avs_kind'].tolist(), availabilities)]
+    avs = {}
+    for (iid, first, last, offset, availability) in zip(
+            checkpoint['avs_id'].tolist(), checkpoint['avs_first'].tolist(),
+            checkpoint['avs_last'].tolist(), checkpoint['avs_offset'].tolist(),
+            availabilities):
+        avs[iid] = [first, last, offset, availability]
+    columns = [checkpoint[k] for k in
+               ['slots_id', 'slots_time', 'slots_first', 'slots_last', 'slots_offset']]
+    if min_slot_time is not None:
+        keep = columns[1] >= min_slot_time
+        columns = [column[keep] for column in columns]
+    slots = {}
+    # slots are stored grouped by location
+    starts = np.flatnonzero(np.diff(columns[0], prepend=np.int64(-1)) != 0)
+    ends = np.append(starts[1:], len(columns[0]))
+    for (start, end) in zip(starts.tolist(), ends.tolist()):
+        slots[int(columns[0][start])] = OpenSlots.from_arrays(
+            *[column[start:end] for column in columns[1:]])
+    return (avs, slots)
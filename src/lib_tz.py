@@ -0,0 +1,171 @@
+#
+# Fast lookups of UTC offsets in time zones.
+#
+# Converting every check time with `astimezone` is slow, so instead this
+# looks up offsets in the table of UTC transition times of each time zone
+# (the same table pytz uses), with a binary search per time stamp, or
+# vectorized over arrays of time stamps. Offsets are in whole hours, rounded
+# towards zero like `int(utcoffset.total_seconds() / 3600)`.
+#
+# The same slot start time stamps also show up in every update of a location,
+# so their conversions are kept in a bounded cache (`SlotTimeCache`), which
+# counts its hits and misses to tune its size with.
+#
+
+import bisect
+import collections
+import datetime
+import functools
+import numpy as np
+import pytz
+import us
+# internal
+import lib_metrics
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# number of slot start time stamps kept by a `SlotTimeCache`
+SLOT_TIME_CACHE_SIZE = 1 << 16
+
+
+@functools.lru_cache(maxsize=1024)
+def get_timezone(timezone):
+    """
+    Get the pytz time zone with a name.
+    """
+    return pytz.timezone(timezone)
+
+
+@functools.lru_cache(maxsize=1024)
+def transitions(timezone):
+    """
+    Get the transition table of a time zone, as a tuple of lists:
+
+        (times, offsets)
+
+    where `times` are the UTC times (in seconds since epoch) from which on the
+    UTC offsets (in whole hours) apply. The first time is before any date.
+    """
+    tz = get_timezone(timezone)
+    if hasattr(tz, '_utc_transition_times'):
+        times = [int((t - EPOCH).total_seconds()) for t in tz._utc_transition_times]
+        offsets = [int(utcoffset.total_seconds() / (60 * 60))
+                   for (utcoffset, dst, name) in tz._transition_info]
+    else:
+        # time zones without transitions, like UTC
+        times = [int((datetime.datetime.min - EPOCH).total_seconds())]
+        offsets = [int(tz.utcoffset(EPOCH).total_seconds() / (60 * 60))]
+    return (times, offsets)
+
+
+@functools.lru_cache(maxsize=1024)
+def transition_arrays(timezone):
+    """
+    Get the transition table of a time zone as NumPy arrays.
+    """
+    (times, offsets) = transitions(timezone)
+    return (np.array(times, dtype=np.int64), np.array(offsets, dtype=np.int64))
+
+
+def utc_offset(timezone, seconds):
+    """
+    Get the UTC offset (in whole hours) of a time zone at a point in time (in
+    seconds since epoch).
+    """
+    (times, offsets) = transitions(timezone)
+    return offsets[bisect.bisect_right(times, seconds) - 1]
+
+
+def utc_offsets(tz_codes, timezones, seconds):
+    """
+    Get the UTC offsets (in whole hours) of an array of points in time (in
+    seconds since epoch), in time zones given as indexes into `timezones`.
+    """
+    tz_codes = np.asarray(tz_codes)
+    seconds = np.asarray(seconds, dtype=np.int64)
+    out = np.zeros(len(seconds), dtype=np.int64)
+    for code in np.unique(tz_codes).tolist():
+        (times, offsets) = transition_arrays(timezones[code])
+        mask = tz_codes == code
+        out[mask] = offsets[np.searchsorted(times, seconds[mask], side='right') - 1]
+    return out
+
+
+@functools.lru_cache(maxsize=None)
+def state_timezone(state):
+    """
+    Get the (first) time zone of a US state.
+    """
+    return us.states.lookup(state).time_zones[0]
+
+
+class SlotTimeCache:
+    """
+    Bounded cache of the conversions of raw slot start time stamps (e.g. to
+    their UTC time), which drops the least recently used ones when it's full.
+    `convert` converts a single time stamp, and `convert_many` (if given) a
+    list of them at once.
+    """
+
+    def __init__(self, convert, convert_many=None, maxsize=SLOT_TIME_CACHE_SIZE):
+        self.convert = convert
+        self.convert_many = convert_many or (lambda raws: [convert(raw) for raw in raws])
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.counted = (0, 0)
+
+    def add(self, raw, value):
+        self.entries[raw] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def get(self, raw):
+        """
+        Get the conversion of a time stamp.
+        """
+        try:
+            value = self.entries[raw]
+        except KeyError:
+            self.misses += 1
+            value = self.convert(raw)
+            self.add(raw, value)
+            return value
+        self.hits += 1
+        self.entries.move_to_end(raw)
+        return value
+
+    def get_many(self, raws):
+        """
+        Get the conversions of a list of time stamps, converting the ones that
+        aren't in the cache all at once.
+        """
+        values = dict.fromkeys(raws)
+        missing = []
+        for raw in values:
+            value = self.entries.get(raw)
+            if value is None:
+                missing.append(raw)
+            else:
+                values[raw] = value
+                self.entries.move_to_end(raw)
+        for (raw, value) in zip(missing, self.convert_many(missing)):
+            values[raw] = value
+            self.add(raw, value)
+        self.misses += len(missing)
+        self.hits += len(raws) - len(missing)
+        return list(map(values.__getitem__, raws))
+
+    def stats(self):
+        n = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries),
+                'hit_rate': self.hits / n if n else None}
+
+    def count_metrics(self, name='slot_time_cache'):
+        """
+        Add the hits and misses since the last call to the metrics counters.
+        """
+        lib_metrics.count(name + '_hits', self.hits - self.counted[0])
+        lib_metrics.count(name + '_misses', self.misses - self.counted[1])
+        self.counted = (self.hits, self.misses)
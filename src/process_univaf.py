@@ -13,44 +13,74 @@
 #
 # Usage:
 #
-#   python process_univaf.py [-h] [-s START_DATE] [-e END_DATE]
+#   python process_univaf.py [-h] [-s START_DATE] [-e END_DATE] [-w WORKERS]
+#                            [--memory_budget MB] [--incremental_aggregation]
+#                            [--output_format FORMAT [FORMAT ...]]
+#                            [--metrics FILE] [--profile FILE] [-i]
+#                            [--day_parts N] [--avs_engine {rows,arrays}]
+#                            [--slot_time_cache_size N]
+#
+# With more than one worker, the availability logs of upcoming dates are
+# decoded in parallel while the current date is being merged into the state.
+# With --day_parts, each date's log is also split into parts that are
+# decoded by several workers (a copy of the cached logs is compressed in
+# blocks for that once, see `univaf_data.blockify_log_file`).
+#
+# In incremental mode (-i), for daily runs, only the dates that are new or
+# whose inputs changed since the last run are processed (tracked in
+# univaf_manifest.json), the locations are only processed again when their
+# files changed, and new dates are merged into the aggregated slots instead
+# of aggregating all of them again.
 #
 # Produces:
 #
 #   locations.csv    - (id, uuid, name, provider, type, address, city,
 #                       county, state, zip, lat, lng, timezone)
 #   ids.csv          - (external_id, id)
+#   ids_index/       - sorted location ids with their internal ids and time
+#                      zones, as NumPy arrays (see `lib.write_id_index`)
 #   avs_{DATE}.csv   - (id, first_checked_time, last_checked_time,
 #                       offset, availability)
 #   slots_{DATE}.csv - (id, slot_time, first_checked_time, last_checked_time,
 #                       offset, availability)
 #
+# With --output_format parquet (or feather), the avs and slots files are
+# (also) written as typed, columnar files in avs/ and slots/, partitioned by
+# date, and so is the aggregated slots file (see `lib_output`).
+#
 # Authors:
 #
 #   Jan Overgoor - jsovergoor@usdigitalresponse.org
 #
 
 import argparse
-import csv
-import datetime
-import dateutil.parser
+import collections
+import concurrent.futures
+import hashlib
+import itertools
 import json
 import ndjson
+import numpy as np
 import os
-import pytz
+import pandas as pd
 import sys
+import time
 import traceback
 import urllib.request
-import us
 from glob import glob
 from shapely import wkb
 # internal
 import lib
+import lib_metrics
+import lib_output
+import lib_state
+import lib_tz
+import univaf_columnar
 import univaf_data
 
-# set and make paths
-path_raw = univaf_data.CACHE_PATH
-path_out = univaf_data.DATA_PATH / 'univaf_clean'
+# set and make paths (as strings with a trailing slash, like lib expects)
+path_raw = '%s/' % univaf_data.CACHE_PATH
+path_out = '%s/' % (univaf_data.DATA_PATH / 'univaf_clean')
 for path in [path_raw, path_out]:
     if not os.path.exists(path):
         os.mkdir(path)
@@ -59,262 +89,699 @@ for path in [path_raw, path_out]:
 locations = {}
 eid_to_id = {}
 avs = {}    # { id : [ts_first, ts_last, offset, available] }
-slots = {}  # { id : { ts_slot : [ts_first, ts_last, offset, available] }}
+slots = {}  # { id : lib_state.OpenSlots }
+id_index = None    # see lib.read_id_index
+output_formats = ('csv',)  # see lib_output
+avs_engine = 'rows'  # how availability records are merged, see `merge_updates`
+day_parts = 1      # number of parts to decode each date's file in, see `submit_date`
+
+# number of rows whose time stamps are normalized at once
+DECODE_CHUNK_SIZE = 100000
+# version of the output of this script, to be bumped when it changes, so the
+# incremental mode processes everything again (see `process_incremental`)
+PROCESSING_VERSION = 1
+# zip map with the time zones of zip codes (see `lib.read_zipmap`)
+ZIPMAP_FILE = 'vaccinespotter-zipdump.csv'
+
+
+def to_epoch(timestamps, unit):
+    """
+    Parse an array of ISO 8601 time stamps into whole units (seconds or minutes)
+    since epoch, in UTC.
+    """
+    nanoseconds = pd.to_datetime(pd.Series(timestamps, dtype=object), utc=True, cache=True)
+    return nanoseconds.values.astype('int64') // pd.Timedelta(1, unit=unit).value
+
+
+# slot start times in minutes since epoch (in UTC), see `normalize_times`
+slot_time_cache = lib_tz.SlotTimeCache(
+    None, convert_many=lambda starts: to_epoch(starts, 'min').tolist())
+
+
+def check_times_of(valid_ats):
+    """
+    Get the check times of rows in seconds since epoch, from their `valid_at`
+    time stamps, or as they are if they're already integers (see
+    `decode_batch`).
+    """
+    is_text = [type(valid_at) == str for valid_at in valid_ats]
+    if all(is_text):
+        return to_epoch(valid_ats, 's')
+    check_times = np.array([0 if text else valid_at
+                            for (valid_at, text) in zip(valid_ats, is_text)], dtype=np.int64)
+    if any(is_text):
+        i = np.flatnonzero(is_text)
+        check_times[i] = to_epoch([valid_ats[j] for j in i.tolist()], 's')
+    return check_times
+
+
+def normalize_times(rows, unknown):
+    """
+    Normalize a chunk of decoded rows all at once. Location ids are resolved to
+    internal ids, check times become seconds since epoch, slot times minutes
+    since epoch (both in UTC), and offsets are computed for each location's
+    time zone. Rows with unknown location ids are counted in `unknown`.
+    """
+    if len(rows) == 0:
+        return []
+    with lib_metrics.timer('resolve_ids'):
+        (iids, tz_codes, found) = lib.resolve_ids(id_index, [row[0] for row in rows])
+    if not found.all():
+        unknown.update(rows[i][0] for i in np.flatnonzero(~found).tolist())
+        rows = [row for (row, row_found) in zip(rows, found.tolist()) if row_found]
+        (iids, tz_codes) = (iids[found], tz_codes[found])
+        if len(rows) == 0:
+            return []
+    iids = iids.tolist()
+    (_, valid_ats, changed, availabilities, row_slots) = zip(*rows)
+    with lib_metrics.timer('timestamps'):
+        try:
+            check_times = check_times_of(valid_ats)
+        except Exception:
+            # parse the time stamps one by one to find the row that failed
+            for row in rows:
+                try:
+                    check_times_of([row[1]])
+                except Exception:
+                    report_problem(row)
+            raise
+    with lib_metrics.timer('timezones'):
+        offsets = lib_tz.utc_offsets(tz_codes, id_index[3], check_times).tolist()
+    check_times = check_times.tolist()
+    starts = [start for s in row_slots if s is not None for (start, _) in s]
+    with lib_metrics.timer('timestamps'):
+        slot_times = iter(slot_time_cache.get_many(starts))
+    lib_metrics.count('slots', len(starts))
+    updates = []
+    for (i, check_time) in enumerate(check_times):
+        tmp_slots = None
+        if row_slots[i] is not None:
+            # a slot is only open if it is available and in the future
+            tmp_slots = [(slot_time, available and slot_time * 60 > check_time)
+                         for ((_, available), slot_time) in
+                         zip(row_slots[i], itertools.islice(slot_times, len(row_slots[i])))]
+        updates.append((iids[i], check_time, offsets[i], changed[i],
+                        availabilities[i], tmp_slots))
+    return updates
+
+
+def decode_row(row):
+    """
+    Decode an availability log record into a row for `normalize_times`:
+
+        (location_id, valid_at, changed, availability, slots)
+
+    or None if it has no (new) `valid_at` field.
+    """
+    # only process rows that have a (new) valid_at field
+    if "valid_at" not in row:
+        return None
+    # if nothing new, only the time needs to be recorded
+    # (locations are looked up for a whole chunk of rows at once)
+    if "available" not in row or row['available'] is None:
+        return (row['location_id'], row['valid_at'], False, None, None)
+
+    availability = decode_availability(row['available'], 'available_count' in row,
+                                       row.get('available_count'), row.get('capacity'))
+
+    # do slots, if the data is there
+    row_slots = None
+    if 'slots' in row and row['slots'] is not None:
+        row_slots = [(slot['start'], slot['available'] == 'YES')
+                     for slot in row['slots']]
+
+    return (row['location_id'], row['valid_at'], True, availability, row_slots)
+
+
+def decode_availability(available, has_count, available_count, capacity):
+    """
+    Get the availability of a record from its `available` and (if it has one,
+    see `has_count`) `available_count` fields, or else its `capacity` list:
+    a count, '+' if it's only known to be available, or None if unknown.
+    """
+    if available in ['YES', 'yes']:
+        if has_count:
+            return available_count
+        if capacity is not None and capacity[0]['available'] not in ['YES','NO']:
+            availability = 0
+            for em in capacity:
+                if 'available_count' in em:
+                    availability += em['available_count']
+                elif 'available' in em:
+                    availability += em['available']
+                else:
+                    raise Exception('No availability counts found...')
+            return availability
+        return '+'
+    elif available in ['NO', 'no']:
+        return 0
+    elif available == 'UNKNOWN':
+        return None
+    raise Exception('No availability found...')
+
+
+def decode_batch(batch):
+    """
+    Decode a batch of records of a columnar log file (see
+    `univaf_columnar.read_columnar_batches`) into rows like `decode_row`,
+    except that check times are already seconds since epoch.
+    """
+    check_times = (batch['valid_at'] // 1000000).tolist()
+    offsets = batch['slots_offsets'].tolist()
+    columns = zip(batch['location_id'], batch['available'], batch['available_count'],
+                  batch['present'], batch['json'])
+    for (i, (location_id, available, available_count, present, raw)) in enumerate(columns):
+        try:
+            if raw is not None:
+                decoded = decode_row(json.loads(raw))
+            elif not present & univaf_columnar.PRESENT_VALID_AT:
+                decoded = None
+            elif not present & univaf_columnar.PRESENT_AVAILABLE or available is None:
+                decoded = (location_id, check_times[i], False, None, None)
+            else:
+                capacity = None
+                if present & univaf_columnar.HAS_CAPACITY_LIST:
+                    capacity = batch['capacity'][i]
+                availability = decode_availability(
+                    available, present & univaf_columnar.PRESENT_AVAILABLE_COUNT,
+                    available_count, capacity)
+                row_slots = None
+                if present & univaf_columnar.HAS_SLOTS_LIST:
+                    (first, last) = (offsets[i], offsets[i + 1])
+                    row_slots = [(start, slot_available == 'YES') for (start, slot_available) in
+                                 zip(batch['slots_start'][first:last],
+                                     batch['slots_available'][first:last])]
+                decoded = (location_id, check_times[i], True, availability, row_slots)
+        except Exception:
+            report_problem(univaf_columnar.batch_record(batch, i))
+        if decoded is not None:
+            yield decoded
+
+
+def report_problem(row):
+    """
+    Report the exception raised for a record, and stop.
+    """
+    print("[ERROR] ", sys.exc_info())
+    traceback.print_exc()
+    print("Problem data: ")
+    print(lib.pp(row))
+    exit()
+
+
+def decode_records(fn, part=None):
+    """
+    Decode the records of an availability log file (or a part of it) into rows
+    for `normalize_times`. The columnar version of the file is decoded a batch
+    at a time if there is one (see `decode_batch`).
+    """
+    path = univaf_columnar.availability_columnar(fn, part)
+    if path is not None:
+        for batch in univaf_columnar.read_columnar_batches(path, DECODE_CHUNK_SIZE):
+            yield from decode_batch(batch)
+        return
+    for row in univaf_columnar.read_availability_log(fn, part):
+        try:
+            decoded = decode_row(row)
+        except Exception:
+            report_problem(row)
+        if decoded is not None:
+            yield decoded
+
+
+def decode_file(fn, unknown, part=None):
+    """
+    Decode an availability log file (or a part of it, see
+    `univaf_data.split_log_file`) into a list of updates (see `decode_date`).
+    Rows with unknown location ids are counted in `unknown`.
+    """
+    updates = []
+    rows = []
+    for decoded in decode_records(fn, part):
+        rows.append(decoded)
+        if len(rows) >= DECODE_CHUNK_SIZE:
+            updates += normalize_times(rows, unknown)
+            rows = []
+    updates += normalize_times(rows, unknown)
+    return updates
+
+
+def date_files(ds):
+    return sorted(glob('%savailability_log-%s.ndjson.gz' % (path_raw, ds)))
+
+
+def warn_unknown(unknown):
+    if unknown:
+        print('[WARN]   skipped %d rows with %d ids not in the dictionary (most common: %s)' %
+              (sum(unknown.values()), len(unknown),
+               ', '.join('%s (%d)' % x for x in unknown.most_common(3))))
+
+
+def decode_date(ds):
+    """
+    Decode a single date's availability logs into a list of updates.
+
+    This is the expensive part of processing a date (JSON decoding, id lookups
+    and time stamp parsing), and it does not depend on the avs/slots state, so
+    it can run ahead of time in a separate process. Each update is a tuple:
+
+        (id, check_time, offset, changed, availability, slots)
+
+    where `changed` is False for rows without new availability data, and
+    `slots` is either None or a list of (slot_time, available) tuples. Times
+    are integers (see `normalize_times`).
+    """
+    global id_index
+    if id_index is None:
+        id_index = lib.read_id_index(path_out + 'univaf_ids_index/')
+    updates = []
+    unknown = collections.Counter()
+    for fn in date_files(ds):
+        print("[INFO]   reading " + fn)
+        updates += decode_file(fn, unknown)
+    warn_unknown(unknown)
+    lib_metrics.count('updates', len(updates))
+    lib_metrics.count('unknown_rows', sum(unknown.values()))
+    slot_time_cache.count_metrics()
+    lib_metrics.report(pipeline='univaf', date=ds, step='decode')
+    return updates
+
+
+def decode_part(ds, fn, part):
+    """
+    Decode a part of a date's availability log file, in a worker process (see
+    `do_dates`). Returns the updates, and the counts of unknown location ids.
+    """
+    global id_index
+    if id_index is None:
+        id_index = lib.read_id_index(path_out + 'univaf_ids_index/')
+    unknown = collections.Counter()
+    updates = decode_file(fn, unknown, part)
+    lib_metrics.count('updates', len(updates))
+    lib_metrics.count('unknown_rows', sum(unknown.values()))
+    slot_time_cache.count_metrics()
+    lib_metrics.report(pipeline='univaf', date=ds, step='decode', part=list(part or []))
+    return (updates, unknown)
+
+
+def submit_date(executor, ds):
+    """
+    Start decoding a date in a pool of processes, as a whole, or in parts of
+    its files with `day_parts` parts (see `univaf_data.split_log_file`).
+    """
+    if day_parts <= 1:
+        return executor.submit(decode_date, ds)
+    futures = []
+    for fn in date_files(ds):
+        parts = univaf_data.split_log_file(fn, day_parts)
+        print("[INFO]   reading %s in %d parts" % (fn, len(parts)))
+        futures += [executor.submit(decode_part, ds, fn, part) for part in parts]
+    return futures
+
+
+def date_updates(submitted):
+    """
+    Get the updates of a date that was submitted with `submit_date`, in the
+    order of the files and their parts.
+    """
+    if not isinstance(submitted, list):
+        return submitted.result()
+    updates = []
+    unknown = collections.Counter()
+    for future in submitted:
+        (part_updates, part_unknown) = future.result()
+        updates += part_updates
+        unknown.update(part_unknown)
+    warn_unknown(unknown)
+    return updates
+
+
+def read_state(ds):
+    """
+    Read the state at the start of a date, with times as integers.
+    """
+    fn = '%sstate_%s.npz' % (path_raw, ds)
+    # remove slots more than 1 day before today from the record
+    min_slot_time = lib.epoch_seconds(lib.add_days(ds, -1)) // 60
+    if os.path.exists(fn):
+        return lib_state.read_checkpoint(fn, min_slot_time)
+    # fall back to the JSON state files of earlier versions
+    avs = {iid: [lib.epoch_seconds(row[0]), lib.epoch_seconds(row[1])] + row[2:]
+           for (iid, row) in lib.read_previous_state(path_raw, ds, 'avs').items()}
+    slots = {}
+    for (iid, tmp_row) in lib.read_previous_state(path_raw, ds, 'slots').items():
+        slots[iid] = lib_state.OpenSlots(
+            (lib.epoch_seconds(slot_time) // 60, lib.epoch_seconds(row[0]),
+             lib.epoch_seconds(row[1]), row[2])
+            for (slot_time, row) in tmp_row.items())
+    return (avs, slots)
+
+
+def write_state(ds):
+    """
+    Write the current state for the start of a date.
+    """
+    lib_state.write_checkpoint('%sstate_%s.npz' % (path_raw, ds), avs, slots)
+
+
+def avs_row(row):
+    """
+    Format an availability record as a CSV row.
+    """
+    return [row[0], lib.format_seconds(row[1]), lib.format_seconds(row[2])] + row[3:]
 
 
-def do_date(ds):
+def slot_row(row):
+    """
+    Format a slot record as a CSV row.
+    """
+    (iid, slot_time, first, last, offset) = row
+    return [iid, lib.format_minutes(slot_time),
+            lib.format_seconds(first), lib.format_seconds(last), offset]
+
+
+def merge_slots(iid, check_time, offset, row_slots, write_slots):
+    """
+    Merge the slots of an update into the slots state, and write the slot
+    records that it closes. Returns the number of records written.
+    """
+    n_slots = 0
+    # create a new row if the location is new
+    if iid not in slots:
+        slots[iid] = lib_state.OpenSlots()
+    location_slots = slots[iid]
+    # most updates repeat the previous list of slots, or change little of it
+    closed = location_slots.update(row_slots, check_time, offset)
+    if closed is not None:
+        for record in closed:
+            write_slots((iid,) + record)
+        return len(closed)
+    for (slot_time, available) in row_slots:
+        i = location_slots.find(slot_time)
+        # if slot time didn't exist, create
+        if i < 0:
+            if available:
+                location_slots.open(slot_time, check_time, offset)
+        # if availability didn't change, just update time
+        elif available:
+            location_slots.last[i] = check_time
+        # else, write old row
+        else:
+            write_slots((iid,) + location_slots.close(i))
+            n_slots += 1
+    # assume that slots for which we saw no availaiblity in last update are not available anymore
+    for record in location_slots.close_unseen(check_time):
+        write_slots((iid,) + record)
+        n_slots += 1
+    return n_slots
+
+
+def merge_updates(updates, write_avs, write_slots):
+    """
+    Merge decoded updates (see `decode_date`) into the avs/slots state, in
+    order, and write the availability and slot records that they close.
+    Returns the number of (avs, slots) records written.
+    """
+    if avs_engine == 'arrays':
+        return merge_updates_arrays(updates, write_avs, write_slots)
+    n_avs = 0
+    n_slots = 0
+    for (iid, check_time, offset, changed, availability, row_slots) in updates:
+        # if nothing new, just update the last time
+        if not changed:
+            # skip new locations without change as we don't know their prior state
+            if iid not in avs:
+                continue
+            avs[iid][1] = check_time
+            # update each slot time
+            if iid in slots:
+                slots[iid].touch(check_time)
+            continue
+
+        # create a new row if the location is new
+        if iid not in avs:
+            avs[iid] = [check_time, check_time, offset, availability]
+        # if new row but availability didn't change, just update time
+        if availability == avs[iid][3]:
+            avs[iid][1] = check_time
+        # else, write old row and update new row
+        else:
+            write_avs([iid] + avs[iid])
+            n_avs += 1
+            avs[iid] = [check_time, check_time, offset, availability]
+
+        # do slots, if the data is there
+        if row_slots is not None:
+            n_slots += merge_slots(iid, check_time, offset, row_slots, write_slots)
+    return (n_avs, n_slots)
+
+
+def merge_updates_arrays(updates, write_avs, write_slots):
+    """
+    Same as `merge_updates`, but with the availability records of all updates
+    merged at once (see `lib_state.merge_availability`), so only the slots
+    are merged one update at a time.
+    """
+    if len(updates) == 0:
+        return (0, 0)
+    # locations that have an availability record, before each update
+    has_record = set(avs)
+    (iids, check_times, offsets, changed, availabilities, _) = zip(*updates)
+    with lib_metrics.timer('merge_avs'):
+        closed = lib_state.merge_availability(avs, iids, check_times, offsets,
+                                              availabilities, changed)
+    for record in closed:
+        write_avs(record)
+    n_slots = 0
+    for (iid, check_time, offset, changed, availability, row_slots) in updates:
+        if not changed:
+            if iid in has_record and iid in slots:
+                slots[iid].touch(check_time)
+            continue
+        has_record.add(iid)
+        if row_slots is not None:
+            n_slots += merge_slots(iid, check_time, offset, row_slots, write_slots)
+    return (len(closed), n_slots)
+
+
+def do_date(ds, updates=None):
     """
     Process a single date.
+
+    The updates for the date are decoded with `decode_date`, unless they
+    were already decoded elsewhere (see `do_dates`).
     """
     global avs, slots
     print("[INFO] doing %s" % ds)
 
     # open output files
-    fn_avs = "%savs_%s.csv" % (path_out, ds)
-    f_avs = open(fn_avs, 'w')
-    writer_avs = csv.writer(f_avs, delimiter=',', quoting=csv.QUOTE_MINIMAL)
-    n_avs = 0
-    fn_slots = "%sslots_%s.csv" % (path_out, ds)
-    f_slots = open(fn_slots, 'w')
-    writer_slots = csv.writer(f_slots, delimiter=',', quoting=csv.QUOTE_MINIMAL)
-    n_slots = 0
+    out_avs = lib_output.OutputFile(path_out, 'avs', ds, output_formats, format_row=avs_row)
+    write_avs = out_avs.write
+    out_slots = lib_output.OutputFile(path_out, 'slots', ds, output_formats,
+                                      format_row=slot_row, units={'slot_time': 'min'})
+    write_slots = out_slots.write
 
+    # decode first, so its metrics are reported separately
+    if updates is None:
+        updates = decode_date(ds)
     # read previous state, if exists
-    avs = lib.read_previous_state(path_raw, ds, 'avs')
-    slots = lib.read_previous_state(path_raw, ds, 'slots')
+    with lib_metrics.timer('read_state'):
+        (avs, slots) = read_state(ds)
 
-    # construct list of files to read
-    files = sorted(glob('%savailability_log-%s.ndjson.gz' % (path_raw, ds)))
-    for fn in files:
-        print("[INFO]   reading " + fn)
-        for row in univaf_data.read_json_lines(fn):
-            try:
-                # only process rows that have a (new) valid_at field
-                if "valid_at" not in row:
-                    continue
-                # look up the location
-                if 'uuid:%s' % row['location_id'] in eid_to_id:
-                    sid = 'uuid:%s' % row['location_id']
-                elif 'univaf_v1:%s' % row['location_id'] in eid_to_id:
-                    sid = 'univaf_v1:%s' % row['location_id']
-                elif 'univaf_v0:%s' % row['location_id'] in eid_to_id:
-                    sid = 'univaf_v0:%s' % row['location_id']
-                else:
-                    print('[WARN]     id %s not in the dictionary...' % row['location_id'])
-                    continue
-                iid = int(eid_to_id[sid])
-                loc = locations[iid]
-
-                # skip new locations without change as we don't know their prior state
-                if iid not in avs and ("available" not in row or row['available'] is None):
-                    continue
-
-                # parse checked_time and convert to UTC if not already
-                t = row['valid_at']
-                if t[-5:] == '00:00' or t[-1] == 'Z':
-                    check_time_utc = datetime.datetime.strptime(t[:19], "%Y-%m-%dT%H:%M:%S")
-                else:
-                    check_time_utc = dateutil.parser.parse(t).astimezone(pytz.timezone('UTC'))
-                check_time_local = check_time_utc.astimezone(pytz.timezone(loc['timezone']))
-                offset = int(check_time_local.utcoffset().total_seconds() / (60 * 60))
-                check_time = check_time_utc.strftime("%Y-%m-%d %H:%M:%S")  # in UTC
-
-                # if nothing new, just update the last time
-                if "available" not in row or row['available'] is None:
-                    avs[iid][1] = check_time
-                    # update each slot time
-                    if iid in slots:
-                        for ts in slots[iid].keys():
-                            slots[iid][ts][1] = check_time
-                    continue
-
-                # compute regular availability count
-                availability = None
-                if row['available'] in ['YES', 'yes']:
-                    if 'available_count' in row:
-                        availability = row['available_count']
-                    elif ('capacity' in row and row['capacity'] is not None and
-                          row['capacity'][0]['available'] not in ['YES','NO']):
-                        availability = 0
-                        for em in row['capacity']:
-                            if 'available_count' in em:
-                                availability += em['available_count']
-                            elif 'available' in em:
-                                availability += em['available']
-                            else:
-                                raise Exception('No availability counts found...')
-                    else:
-                        availability = '+'
-                elif row['available'] in ['NO', 'no']:
-                    availability = 0
-                elif row['available'] == 'UNKNOWN':
-                    availability = None
-                else:
-                    availability = None
-                    raise Exception('No availability found...')
-
-                # create a new row if the location is new
-                if iid not in avs:
-                    avs[iid] = [check_time, check_time, offset, availability]
-                # if new row but availability didn't change, just update time
-                if availability == avs[iid][3]:
-                    avs[iid][1] = check_time
-                # else, write old row and update new row
-                else:
-                    writer_avs.writerow([iid] + avs[iid])
-                    n_avs += 1
-                    avs[iid] = [check_time, check_time, offset, availability]
-
-                # do slots, if the data is there
-                if 'slots' in row and row['slots'] is not None:
-                    # create a new row if the location is new
-                    if iid not in slots:
-                        slots[iid] = {}
-                    for slot in row['slots']:
-                        # compute local offset and UTC time for slot time
-                        slot_time_local = datetime.datetime.fromisoformat(slot['start'])
-                        slot_time_offset = int(slot_time_local.utcoffset().total_seconds() / (60 * 60))
-                        slot_time_utc = slot_time_local.astimezone(pytz.timezone('UTC'))
-                        slot_time = slot_time_utc.strftime("%Y-%m-%d %H:%M")  # in UTC
-                        # if slot time didn't exist, create
-                        if slot_time not in slots[iid]:
-                            if slot['available'] == 'YES' and slot_time > check_time:
-                                slots[iid][slot_time] = [check_time, check_time, offset]
-                            else:
-                                continue
-                        # if availability didn't change, just update time
-                        if slot['available'] == 'YES' and slot_time > check_time:
-                            slots[iid][slot_time][1] = check_time
-                        # else, write old row and update new row
-                        else:
-                            writer_slots.writerow([iid, slot_time] + slots[iid][slot_time])
-                            n_slots += 1
-                            del slots[iid][slot_time]
-                    # assume that slots for which we saw no availaiblity in last update are not available anymore
-                    for slot_time in list(slots[iid].keys()):
-                        if slots[iid][slot_time][1] != check_time:
-                            writer_slots.writerow([iid, slot_time] + slots[iid][slot_time])
-                            n_slots += 1
-                            del slots[iid][slot_time]
-
-            except Exception as e:
-                print("[ERROR] ", sys.exc_info())
-                traceback.print_exc()
-                print("Problem data: ")
-                print(lib.pp(row))
-                exit()
+    t_merge = time.perf_counter()
+    (n_avs, n_slots) = merge_updates(updates, write_avs, write_slots)
 
     # write unclosed records
     for iid, row in avs.items():
-        writer_avs.writerow([iid] + row)
+        write_avs([iid] + row)
         n_avs += 1
-    for iid, tmp_row in slots.items():
-        for slot_time, row in tmp_row.items():
-            writer_slots.writerow([iid, slot_time] + row)
+    for iid, location_slots in slots.items():
+        for record in location_slots:
+            write_slots((iid,) + record)
             n_slots += 1
 
     # wrap up
-    f_avs.close()
-    f_slots.close()
-    print("[INFO]   wrote %d availability records to %s" % (n_avs, fn_avs))
-    print("[INFO]   wrote %d slot records to %s" % (n_slots, fn_slots))
+    out_avs.close()
+    out_slots.close()
+    lib_metrics.add_time('merge', t_merge)
+    print("[INFO]   wrote %d availability records to %s" % (n_avs, out_avs.fn))
+    print("[INFO]   wrote %d slot records to %s" % (n_slots, out_slots.fn))
     # write current state for the next day
-    next_day = lib.add_days(ds, 1)
-    with open(path_raw + 'state_%s_avs.json' % next_day, 'w') as f:
-        json.dump(avs, f)
-    with open(path_raw + 'state_%s_slots.json' % next_day, 'w') as f:
-        json.dump(slots, f)
+    with lib_metrics.timer('write_state'):
+        write_state(lib.add_days(ds, 1))
+    lib_metrics.count('updates', len(updates))
+    lib_metrics.count('avs_records', n_avs)
+    lib_metrics.count('slot_records', n_slots)
+    lib_metrics.report(pipeline='univaf', date=ds, step='merge')
+
+
+def do_dates(dates, workers=1):
+    """
+    Process a sequence of dates.
+
+    With more than one worker, the dates are decoded ahead of time in a pool
+    of processes, while the (cheap) merging of the updates into the avs/slots
+    state still happens one date at a time, in order. With `day_parts`, the
+    files of a date are decoded by several workers too.
+    """
+    if workers <= 1:
+        for date in dates:
+            do_date(date)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # keep a bounded number of decoded dates in flight, to limit memory
+        pending = collections.deque()
+        queue = iter(dates)
+        for date in itertools.islice(queue, 2 * workers):
+            pending.append((date, submit_date(executor, date)))
+        while pending:
+            (date, submitted) = pending.popleft()
+            updates = date_updates(submitted)
+            for next_date in itertools.islice(queue, 1):
+                pending.append((next_date, submit_date(executor, next_date)))
+            do_date(date, updates)
+
+
+def location_record(row, zipmap, position=None):
+    """
+    Extract the location record of a provider_locations row. `position` is
+    the already decoded (lng, lat) of a WKB position, if any.
+    """
+    # set fields to None by default
+    [uuid, name, provider, loctype, address, city, county,
+     state, zip, lat, lng, tz] = [None] * 12
+    # extract fields
+    uuid = row['id']
+    # TODO: if NOT there, then should look up?
+    if 'name' in row and row['name'] is not None:
+        name = row['name'].title()
+    if 'provider' in row and row['provider'] is not None:
+        provider = row['provider'].lower()
+        if provider == 'rite_aid':
+            provider = 'riteaid'
+    if 'location_type' in row and row['location_type'] is not None:
+        loctype = row['location_type'].lower()
+    if 'city' in row and row['city'] is not None:
+        city = row['city'].title()
+    if 'county' in row and row['county'] is not None:
+        county = row['county'].title()
+    if 'state' in row and row['state'] is not None:
+        state = row['state'].upper()
+    if 'postal_code' in row and row['postal_code'] is not None:
+        # NOTE - this throws away information after first 5 digits
+        zip = "%05d" % int(row['postal_code'][:5])
+    # take county from VS zipmap
+    if zip is not None and county is None and zip in zipmap:
+        county = zipmap[zip][2]
+    # process addres
+    if 'address_lines' in row and row['address_lines'] is not None:
+        # NOTE - length is never larger than 1
+        address = ','.join(row['address_lines'])
+        # fix end on ,
+        if address[-1] == ',':
+            address = address[:-1]
+    # fix address issue for some NJ listings
+    if ', NJ' in address:
+        address = address.split(', ')[0]
+        if zip is not None:
+            city = zipmap[zip][1]
+        # still has city in the address..
+    # extract local timezone
+    if 'time_zone' in row and row['time_zone'] is not None:
+        timezone = row['time_zone']
+    elif zip is not None:
+        zip = "%05d" % int(row['postal_code'][:5])
+        timezone = zipmap[zip][0]
+    elif state is not None:
+        timezone = lib_tz.state_timezone(row['state'])
+    # extract position
+    if ('position' in row and row['position'] is not None):
+        # original format was dictionary
+        if type(row['position']) == dict:
+            if 'latitude' in row['position']:
+                lat = row['position']['latitude']
+            if 'longitude' in row['position']:
+                lng = row['position']['longitude']
+        # else, assume WKB hex
+        elif position is not None:
+            (lng, lat) = position
+        else:
+            (lng, lat) = wkb.loads(bytes.fromhex(row['position'])).coords[0]
+    # insert row
+    return {
+        'uuid': uuid,
+        'name': name,
+        'provider': provider,
+        'type': loctype,
+        'address': address,
+        'city': city,
+        'county': county,
+        'state': state,
+        'zip': zip,
+        'lat': lat,
+        'lng': lng,
+        'timezone': timezone
+    }
+
+
+def read_location_cache(fn, zipmap_key):
+    """
+    Read the location records of the previous run, by hash of their rows. The
+    records are only used if they were made with the same zip map (see
+    `lib.zipmap_key`), as their time zone, city and county come from it.
+    """
+    if os.path.exists(fn):
+        cache = pd.read_pickle(fn)
+        if cache['version'] == PROCESSING_VERSION and cache.get('zipmap') == zipmap_key:
+            return cache['records']
+    return {}
 
 
 def process_locations(path_out):
     """
     Process the latest provider_locations and external_ids log files.
+
+    Location records are cached by a hash of their raw rows, so only the rows
+    that changed since the previous run are decoded and processed again.
     """
     # read zip map
     zipmap = lib.read_zipmap()
+    zipmap_key = lib.zipmap_key()
     # read 'new' locations
     path_loc = glob(path_raw + 'provider_locations-*.ndjson.gz')[-1]
-    for row in univaf_data.read_json_lines(path_loc):
-        # grab internal numeric id, or make one
-        sid = 'uuid:%s' % row['id']
-        if sid in eid_to_id:
-            iid = eid_to_id[sid]
+    fn_cache = path_out + 'univaf_locations_cache.pkl'
+    cache = read_location_cache(fn_cache, zipmap_key)
+    loads = univaf_data.json_decoder()
+    entries = []  # [ (digest, cached (iid, record), or the decoded row) ]
+    for line in univaf_data.read_lines(path_loc):
+        if line.isspace():
+            continue
+        digest = hashlib.sha1(line).digest()
+        entries.append((digest, cache[digest] if digest in cache else loads(line)))
+    changed = [row for (digest, row) in entries if type(row) == dict]
+    print("[INFO] processing %d of %d locations that changed" % (len(changed), len(entries)))
+    # decode WKB positions all at once
+    wkb_rows = [row for row in changed
+                if row.get('position') is not None and type(row['position']) != dict]
+    (lngs, lats) = lib.wkb_points([row['position'] for row in wkb_rows])
+    positions = {id(row): (lng, lat) for (row, lng, lat) in
+                 zip(wkb_rows, lngs.tolist(), lats.tolist()) if lng == lng and lat == lat}
+    records = {}
+    for (digest, row) in entries:
+        if type(row) == dict:
+            # grab internal numeric id, or make one
+            sid = 'uuid:%s' % row['id']
+            iid = eid_to_id[sid] if sid in eid_to_id else lib.hash(row['id'])
+            record = location_record(row, zipmap, positions.get(id(row)))
         else:
-            iid = lib.hash(row['id'])
-            eid_to_id[sid] = iid
-        # set fields to None by default
-        [uuid, name, provider, loctype, address, city, county,
-         state, zip, lat, lng, tz] = [None] * 12
-        # extract fields
-        uuid = row['id']
-        # TODO: if NOT there, then should look up?
-        if 'name' in row and row['name'] is not None:
-            name = row['name'].title()
-        if 'provider' in row and row['provider'] is not None:
-            provider = row['provider'].lower()
-            if provider == 'rite_aid':
-                provider = 'riteaid'
-        if 'location_type' in row and row['location_type'] is not None:
-            loctype = row['location_type'].lower()
-        if 'city' in row and row['city'] is not None:
-            city = row['city'].title()
-        if 'county' in row and row['county'] is not None:
-            county = row['county'].title()
-        if 'state' in row and row['state'] is not None:
-            state = row['state'].upper()
-        if 'postal_code' in row and row['postal_code'] is not None:
-            # NOTE - this throws away information after first 5 digits
-            zip = "%05d" % int(row['postal_code'][:5])
-        # take county from VS zipmap
-        if zip is not None and county is None and zip in zipmap:
-            county = zipmap[zip][2]
-        # process addres
-        if 'address_lines' in row and row['address_lines'] is not None:
-            # NOTE - length is never larger than 1
-            address = ','.join(row['address_lines'])
-            # fix end on ,
-            if address[-1] == ',':
-                address = address[:-1]
-        # fix address issue for some NJ listings
-        if ', NJ' in address:
-            address = address.split(', ')[0]
-            if zip is not None:
-                city = zipmap[zip][1]
-            # still has city in the address..
-        # extract local timezone
-        if 'time_zone' in row and row['time_zone'] is not None:
-            timezone = row['time_zone']
-        elif zip is not None:
-            zip = "%05d" % int(row['postal_code'][:5])
-            timezone = zipmap[zip][0]
-        elif state is not None:
-            timezone = us.states.lookup(row['state']).time_zones[0]
-        # extract position
-        if ('position' in row and row['position'] is not None):
-            # original format was dictionary
-            if type(row['position']) == dict:
-                if 'latitude' in row['position']:
-                    lat = row['position']['latitude']
-                if 'longitude' in row['position']:
-                    lng = row['position']['longitude']
-            # else, assume WKB hex
-            else:
-                (lng, lat) = wkb.loads(bytes.fromhex(row['position'])).coords[0]
-        # insert row
-        locations[iid] = {
-            'uuid': uuid,
-            'name': name,
-            'provider': provider,
-            'type': loctype,
-            'address': address,
-            'city': city,
-            'county': county,
-            'state': state,
-            'zip': zip,
-            'lat': lat,
-            'lng': lng,
-            'timezone': timezone
-        }
+            (iid, record) = row
+            sid = 'uuid:%s' % record['uuid']
+        eid_to_id[sid] = iid
+        locations[iid] = record
+        records[digest] = (iid, record)
+    if changed or records.keys() != cache.keys():
+        pd.to_pickle({'version': PROCESSING_VERSION, 'zipmap': zipmap_key, 'records': records},
+                     fn_cache)
 
     # read 'new' external_id to uuid mapping
     eid_to_uuid = {}
@@ -332,6 +799,7 @@ def process_locations(path_out):
     # write updated location files
     lib.write_locations(locations, path_out + 'univaf_locations.csv')
     lib.write_external_ids(eid_to_id, path_out + 'univaf_ids.csv')
+    lib.write_id_index(eid_to_id, locations, path_out + 'univaf_ids_index/')
     return (locations, eid_to_id)
 
 
@@ -339,26 +807,184 @@ def download_files(dates):
     """
     Download the files, if they don't already exist.
     """
+    # only the latest locations and external ids are used
     univaf_data.download_log_file('provider_locations', dates[-1])
     univaf_data.download_log_file('external_ids', dates[-1])
-    for date in dates:
-        univaf_data.download_log_file('external_ids', date)
+    univaf_data.download_log_files('availability_log', dates)
+
+
+def read_manifest(fn):
+    """
+    Read the manifest of a previous (incremental) run, or create an empty one
+    if there is none, or it was written by a different version of the code.
+    """
+    if os.path.exists(fn):
+        with open(fn, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == PROCESSING_VERSION:
+            manifest.setdefault('hashes', {})
+            return manifest
+        print("[INFO] manifest is for a different version, so processing everything")
+    return {'version': PROCESSING_VERSION, 'locations': None, 'dates': {}, 'slots': [],
+            'hashes': {}}
+
+
+def write_manifest(fn, manifest):
+    """
+    Write the run manifest, replacing the previous one atomically.
+    """
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(fn + '.tmp', fn)
+
+
+def file_hashes(pattern, known=None, latest=False):
+    """
+    Hash the files that match a pattern, or only the last one by name if
+    `latest`. Hashes in `known` (path -> [size, mtime_ns, hash], as kept in
+    the manifest) are reused for files that didn't change, and the others are
+    added to it.
+    """
+    fns = sorted(glob(pattern))
+    if latest:
+        fns = fns[-1:]
+    hashes = []
+    for fn in fns:
+        stat = os.stat(fn)
+        entry = known.get(fn) if known is not None else None
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            entry = [stat.st_size, stat.st_mtime_ns, univaf_columnar.source_hash(fn)]
+            if known is not None:
+                known[fn] = entry
+        hashes.append(entry[2])
+    return hashes
+
+
+def location_inputs(known=None):
+    """
+    Hashes of the files `process_locations` reads, including the zip map that
+    the time zones of locations come from.
+    """
+    inputs = {kind: file_hashes(path_raw + '%s-*.ndjson.gz' % kind, known, latest=True)
+              for kind in ['provider_locations', 'external_ids']}
+    inputs['zipmap'] = file_hashes(ZIPMAP_FILE, known)
+    return inputs
+
+
+def date_inputs(ds, known=None):
+    """
+    Hashes of the inputs of processing a date: its availability logs, the
+    state at the start of the day, and the zip map (which the local times of
+    its records depend on, through the time zones of locations).
+    """
+    return {'logs': file_hashes('%savailability_log-%s.ndjson.gz' % (path_raw, ds), known),
+            'state': file_hashes('%sstate_%s*' % (path_raw, ds), known),
+            'zipmap': file_hashes(ZIPMAP_FILE, known)}
+
+
+def is_processed(manifest, ds):
+    """
+    Check whether a date was processed before with the same inputs.
+    """
+    return (manifest['dates'].get(ds) == date_inputs(ds, manifest['hashes']) and
+            lib_output.output_exists(path_out, 'avs', ds, output_formats) and
+            lib_output.output_exists(path_out, 'slots', ds, output_formats) and
+            os.path.exists('%sstate_%s.npz' % (path_raw, lib.add_days(ds, 1))))
+
+
+def process_incremental(dates, fn_slots, workers=1):
+    """
+    Process only what changed since the previous run, according to the run
+    manifest: the locations if their files changed, and the dates from the
+    first one that is new or has different inputs. The slot records of new
+    dates are then merged into the aggregated slots file, which only has to be
+    aggregated again when dates before the last merged one changed.
+    """
+    fn_manifest = path_out + 'univaf_manifest.json'
+    manifest = read_manifest(fn_manifest)
+
+    inputs = location_inputs(manifest['hashes'])
+    if manifest['locations'] == inputs and os.path.exists(path_out + 'univaf_ids_index/'):
+        print("[INFO] locations didn't change, so skipping them")
+    else:
+        process_locations(path_out)
+        manifest['locations'] = inputs
+        write_manifest(fn_manifest, manifest)
+
+    # once a date is processed again, the state of later dates changes too
+    n_done = 0
+    while n_done < len(dates) and is_processed(manifest, dates[n_done]):
+        n_done += 1
+    todo = dates[n_done:]
+    if n_done > 0:
+        print("[INFO] skipping %d dates that were already processed" % n_done)
+    do_dates(todo, workers=workers)
+    for ds in todo:
+        manifest['dates'][ds] = date_inputs(ds, manifest['hashes'])
+    write_manifest(fn_manifest, manifest)
+
+    # merge new dates into the aggregated slots
+    merged = set(manifest['slots'])
+    new = sorted((set(dates) - merged) | set(todo))
+    if len(new) == 0:
+        return
+    if (len(merged) > 0 and min(new) > max(merged) and
+            lib.merge_slots([fn for fn in lib.slot_files(path_out)
+                             if lib.output_file_date(fn) in new], fn_slots, new[-1])):
+        manifest['slots'] = sorted(merged | set(new))
+    else:
+        merged = [lib.output_file_date(fn) for fn in lib.slot_files(path_out)]
+        lib.aggregate_slots_with_tail(path_out, fn_slots, max(merged))
+        manifest['slots'] = sorted(merged)
+    write_manifest(fn_manifest, manifest)
 
 
 if __name__ == "__main__":
     import lib_cli
-    args = lib_cli.create_agument_parser().parse_args()
+    parser = lib_cli.create_agument_parser()
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="number of processes to decode dates and aggregate slots with")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="only process what changed since the last run, and merge new "
+                             "dates into the aggregated slots")
+    parser.add_argument('--day_parts', type=int, default=1, metavar='N',
+                        help="with more than one worker, decode each date's file in N parts "
+                             "(writes a copy of the cached files in blocks the first time, see "
+                             "`univaf_data.blockify_log_file`)")
+    lib_cli.add_avs_engine_argument(parser)
+    lib_cli.add_slot_time_cache_argument(parser)
+    lib_cli.add_aggregation_arguments(parser)
+    lib_cli.add_output_arguments(parser)
+    lib_cli.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    lib_cli.check_aggregation_arguments(parser, args)
     dates = lib_cli.get_dates_in_range(args.start_date, args.end_date)
+    output_formats = lib_output.check_formats(args.output_format)
+    avs_engine = args.avs_engine
+    day_parts = args.day_parts
+    if args.slot_time_cache_size:
+        slot_time_cache.maxsize = args.slot_time_cache_size
+    if args.metrics:
+        lib_metrics.enable(args.metrics)
 
     print("[INFO] doing these dates: [%s]" % ', '.join(dates))
-    # TODO: this should return the downloaded paths and other functions should
-    # use them rather than expecting them to be in a certain place.
-    download_files(dates)
-    # process latest locations file
-    (locations, eid_to_id) = process_locations(path_out)
-    # iterate over days
-    for date in dates:
-        do_date(date)
-    # aggregate slot data over multiple days
-    fn_slots = lib.path_root + '/univaf_clean/univaf_slots.csv'
-    lib.aggregate_slots(path_out, fn_slots)
+    with lib_metrics.profile(args.profile):
+        # TODO: this should return the downloaded paths and other functions should
+        # use them rather than expecting them to be in a certain place.
+        download_files(dates)
+        if day_parts > 1 and args.workers > 1:
+            for ds in dates:
+                for fn in date_files(ds):
+                    univaf_data.blockify_log_file(fn)
+        fn_slots = lib.path_root + '/univaf_clean/univaf_slots.csv'
+        if args.incremental:
+            process_incremental(dates, fn_slots, workers=args.workers)
+        else:
+            # process latest locations file
+            (locations, eid_to_id) = process_locations(path_out)
+            # iterate over days
+            do_dates(dates, workers=args.workers)
+            # aggregate slot data over multiple days
+            lib.aggregate_slots(path_out, fn_slots, workers=args.workers,
+                                **lib_cli.aggregation_options(args))
+        lib_output.write_aggregated_slots(fn_slots, output_formats)
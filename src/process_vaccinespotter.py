@@ -7,7 +7,15 @@
 # Usage:
 #
 #   python process_vaccinespotter.py [-h] [-s START_DATE] [-e END_DATE] [-c]
+#                                    [--memory_budget MB] [--incremental_aggregation]
+#                                    [--output_format FORMAT [FORMAT ...]]
+#                                    [--metrics FILE] [--profile FILE]
+#                                    [--avs_engine {rows,arrays}]
+#                                    [--slot_time_cache_size N]
 #
+# With --output_format parquet (or feather), the avs and slots files are
+# (also) written as typed, columnar files in avs/ and slots/, partitioned by
+# date, and so is the aggregated slots file (see `lib_output`).
 #
 #
 # Authors:
@@ -16,19 +24,24 @@
 #
 
 import argparse
-import csv
 import datetime
 import dateutil.parser
 import gzip
 import json
+import multiprocessing
 import os
 import pytz
+import queue
 import sys
+import time
 import traceback
 import urllib.request
-import us
 # internal
 import lib
+import lib_metrics
+import lib_output
+import lib_state
+import lib_tz
 
 
 # set and make paths
@@ -44,11 +57,224 @@ locations = {}
 avs = {}    # { id : [ts_first, ts_last, offset, available] }
 slots = {}  # { id : { ts_slot : [ts_first, ts_last, offset, available] }}
 main_url = "https://www.vaccinespotter.org/database/history/"
+# (name, brand, address, city, state, postal_code, latitude, longitude,
+# time_zone) of each location, as last seen, see `location_key`
+location_fields = {}
+output_formats = ('csv',)  # see lib_output
+avs_engine = 'rows'  # how availability records are merged, see `do_date`
+
+# number of decoded records that are sent from the decoding process at once,
+# and the maximum number of batches waiting to be processed
+DECODE_BATCH_SIZE = 1000
+DECODE_QUEUE_SIZE = 16
+# block size for reading the (compressed) input files
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def location_key(loc):
+    """
+    Get the fields of a location row that go into its location record.
+    """
+    position = loc['location']
+    return (loc['name'], loc['brand'], loc['address'], loc['city'], loc['state'],
+            loc['postal_code'],
+            None if position is None else position['latitude'],
+            None if position is None else position['longitude'],
+            loc.get('time_zone'))
+
+
+def parse_time(ts):
+    """
+    Parse a time stamp, quickly if it is in ISO format.
+    """
+    try:
+        return datetime.datetime.fromisoformat(ts)
+    except ValueError:
+        return dateutil.parser.parse(ts)
+
+
+def slot_time_utc(slot_time_raw):
+    """
+    Convert a slot time to UTC. Cached (see `slot_time_cache`), as the same
+    slots are seen many times.
+    """
+    slot_time_local = datetime.datetime.fromisoformat(slot_time_raw)
+    slot_time_utc = slot_time_local.astimezone(pytz.timezone('UTC'))
+    return slot_time_utc.strftime("%Y-%m-%d %H:%M")  # in UTC
+
+
+slot_time_cache = lib_tz.SlotTimeCache(slot_time_utc)
+
+
+def availability_row(row, transaction_timestamp):
+    """
+    Get the availability data of a location row, as a tuple:
+
+        (check_time, seconds, appointments_available, n_appointments, slot_times)
+
+    where `check_time` is in UTC, `seconds` is the check time in seconds since
+    epoch, `slot_times` are in UTC, and `n_appointments` and `slot_times` are
+    None if the appointments are.
+    """
+    # they only started recording last_fetched later...
+    if 'appointments_last_fetched' in row and row['appointments_last_fetched'] is not None:
+        ts = row['appointments_last_fetched']
+    elif 'updated_at' in row and row['updated_at'] is not None:
+        ts = row['updated_at']
+    else:
+        ts = transaction_timestamp
+    time_raw = parse_time(ts)
+    # convert to UTC, so it's all the same
+    check_time_utc = time_raw.astimezone(pytz.timezone('UTC'))
+    check_time = check_time_utc.strftime("%Y-%m-%d %H:%M:%S")  # in UTC
+    seconds = int(check_time_utc.timestamp())
+    appointments = row.get('appointments')
+    if appointments is None:
+        return (check_time, seconds, row['appointments_available'], None, None)
+    slot_times = [slot_time_cache.get(slot['time']) for slot in appointments
+                  if 'time' in slot and slot['time'] is not None]
+    return (check_time, seconds, row['appointments_available'],
+            len(appointments), slot_times)
+
+
+def decode_file(fn, batches):
+    """
+    Decompress and decode an input file, and put its records on `batches` in
+    batches, as compact tuples:
+
+        (iid, location, rows)
+
+    where `location` is the key of the location row (see `location_key`), or
+    None if it is the same as in the previous record of the location, and
+    `rows` is None, or the availability data (see `availability_row`) of the
+    previous and new location row for updates of the appointments. The end of
+    the file is marked by None, and errors by a string.
+
+    This runs in a separate process, so decoding overlaps with processing.
+    """
+    loads = lib_metrics.timed('json_decode', json.loads)
+    get_availability = lib_metrics.timed('timestamps', availability_row)
+    last_keys = {}
+    batch = []
+    with gzip.open(fn, 'rb') as f:
+        read = lib_metrics.timed('gzip', f.read)
+        rest = b''
+        while True:
+            block = read(READ_BLOCK_SIZE)
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            if not block and rest:
+                lines.append(rest)
+            for line in lines:
+                if len(line) == 0:
+                    continue
+                try:
+                    data = loads(line.replace(b"\\\\", b"\\"))
+                except json.decoder.JSONDecodeError:
+                    batches.put('[ERROR] json.decoder.JSONDecodeError:\n%s' % line)
+                    return
+                try:
+                    if data['action'] == 'UPDATE':
+                        loc = data['data']
+                    elif data['action'] == 'INSERT':
+                        loc = data['changed_data']
+                    elif data['action'] == 'DELETE':
+                        loc = data['previous_data']
+                    else:
+                        print('[WARN] different action than {UPDATE,INSERT}')
+                        print(lib.pp(data))
+                        continue
+                    iid = loc['id']
+                    key = location_key(loc)
+                    if last_keys.get(iid) == key:
+                        key = None
+                    else:
+                        last_keys[iid] = key
+                    rows = None
+                    # only updates of the appointments have (new) availability data
+                    if (data['action'] == 'UPDATE' and data['changed_data'] is not None and
+                        ('appointments' in data['changed_data'] or
+                         'appointments_available' in data['changed_data'])):
+                        rows = [get_availability(row, data['transaction_timestamp'])
+                                for row in [data['previous_data'], data['data']]]
+                except Exception:
+                    batches.put('Unexpected error: %s\n%s\nProblem data:\n%s' %
+                              (sys.exc_info(), traceback.format_exc(), lib.pp(data)))
+                    return
+                batch.append((iid, key, rows))
+                if len(batch) >= DECODE_BATCH_SIZE:
+                    batches.put(batch)
+                    batch = []
+            if not block:
+                break
+    batches.put(batch)
+    batches.put(None)
+    slot_time_cache.count_metrics()
+    lib_metrics.report(pipeline='vaccinespotter', date=os.path.basename(fn)[:10], step='decode')
+
+
+def extract_location(iid, key, zipmap):
+    """
+    Extract the location record of a location row, given its key.
+
+    NOTE: assumes that location meta-data stays stable,
+          and takes the last known non-null values as true
+    """
+    (loc_name, brand, loc_address, loc_city, loc_state, postal_code,
+     latitude, longitude, time_zone) = key
+    # set fields to None by default
+    [uuid, name, provider, type, address, city, county,
+     state, zip, lat, lng, timezone] = [None] * 12
+    # extract fields
+    if loc_name is not None:
+        name = loc_name
+    if brand is not None:
+        provider = brand.lower()
+    if loc_address is not None:
+        address = loc_address
+    if loc_city is not None:
+        city = loc_city.title()
+    if loc_state is not None:
+        state = loc_state.upper()
+    if postal_code is not None:
+        zip = "%05d" % int(postal_code[:5])
+    if latitude is not None or longitude is not None:
+        lat = latitude
+        lng = longitude
+    # extract local timezone
+    if time_zone is not None and time_zone != '':
+        timezone = time_zone
+    elif zip is not None:
+        timezone = zipmap[zip][0]
+    elif state is not None:
+        timezone = lib_tz.state_timezone(loc_state)
+    # insert row
+    locations[iid] = {
+        'uuid': uuid,
+        'name': name,
+        'provider': provider,
+        'type': type,
+        'address': address,
+        'city': city,
+        'county': county,
+        'state': state,
+        'zip': zip,
+        'lat': lat,
+        'lng': lng,
+        'timezone': timezone
+    }
 
 
 def do_date(ds):
     """
     Process a single date
+
+    The input file is decompressed and decoded in a separate process (see
+    `decode_file`), while its records are processed here. Locations are only
+    extracted again when their fields changed, and are only written at the
+    end of the run. With the 'arrays' `avs_engine`, the availability records
+    are merged all at once at the end of the day (see
+    `lib_state.merge_availability`).
     """
     print("[INFO] doing %s" % ds, end='')
     fn = "%s.jsonl.gz" % (ds)
@@ -60,163 +286,96 @@ def do_date(ds):
     print(" (size: %d MB)" % size)
 
     # open output files
-    fn_avs = "%savs_%s.csv" % (path_out, ds)
-    f_avs = open(fn_avs, 'w')
-    writer_avs = csv.writer(f_avs, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+    out_avs = lib_output.OutputFile(path_out, 'avs', ds, output_formats)
+    write_avs = out_avs.write
     n_avs = 0
-    fn_slots = "%sslots_%s.csv" % (path_out, ds)
-    f_slots = open(fn_slots, 'w')
-    writer_slots = csv.writer(f_slots, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+    out_slots = lib_output.OutputFile(path_out, 'slots', ds, output_formats)
+    write_slots = out_slots.write
     n_slots = 0
 
+    # start decoding the input file
+    batches = multiprocessing.Queue(maxsize=DECODE_QUEUE_SIZE)
+    decoder = multiprocessing.Process(target=decode_file, args=(path_raw + fn, batches),
+                                      daemon=True)
+    decoder.start()
+
     # read previous state, if exists
-    avs = lib.read_previous_state(path_raw, ds, 'avs')
-    slots = lib.read_previous_state(path_raw, ds, 'slots')
+    with lib_metrics.timer('read_state'):
+        avs = lib.read_previous_state(path_raw, ds, 'avs')
+        slots = lib.read_previous_state(path_raw, ds, 'slots')
     # read zip map
     zipmap = lib.read_zipmap()
+    n_records = 0
+    avs_columns = []  # (iid, check_time, offset, availability) for the arrays engine
 
-    # open input file
-    with gzip.open(path_raw + fn, 'rb') as f:
-        while True:
-            line = f.readline()
-            if line is None or len(line) == 0:
-                break
-            try:
-                data = json.loads(line[:-1].replace(b"\\\\", b"\\").decode())
-            except json.decoder.JSONDecodeError:
-                print('[ERROR] json.decoder.JSONDecodeError:')
-                print(line)
+    t_process = time.perf_counter()
+    while True:
+        try:
+            batch = batches.get(timeout=1)
+        except queue.Empty:
+            if not decoder.is_alive():
+                print("[ERROR] decoding process stopped unexpectedly")
                 exit()
-
+            continue
+        if batch is None:
+            break
+        if type(batch) == str:
+            print(batch)
+            exit()
+        n_records += len(batch)
+        for record in batch:
             try:
-                if data['action'] == 'UPDATE':
-                    loc = data['data']
-                elif data['action'] == 'INSERT':
-                    loc = data['changed_data']
-                elif data['action'] == 'DELETE':
-                    loc = data['previous_data']
-                else:
-                    print('[WARN] different action than {UPDATE,INSERT}')
-                    print(lib.pp(data))
-
-                iid = loc['id']
-
+                (iid, key, rows) = record
                 #
-                # extract location data
+                # extract location data, if it changed
                 #
-                # NOTE: assumes that location meta-data stays stable,
-                #       and takes the last known non-null values as true
-                # if iid not in locations:
-                if True:
-                    # set fields to None by default
-                    [uuid, name, provider, type, address, city, county,
-                     state, zip, lat, lng, timezone] = [None] * 12
-                    # extract fields
-                    if loc['name'] is not None:
-                        name = loc['name']
-                    if loc['brand'] is not None:
-                        provider = loc['brand'].lower()
-                    if loc['address'] is not None:
-                        address = loc['address']
-                    if loc['city'] is not None:
-                        city = loc['city'].title()
-                    if loc['state'] is not None:
-                        state = loc['state'].upper()
-                    if loc['postal_code'] is not None:
-                        zip = "%05d" % int(loc['postal_code'][:5])
-                    if loc['location'] is not None:
-                        lat = loc['location']['latitude']
-                        lng = loc['location']['longitude']
-                    # extract local timezone
-                    if 'time_zone' in loc and loc['time_zone'] is not None and loc['time_zone'] != '':
-                        timezone = loc['time_zone']
-                    elif zip is not None:
-                        timezone = zipmap[zip][0]
-                    elif state is not None:
-                        timezone = us.states.lookup(loc['state']).time_zones[0]
-                    # insert row
-                    locations[iid] = {
-                        'uuid': uuid,
-                        'name': name,
-                        'provider': provider,
-                        'type': type,
-                        'address': address,
-                        'city': city,
-                        'county': county,
-                        'state': state,
-                        'zip': zip,
-                        'lat': lat,
-                        'lng': lng,
-                        'timezone': timezone
-                    }
-
-                if data['action'] in ['INSERT', 'DELETE']:
-                    continue
-                # warn if anything else than known values get updated
-                if data['changed_data'] is None or (
-                    'appointments' not in data['changed_data'] and
-                    'appointments_available' not in data['changed_data']):
+                if key is not None and location_fields.get(iid) != key:
+                    extract_location(iid, key, zipmap)
+                    location_fields[iid] = key
+                if rows is None:
                     continue
                 #
                 # extract "any" availability data
                 #
-                for row in [data['previous_data'], data['data']]:
-                    # they only started recording last_fetched later...
-                    if 'appointments_last_fetched' in row and row['appointments_last_fetched'] is not None:
-                        ts = row['appointments_last_fetched']
-                    elif 'updated_at' in row and row['updated_at'] is not None:
-                        ts = row['updated_at']
-                    else:
-                        ts = data['transaction_timestamp']
-                    time_raw = dateutil.parser.parse(ts)
-                    # convert to UTC, so it's all the same
-                    check_time_utc = time_raw.astimezone(pytz.timezone('UTC'))
+                for (check_time, seconds, appointments_available, n_appointments,
+                     slot_times) in rows:
                     # (optional) compute local offset
                     if locations[iid]['timezone'] is not None:
-                        check_time_local = check_time_utc.astimezone(pytz.timezone(locations[iid]['timezone']))
-                        offset = int(check_time_local.utcoffset().total_seconds() / (60 * 60))
+                        offset = lib_tz.utc_offset(locations[iid]['timezone'], seconds)
                     else:
                         offset = None
-                    check_time = check_time_utc.strftime("%Y-%m-%d %H:%M:%S")  # in UTC
 
                     # extract availabilities
                     availability = None
-                    if row['appointments_available']:
-                        if row['appointments'] is not None:
-                            availability = len(row['appointments'])
+                    if appointments_available:
+                        if n_appointments is not None:
+                            availability = n_appointments
                         else:
                             availability = '+'
-                    elif not row['appointments_available']:
-                        availability = 0
                     else:
-                        availability = None
-                        print('[WARN]   %d - no availability found' % data['audit_id'])
+                        availability = 0
 
+                    if avs_engine == 'arrays':
+                        # merged all at once at the end of the day
+                        avs_columns.append((iid, check_time, offset, availability))
                     # create a new row if the location is new
-                    if iid not in avs:
+                    elif iid not in avs:
                         avs[iid] = [check_time, check_time, offset, availability]
                     # if new row but availability didn't change, just update time
-                    if availability == avs[iid][3]:
+                    elif availability == avs[iid][3]:
                         avs[iid][1] = check_time
                     # else, write old row and update new row
                     else:
-                        writer_avs.writerow([iid] + avs[iid])
+                        write_avs([iid] + avs[iid])
                         n_avs += 1
                         avs[iid] = [check_time, check_time, offset, availability]
 
                     # do slots, if the data is there
-                    if 'appointments' in row and row['appointments'] is not None:
+                    if slot_times is not None:
                         # create a new row if the location is new
                         if iid not in slots:
                             slots[iid] = {}
-                        for slot in row['appointments']:
-                            if 'time' not in slot or slot['time'] is None:
-                                continue
-                            # compute local offset and UTC time for slot time
-                            slot_time_local = datetime.datetime.fromisoformat(slot['time'])
-                            slot_time_offset = int(slot_time_local.utcoffset().total_seconds() / (60 * 60))
-                            slot_time_utc = slot_time_local.astimezone(pytz.timezone('UTC'))
-                            slot_time = slot_time_utc.strftime("%Y-%m-%d %H:%M")  # in UTC
+                        for slot_time in slot_times:
                             # if slot time didn't exist, create
                             if slot_time not in slots[iid]:
                                 if slot_time > check_time:
@@ -228,13 +387,13 @@ def do_date(ds):
                                 slots[iid][slot_time][1] = check_time
                             # else, write old row and update new row
                             else:
-                                writer_slots.writerow([iid, slot_time] + slots[iid][slot_time])
+                                write_slots([iid, slot_time] + slots[iid][slot_time])
                                 n_slots += 1
                                 del slots[iid][slot_time]
                         # assume that slots for which we saw no availaiblity in last update are not available anymore
                         for slot_time in list(slots[iid].keys()):
                             if slots[iid][slot_time][1] != check_time:
-                                writer_slots.writerow([iid, slot_time] + slots[iid][slot_time])
+                                write_slots([iid, slot_time] + slots[iid][slot_time])
                                 n_slots += 1
                                 del slots[iid][slot_time]
 
@@ -242,22 +401,33 @@ def do_date(ds):
                 print("Unexpected error:", sys.exc_info())
                 traceback.print_exc()
                 print("Problem data: ")
-                print(lib.pp(data))
+                print(record)
                 exit()
+    decoder.join()
+    if avs_columns:
+        with lib_metrics.timer('merge_avs'):
+            closed = lib_state.merge_availability(avs, *zip(*avs_columns))
+        for record in closed:
+            write_avs(record)
+        n_avs += len(closed)
 
     # wrap up
-    f_avs.close()
-    f_slots.close()
-    print("[INFO]   wrote %d availability records to %s" % (n_avs, fn_avs))
-    print("[INFO]   wrote %d slot records to %s" % (n_slots, fn_slots))
+    out_avs.close()
+    out_slots.close()
+    lib_metrics.add_time('process', t_process)
+    print("[INFO]   wrote %d availability records to %s" % (n_avs, out_avs.fn))
+    print("[INFO]   wrote %d slot records to %s" % (n_slots, out_slots.fn))
     # write current state for the next day
     next_day = lib.add_days(ds, 1)
-    with open(path_raw + 'state_%s_avs.json' % next_day, 'w') as f:
-        json.dump(avs, f)
-    with open(path_raw + 'state_%s_slots.json' % next_day, 'w') as f:
-        json.dump(slots, f)
-    # write updated locations file
-    lib.write_locations(locations, locations_path)
+    with lib_metrics.timer('write_state'):
+        with open(path_raw + 'state_%s_avs.json' % next_day, 'w') as f:
+            json.dump(avs, f)
+        with open(path_raw + 'state_%s_slots.json' % next_day, 'w') as f:
+            json.dump(slots, f)
+    lib_metrics.count('records', n_records)
+    lib_metrics.count('avs_records', n_avs)
+    lib_metrics.count('slot_records', n_slots)
+    lib_metrics.report(pipeline='vaccinespotter', date=ds)
 
 
 def download_file(fn):
@@ -281,8 +451,20 @@ if __name__ == "__main__":
     parser = lib_cli.create_agument_parser()
     parser.add_argument('-c', '--clean_run', action='store_true',
                         help="replace previous locations file")
+    lib_cli.add_avs_engine_argument(parser)
+    lib_cli.add_slot_time_cache_argument(parser)
+    lib_cli.add_aggregation_arguments(parser)
+    lib_cli.add_output_arguments(parser)
+    lib_cli.add_metrics_arguments(parser)
     args = parser.parse_args()
+    lib_cli.check_aggregation_arguments(parser, args)
     dates = lib_cli.get_dates_in_range(args.start_date, args.end_date)
+    output_formats = lib_output.check_formats(args.output_format)
+    avs_engine = args.avs_engine
+    if args.slot_time_cache_size:
+        slot_time_cache.maxsize = args.slot_time_cache_size
+    if args.metrics:
+        lib_metrics.enable(args.metrics)
 
     # compute intersection with days that VaccineSpotter actually has data for
     try:
@@ -307,9 +489,13 @@ if __name__ == "__main__":
     else:
         print("[INFO] clean_run=F, so keep previously collected location data")
         locations = lib.read_locations(locations_path)
-    # iterate over days
-    for date in dates:
-        do_date(date)
-    # aggregate slot data over multiple days
-    fn_slots = lib.path_root + '/vs_clean/vs_slots.csv'
-    lib.aggregate_slots(path_out, fn_slots)
+    with lib_metrics.profile(args.profile):
+        # iterate over days
+        for date in dates:
+            do_date(date)
+        # write updated locations file
+        lib.write_locations(locations, locations_path)
+        # aggregate slot data over multiple days
+        fn_slots = lib.path_root + '/vs_clean/vs_slots.csv'
+        lib.aggregate_slots(path_out, fn_slots, **lib_cli.aggregation_options(args))
+        lib_output.write_aggregated_slots(fn_slots, output_formats)
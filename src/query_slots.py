@@ -0,0 +1,339 @@
+#
+# Queries over the aggregated slots (see `lib.aggregate_slots`), with
+# persisted indexes.
+#
+# Loading the whole aggregated slots file to answer a single question ("how
+# many slots were open in county X between T1 and T2?") is slow, so this
+# builds an index of it once, as NumPy arrays in a directory next to it
+# (`univaf_slots_index/` for `univaf_slots.csv`), which are memory-mapped
+# when they're used:
+#
+#   location_ids        - the (sorted) ids of the locations with slots
+#   location_starts     - where the slots of each location start in the
+#                         arrays below
+#   state, county, provider
+#                       - codes of the attributes of each location (from the
+#                         locations file), see `meta.json` for their names
+#   slot_key            - (location index << 32 | slot time) of the slots,
+#                         sorted
+#   first_check, last_check, hod, dow
+#                       - of the slots, in the same order
+#   first_key, last_key - (location index << 32 | first/last check), sorted,
+#                         to count the slots of each location that were open
+#                         in a period with binary searches
+#
+# Times are in minutes since epoch, in local time (like in the aggregated
+# slots). A slot was open in a period if the period overlaps the time from
+# its first to its last check. The index is built again when the slots or
+# locations file changed.
+#
+# Usage:
+#
+#   python query_slots.py [-h] [--slots FILE] [--locations FILE] [--rebuild]
+#                         [--id ID [ID ...]] [--state STATE [STATE ...]]
+#                         [--county COUNTY [COUNTY ...]]
+#                         [--provider PROVIDER [PROVIDER ...]]
+#                         [--slot_start TIME] [--slot_end TIME]
+#                         [--open_start TIME] [--open_end TIME]
+#                         [--hod HOUR [HOUR ...]] [--dow DAY [DAY ...]]
+#                         [--group_by KEY [KEY ...]] [-o OUTPUT]
+#
+# For example, the number of slots per county in WA that were open on a day:
+#
+#   python query_slots.py --state WA --open_start 2021-06-01 \
+#                         --open_end "2021-06-01 23:59" --group_by county
+#
+# Group by keys are id, state, county, provider, date (of the slots), hod and
+# dow. The same queries are available as `SlotIndex.query`.
+#
+
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+# internal
+import lib
+
+# version of the index format, to be bumped when it changes
+INDEX_VERSION = 1
+# location attributes that can be queried
+ATTRIBUTES = ['state', 'county', 'provider']
+GROUP_KEYS = ['id'] + ATTRIBUTES + ['date', 'hod', 'dow']
+SLOT_COLUMNS = ['id', 'slot_time', 'hod', 'dow', 'first_check', 'last_check']
+ARRAYS = ['location_ids', 'location_starts'] + ATTRIBUTES + \
+         ['slot_key', 'first_check', 'last_check', 'hod', 'dow', 'first_key', 'last_key']
+
+# times are stored in the lower 32 bits of keys
+TIME_BITS = 32
+MAX_TIME = (1 << TIME_BITS) - 1
+# times that aren't known (NaT)
+MISSING = np.iinfo(np.int64).min
+
+
+def index_path(fn_slots):
+    return fn_slots[:-len('.csv')] + '_index/'
+
+
+def source_stats(fns):
+    return {fn: [os.stat(fn).st_size, os.stat(fn).st_mtime_ns] for fn in fns}
+
+
+def to_minutes(value):
+    """
+    Convert a time (a string, datetime or Timestamp) to minutes since epoch.
+    """
+    return pd.Timestamp(value).value // (60 * 10 ** 9)
+
+
+def read_times(strings):
+    """
+    Read a column of "YYYY-MM-DD HH:MM" time stamps as minutes since epoch.
+    """
+    times = pd.to_datetime(strings, format='%Y-%m-%d %H:%M', errors='coerce')
+    return times.values.astype('datetime64[m]').astype(np.int64)
+
+
+def build_index(fn_slots, fn_locations, path):
+    """
+    Build the index of an aggregated slots file, with the attributes of the
+    locations in `fn_locations`, and write it to the directory `path`.
+    """
+    print("[INFO] indexing %s" % fn_slots)
+    DF = pd.read_csv(fn_slots, names=SLOT_COLUMNS, dtype={'slot_time': str, 'first_check': str,
+                                                         'last_check': str})
+    slot_time = read_times(DF.slot_time)
+    known = slot_time != MISSING
+    if not known.all():
+        print("[WARN]   skipping %d slots without a slot time" % (~known).sum())
+    (location_ids, locations) = np.unique(DF.id.values[known], return_inverse=True)
+    locations = locations.astype(np.int64)
+    slot_key = (locations << TIME_BITS) | slot_time[known]
+    order = np.argsort(slot_key, kind='stable')
+    arrays = {
+        'location_ids': location_ids.astype(np.int64),
+        'location_starts': np.searchsorted(slot_key[order],
+                                           np.arange(len(location_ids) + 1) << TIME_BITS),
+        'slot_key': slot_key[order],
+        'first_check': read_times(DF.first_check)[known][order],
+        'last_check': read_times(DF.last_check)[known][order],
+        'hod': DF.hod.values[known][order].astype(np.int8),
+        'dow': DF.dow.values[known][order].astype(np.int8)
+    }
+    location_index = locations[order]
+    checked = (arrays['first_check'] != MISSING) & (arrays['last_check'] != MISSING)
+    for column in ['first', 'last']:
+        arrays[column + '_key'] = np.sort((location_index[checked] << TIME_BITS) |
+                                          arrays[column + '_check'][checked])
+
+    # attributes of the locations, as codes into lists of names
+    categories = {}
+    attributes = pd.read_csv(fn_locations, dtype=str, keep_default_na=False,
+                             usecols=['id'] + ATTRIBUTES)
+    attributes = attributes.assign(id=attributes.id.astype(np.int64)).set_index('id')
+    attributes = attributes.reindex(location_ids)
+    for attribute in ATTRIBUTES:
+        values = pd.Categorical(attributes[attribute].fillna(''))
+        categories[attribute] = values.categories.tolist()
+        arrays[attribute] = values.codes.astype(np.int32)
+
+    # write to a temporary directory first, so an index is complete when it exists
+    tmp_path = path[:-1] + '.tmp/'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for (name, array) in arrays.items():
+        np.save(tmp_path + name + '.npy', array)
+    with open(tmp_path + 'meta.json', 'w') as f:
+        json.dump({'version': INDEX_VERSION, 'sources': source_stats([fn_slots, fn_locations]),
+                   'categories': categories}, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    print("[INFO]   indexed %d slots of %d locations in %s" %
+          (len(slot_key), len(location_ids), path))
+
+
+class SlotIndex:
+    """
+    A (memory-mapped) index of aggregated slots, see `build_index`.
+    """
+
+    def __init__(self, path):
+        with open(path + 'meta.json', 'r') as f:
+            self.meta = json.load(f)
+        for name in ARRAYS:
+            setattr(self, name, np.load(path + name + '.npy', mmap_mode='r'))
+
+    @classmethod
+    def open(cls, fn_slots, fn_locations, rebuild=False):
+        """
+        Open the index of an aggregated slots file, building it first if
+        there is none, or it's out of date.
+        """
+        path = index_path(fn_slots)
+        fn_meta = path + 'meta.json'
+        meta = None
+        if os.path.exists(fn_meta):
+            with open(fn_meta, 'r') as f:
+                meta = json.load(f)
+        if (rebuild or meta is None or meta['version'] != INDEX_VERSION or
+                meta['sources'] != source_stats([fn_slots, fn_locations])):
+            build_index(fn_slots, fn_locations, path)
+        return cls(path)
+
+    def select_locations(self, ids=None, **attributes):
+        """
+        Get the indexes of the locations with the given ids and attributes
+        (each a list of allowed values).
+        """
+        keep = np.ones(len(self.location_ids), dtype=bool)
+        if ids is not None:
+            keep &= np.isin(self.location_ids, np.array(ids, dtype=np.int64))
+        for (attribute, values) in attributes.items():
+            if values is None:
+                continue
+            names = self.meta['categories'][attribute]
+            codes = [i for (i, name) in enumerate(names) if name in set(values)]
+            keep &= np.isin(getattr(self, attribute), codes)
+        return np.flatnonzero(keep)
+
+    def count_open(self, locations, start=None, end=None):
+        """
+        Count the slots of each location that were open at some time between
+        `start` and `end` (in minutes since epoch), with binary searches.
+        """
+        start = 0 if start is None else min(max(start, 0), MAX_TIME)
+        end = MAX_TIME if end is None else min(max(end, 0), MAX_TIME)
+        lower = locations.astype(np.int64) << TIME_BITS
+        upper = (locations.astype(np.int64) + 1) << TIME_BITS
+        n_checked = (np.searchsorted(self.first_key, upper) -
+                     np.searchsorted(self.first_key, lower))
+        # slots that were first checked after the end, or last checked before
+        # the start (which can't both be true)
+        n_after = np.searchsorted(self.first_key, upper) - \
+            np.searchsorted(self.first_key, lower | end, side='right')
+        n_before = np.searchsorted(self.last_key, lower | start) - \
+            np.searchsorted(self.last_key, lower)
+        return n_checked - n_after - n_before
+
+    def slot_rows(self, locations, start=None, end=None):
+        """
+        Get the (positions of the) slots of locations with slot times between
+        `start` and `end` (in minutes since epoch).
+        """
+        start = 0 if start is None else min(max(start, 0), MAX_TIME)
+        end = MAX_TIME if end is None else min(max(end, 0), MAX_TIME)
+        lower = locations.astype(np.int64) << TIME_BITS
+        starts = np.searchsorted(self.slot_key, lower | start)
+        ends = np.searchsorted(self.slot_key, lower | end, side='right')
+        lengths = ends - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return offsets + np.arange(lengths.sum())
+
+    def query(self, ids=None, state=None, county=None, provider=None,
+              slot_start=None, slot_end=None, open_start=None, open_end=None,
+              hod=None, dow=None, group_by=()):
+        """
+        Count the slots that match all of the given conditions, in groups of
+        `group_by` keys (see `GROUP_KEYS`). Times can be strings, datetimes
+        or Timestamps, and are inclusive.
+
+        Returns a DataFrame with the group by keys and `n_slots`.
+        """
+        group_by = list(group_by)
+        for key in group_by:
+            if key not in GROUP_KEYS:
+                raise ValueError('can not group by "%s"' % key)
+        (slot_start, slot_end, open_start, open_end) = [
+            None if t is None else to_minutes(t)
+            for t in [slot_start, slot_end, open_start, open_end]]
+        locations = self.select_locations(ids, state=state, county=county, provider=provider)
+
+        if (slot_start is None and slot_end is None and hod is None and dow is None and
+                all(key in ['id'] + ATTRIBUTES for key in group_by)):
+            # counts per location are enough
+            if open_start is None and open_end is None:
+                counts = self.location_starts[locations + 1] - self.location_starts[locations]
+            else:
+                counts = self.count_open(locations, open_start, open_end)
+            columns = {'n_slots': np.asarray(counts, dtype=np.int64)}
+            location_rows = locations
+        else:
+            rows = self.slot_rows(locations, slot_start, slot_end)
+            keep = np.ones(len(rows), dtype=bool)
+            if open_start is not None or open_end is not None:
+                (first, last) = (self.first_check[rows], self.last_check[rows])
+                keep &= (first != MISSING) & (last != MISSING)
+                if open_end is not None:
+                    keep &= first <= open_end
+                if open_start is not None:
+                    keep &= last >= open_start
+            for (column, values) in [('hod', hod), ('dow', dow)]:
+                if values is not None:
+                    keep &= np.isin(getattr(self, column)[rows], values)
+            rows = rows[keep]
+            columns = {'n_slots': np.ones(len(rows), dtype=np.int64)}
+            location_rows = self.slot_key[rows] >> TIME_BITS
+            if 'date' in group_by:
+                minutes = self.slot_key[rows] & MAX_TIME
+                columns['date'] = (minutes // (24 * 60)).astype('datetime64[D]').astype(str)
+            for column in ['hod', 'dow']:
+                if column in group_by:
+                    columns[column] = self.hod[rows] if column == 'hod' else self.dow[rows]
+
+        if 'id' in group_by:
+            columns['id'] = self.location_ids[location_rows]
+        for attribute in ATTRIBUTES:
+            if attribute in group_by:
+                names = np.array(self.meta['categories'][attribute], dtype=object)
+                columns[attribute] = names[getattr(self, attribute)[location_rows]]
+        DF = pd.DataFrame(columns)
+        if not group_by:
+            return pd.DataFrame({'n_slots': [int(DF.n_slots.sum())]})
+        return (DF[DF.n_slots > 0]
+                  .groupby(group_by)
+                  .agg(n_slots=('n_slots', 'sum'))
+                  .reset_index())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slots', default=lib.path_root + '/univaf_clean/univaf_slots.csv',
+                        help="aggregated slots file (default: univaf_clean/univaf_slots.csv)")
+    parser.add_argument('--locations', default=lib.path_root + '/univaf_clean/univaf_locations.csv',
+                        help="locations file (default: univaf_clean/univaf_locations.csv)")
+    parser.add_argument('--rebuild', action='store_true', help="build the index again")
+    parser.add_argument('--id', nargs='+', type=int, help="only these location ids")
+    for attribute in ATTRIBUTES:
+        parser.add_argument('--' + attribute, nargs='+',
+                            help="only locations with one of these values of %s" % attribute)
+    parser.add_argument('--slot_start', metavar='TIME', help="only slots at or after TIME")
+    parser.add_argument('--slot_end', metavar='TIME', help="only slots at or before TIME")
+    parser.add_argument('--open_start', metavar='TIME',
+                        help="only slots that were open at or after TIME")
+    parser.add_argument('--open_end', metavar='TIME',
+                        help="only slots that were open at or before TIME")
+    parser.add_argument('--hod', nargs='+', type=int, help="only slots in these hours of the day")
+    parser.add_argument('--dow', nargs='+', type=int,
+                        help="only slots on these days of the week (0 is Monday)")
+    parser.add_argument('--group_by', nargs='+', default=[], choices=GROUP_KEYS, metavar='KEY',
+                        help="count slots per group of these keys (%s)" % ', '.join(GROUP_KEYS))
+    parser.add_argument('-o', '--output', help="write the result to this CSV file")
+    args = parser.parse_args()
+
+    index = SlotIndex.open(args.slots, args.locations, rebuild=args.rebuild)
+    t_query = time.perf_counter()
+    result = index.query(ids=args.id, state=args.state, county=args.county,
+                         provider=args.provider, slot_start=args.slot_start,
+                         slot_end=args.slot_end, open_start=args.open_start,
+                         open_end=args.open_end, hod=args.hod, dow=args.dow,
+                         group_by=args.group_by)
+    print("[INFO] query took %.1f ms" % ((time.perf_counter() - t_query) * 1000))
+    if args.output:
+        result.to_csv(args.output, index=False)
+        print("[INFO] wrote %d rows to %s" % (result.shape[0], args.output))
+    else:
+        print(result.to_string(index=False))
@@ -0,0 +1,369 @@
+#
+# Near-real-time processing of univaf availability records, as a stream.
+#
+# Instead of complete daily log files, this reads availability log records
+# (one JSON document per line, as in the availability_log files) as they come
+# in: from a growing local file (like `tail -f`), from stdin, or from TCP
+# connections. Records are merged into the avs/slots state of
+# `process_univaf` in small batches, as soon as they arrive, and availability
+# and slot records are appended to the output files as soon as they close.
+#
+# The state is checkpointed periodically (and when the stream ends or the
+# process is stopped). When following a file, the checkpoint includes the
+# position in the file and the size of the output files, so a restarted
+# stream continues exactly where the checkpoint left off.
+#
+# The locations (ids index) are read from the output of `process_univaf`,
+# and read again when they change.
+#
+# Usage:
+#
+#   python stream_univaf.py [-h] (-f FILE | --stdin | --listen HOST:PORT)
+#                           [--no_follow] [--checkpoint_seconds SECONDS]
+#                           [--metrics FILE] [--profile FILE]
+#
+# For example, to feed it from another process over a socket:
+#
+#   python stream_univaf.py --listen localhost:8765
+#   zcat availability_log-2021-06-01.ndjson.gz | nc localhost 8765
+#
+# Produces (in univaf_clean/):
+#
+#   stream_avs.csv   - (id, first_checked_time, last_checked_time,
+#                       offset, availability)
+#   stream_slots.csv - (id, slot_time, first_checked_time, last_checked_time,
+#                       offset)
+#
+
+import argparse
+import asyncio
+import collections
+import csv
+import json
+import os
+import signal
+import stat
+import sys
+import time
+import traceback
+# internal
+import lib
+import lib_metrics
+import lib_state
+import process_univaf
+import univaf_data
+
+path_raw = process_univaf.path_raw
+path_out = process_univaf.path_out
+
+# maximum number of records that are merged at once
+STREAM_BATCH_SIZE = 10000
+# maximum number of records waiting to be merged
+STREAM_QUEUE_SIZE = 100000
+# how often to check a followed file for new records
+POLL_SECONDS = 0.2
+# maximum length of a record from stdin or a socket
+MAX_LINE_SIZE = 64 * 1024 * 1024
+# slots this long before the last check time are dropped from the state
+SLOT_RETENTION_MINUTES = 24 * 60
+
+# end of the stream
+END = None
+
+
+async def follow_file(fn, queue, offset=0, follow=True):
+    """
+    Put the lines of a file on `queue` as (line, offset) tuples, where
+    `offset` is the position after the line. When the end of the file is
+    reached, keep waiting for new lines if `follow`, starting over if the file
+    is truncated or replaced (e.g. rotated).
+    """
+    f = open(fn, 'rb')
+    f.seek(offset)
+    rest = b''
+    try:
+        while True:
+            block = f.read(univaf_data.READ_BLOCK_SIZE)
+            if not block:
+                if not follow:
+                    if rest:
+                        await queue.put((rest, offset + len(rest)))
+                    break
+                await asyncio.sleep(POLL_SECONDS)
+                try:
+                    file_stat = os.stat(fn)
+                except FileNotFoundError:
+                    continue
+                if (file_stat.st_ino != os.fstat(f.fileno()).st_ino or
+                        file_stat.st_size < offset):
+                    print("[INFO] %s was replaced, reading it from the start" % fn)
+                    f.close()
+                    f = open(fn, 'rb')
+                    (offset, rest) = (0, b'')
+                continue
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                offset += len(line) + 1
+                await queue.put((line, offset))
+    finally:
+        f.close()
+    await queue.put(END)
+
+
+async def read_lines(reader, queue):
+    """
+    Put the lines of a `StreamReader` on `queue`, without an offset.
+    """
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        await queue.put((line, None))
+
+
+async def read_stdin(queue):
+    if stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode):
+        # a file can't be read as a pipe, but it doesn't grow either
+        return await follow_file('/dev/stdin', queue, follow=False)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=MAX_LINE_SIZE)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    await read_lines(reader, queue)
+    await queue.put(END)
+
+
+async def listen(address, queue):
+    """
+    Accept connections on `address` ("HOST:PORT"), and put the lines that are
+    sent on them on `queue`. Runs until it's cancelled.
+    """
+    (host, port) = address.rsplit(':', 1)
+
+    async def handle(reader, writer):
+        peer = writer.get_extra_info('peername')
+        print("[INFO] connection from %s" % (peer,))
+        try:
+            await read_lines(reader, queue)
+        finally:
+            writer.close()
+        print("[INFO] connection from %s closed" % (peer,))
+
+    server = await asyncio.start_server(handle, host or None, int(port), limit=MAX_LINE_SIZE)
+    print("[INFO] listening on %s" % address)
+    async with server:
+        await server.serve_forever()
+
+
+class Stream:
+    """
+    The state of a stream: the avs/slots state (in `process_univaf`), the
+    open output files, and the position in the source.
+    """
+
+    def __init__(self, source=None):
+        self.source = source
+        self.offset = 0
+        self.n_checkpoint = 0
+        self.last_check_time = 0
+        self.unknown = collections.Counter()
+        self.loads = univaf_data.json_decoder()
+        self.index_mtime = None
+        self.read_index()
+
+        fn_position = path_raw + 'stream_position.json'
+        position = None
+        if os.path.exists(fn_position):
+            with open(fn_position, 'r') as f:
+                position = json.load(f)
+        if position is not None:
+            print("[INFO] continuing from checkpoint %s" % position['state'])
+            (process_univaf.avs, process_univaf.slots) = lib_state.read_checkpoint(
+                path_raw + position['state'])
+            self.n_checkpoint = position['n_checkpoint']
+            self.last_check_time = position['last_check_time']
+        else:
+            (process_univaf.avs, process_univaf.slots) = ({}, {})
+
+        # when the same file is read again from the checkpoint, the records
+        # that were written after it are written again
+        resume = position is not None and source is not None and position['source'] == source
+        if resume:
+            self.offset = position['offset']
+        self.files = {}
+        for name in ['avs', 'slots']:
+            self.files[name] = open('%sstream_%s.csv' % (path_out, name), 'a')
+            if resume:
+                self.files[name].truncate(position['sizes'][name])
+        avs_writer = csv.writer(self.files['avs'], delimiter=',', quoting=csv.QUOTE_MINIMAL)
+        slots_writer = csv.writer(self.files['slots'], delimiter=',', quoting=csv.QUOTE_MINIMAL)
+        self.write_avs = lambda row: avs_writer.writerow(process_univaf.avs_row(row))
+        self.write_slots = lambda row: slots_writer.writerow(process_univaf.slot_row(row))
+
+    def read_index(self):
+        """
+        Read the ids index of the locations, if it changed. The index that was
+        read before is kept while the directory is missing or empty (e.g.
+        while `process_univaf` writes it again).
+        """
+        fn = path_out + 'univaf_ids_index/'
+        names = os.listdir(fn) if os.path.isdir(fn) else []
+        if len(names) == 0:
+            if process_univaf.id_index is not None:
+                return
+            print("[ERROR] no location ids index in %s, run process_univaf.py first" % fn)
+            sys.exit(1)
+        mtime = max(os.stat(fn + name).st_mtime_ns for name in names)
+        if mtime != self.index_mtime:
+            process_univaf.id_index = lib.read_id_index(fn)
+            self.index_mtime = mtime
+
+    def merge(self, lines):
+        """
+        Decode lines of records, and merge them into the state.
+        """
+        rows = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                decoded = process_univaf.decode_row(self.loads(line))
+            except Exception:
+                print("[ERROR] skipping record that can't be decoded:", sys.exc_info()[1])
+                traceback.print_exc()
+                continue
+            if decoded is not None:
+                rows.append(decoded)
+        updates = process_univaf.normalize_times(rows, self.unknown)
+        (n_avs, n_slots) = process_univaf.merge_updates(updates, self.write_avs,
+                                                        self.write_slots)
+        for f in self.files.values():
+            f.flush()
+        if updates:
+            self.last_check_time = max(self.last_check_time,
+                                       max(update[1] for update in updates))
+        lib_metrics.count('records', len(lines))
+        lib_metrics.count('updates', len(updates))
+        lib_metrics.count('avs_records', n_avs)
+        lib_metrics.count('slot_records', n_slots)
+
+    def checkpoint(self):
+        """
+        Write the state, and the position in the source and the output files
+        that it goes with.
+        """
+        t_checkpoint = time.perf_counter()
+        # drop slots that are long gone, like `process_univaf.read_state` does
+        min_slot_time = self.last_check_time // 60 - SLOT_RETENTION_MINUTES
+        for iid in list(process_univaf.slots):
+            process_univaf.slots[iid].discard_before(min_slot_time)
+            if len(process_univaf.slots[iid]) == 0:
+                del process_univaf.slots[iid]
+
+        # alternate between two state files, so the one that the position
+        # refers to is complete until the new position is written
+        self.n_checkpoint += 1
+        name = 'stream_state_%d.npz' % (self.n_checkpoint % 2)
+        lib_state.write_checkpoint(path_raw + name, process_univaf.avs, process_univaf.slots)
+        position = {'state': name, 'n_checkpoint': self.n_checkpoint,
+                    'last_check_time': self.last_check_time,
+                    'source': self.source, 'offset': self.offset,
+                    'sizes': {k: f.tell() for (k, f) in self.files.items()}}
+        fn_position = path_raw + 'stream_position.json'
+        with open(fn_position + '.tmp', 'w') as f:
+            json.dump(position, f)
+        os.replace(fn_position + '.tmp', fn_position)
+        lib_metrics.add_time('checkpoint', t_checkpoint)
+
+        if self.unknown:
+            print('[WARN]   skipped %d rows with %d ids not in the dictionary' %
+                  (sum(self.unknown.values()), len(self.unknown)))
+            self.unknown.clear()
+        counters = lib_metrics.counters
+        print("[INFO] checkpoint %d: %d open availability records, %d locations with open slots%s" %
+              (self.n_checkpoint, len(process_univaf.avs), len(process_univaf.slots),
+               ' (merged %d records)' % counters['records'] if lib_metrics.enabled else ''))
+        lib_metrics.report(pipeline='univaf_stream', step='checkpoint')
+        self.read_index()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+async def merge_stream(queue, stream, checkpoint_seconds):
+    """
+    Merge the lines on `queue` into the stream state as they come in, in
+    batches of what is available at once, and checkpoint periodically.
+    """
+    loop = asyncio.get_running_loop()
+    next_checkpoint = loop.time() + checkpoint_seconds
+    done = False
+    while not done:
+        try:
+            item = await asyncio.wait_for(queue.get(), max(next_checkpoint - loop.time(), 0))
+        except asyncio.TimeoutError:
+            item = ()
+        batch = []
+        while item is not END:
+            if item:
+                batch.append(item)
+            if len(batch) >= STREAM_BATCH_SIZE or queue.empty():
+                break
+            item = queue.get_nowait()
+        done = item is END
+        if batch:
+            t_merge = time.perf_counter()
+            stream.merge([line for (line, offset) in batch])
+            lib_metrics.add_time('merge', t_merge)
+            if batch[-1][1] is not None:
+                stream.offset = batch[-1][1]
+        if done or loop.time() >= next_checkpoint:
+            stream.checkpoint()
+            next_checkpoint = loop.time() + checkpoint_seconds
+
+
+async def run(args):
+    stream = Stream(source=os.path.abspath(args.file) if args.file else None)
+    queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    if args.file:
+        reader = follow_file(args.file, queue, stream.offset, follow=not args.no_follow)
+    elif args.stdin:
+        reader = read_stdin(queue)
+    else:
+        reader = listen(args.listen, queue)
+    reader = asyncio.ensure_future(reader)
+    merger = asyncio.ensure_future(merge_stream(queue, stream, args.checkpoint_seconds))
+    loop = asyncio.get_running_loop()
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(sig, merger.cancel)
+    try:
+        await merger
+    except asyncio.CancelledError:
+        print("[INFO] stopping")
+        stream.checkpoint()
+    finally:
+        reader.cancel()
+        stream.close()
+
+
+if __name__ == "__main__":
+    import lib_cli
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-f', '--file',
+                        help="read records from a (growing) file of availability log records")
+    source.add_argument('--stdin', action='store_true',
+                        help="read records from stdin, until it's closed")
+    source.add_argument('--listen', metavar='HOST:PORT',
+                        help="read records from TCP connections to this address")
+    parser.add_argument('--no_follow', action='store_true',
+                        help="stop at the end of the file, instead of waiting for more records")
+    parser.add_argument('--checkpoint_seconds', type=float, default=60,
+                        help="how often to write the state (default: 60)")
+    lib_cli.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    if args.metrics:
+        lib_metrics.enable(args.metrics)
+    with lib_metrics.profile(args.profile):
+        asyncio.run(run(args))
@@ -0,0 +1,430 @@
+#
+# Columnar cache of UNIVAF availability logs.
+#
+# Decompressing and parsing the JSON availability logs is the slowest part of
+# reading them, and every run does it again for the same files. This converts
+# each day's log once into a set of Parquet tables, which are much faster to
+# read back:
+#
+#   records.parquet  - (location_id, valid_at, available, available_count,
+#                       present, json)
+#   slots.parquet    - (row, start, available, available_count,
+#                       unavailable_count)
+#   capacity.parquet - (row, date, available, available_count,
+#                       unavailable_count)
+#
+# `valid_at` is stored as a UTC timestamp (int64 microseconds since epoch),
+# `present` is a bit mask of which keys a record had, and `row` links slot and
+# capacity entries to the index of their record. Records that don't fit this
+# schema (e.g. with unexpected types) are kept as JSON in the `json` column.
+# The tables are stored in a directory named after a hash of the source file,
+# so they're never used when the source file changes. The hashes are kept in
+# an index (`columnar/index.json`) by size and modification time of the
+# source files, so they're only computed again when those change.
+#
+# Reading records back with `read_availability_log` falls back to the JSON
+# file when no (up to date) columnar version exists. `read_columnar_batches`
+# reads them as columns instead, with `valid_at` as integers.
+#
+# Usage:
+#
+#   python univaf_columnar.py [-h] [-s START_DATE] [-e END_DATE]
+#
+
+import datetime
+import dateutil.parser
+import hashlib
+import json
+import numpy as np
+import os
+from pathlib import Path
+import shutil
+import tempfile
+# pyarrow is only needed for the columnar cache
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+# internal
+import lib_metrics
+import univaf_data
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# bits of the `present` column
+PRESENT_VALID_AT = 1
+PRESENT_AVAILABLE = 2
+PRESENT_AVAILABLE_COUNT = 4
+PRESENT_CAPACITY = 8
+PRESENT_SLOTS = 16
+HAS_CAPACITY_LIST = 32
+HAS_SLOTS_LIST = 64
+
+# index of the hashes of source files, by their size and modification time
+INDEX_FILE = 'index.json'
+
+
+def source_hash(filepath):
+    """
+    Compute the SHA-1 hash of a (source) file.
+    """
+    sha = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        while True:
+            block = f.read(univaf_data.READ_BLOCK_SIZE)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def columnar_path(filepath, digest=None):
+    """
+    Path of the columnar version of a log file, given the hash of its contents.
+    """
+    filepath = Path(filepath)
+    if digest is None:
+        digest = source_hash(filepath)
+    name = filepath.name.split('.')[0]
+    return filepath.parent / 'columnar' / f'{name}-{digest[:16]}'
+
+
+def index_path(filepath):
+    return Path(filepath).parent / 'columnar' / INDEX_FILE
+
+
+def read_index(filepath):
+    path = index_path(filepath)
+    if not path.exists():
+        return {}
+    with path.open() as f:
+        return json.load(f)
+
+
+def record_digest(filepath, digest):
+    """
+    Add the hash of a source file to the index of the columnar cache, by the
+    size and modification time of the file. (Concurrent writers can lose
+    each other's entries, which only means the files are hashed again.)
+    """
+    stat = os.stat(filepath)
+    index = read_index(filepath)
+    index[Path(filepath).name] = [stat.st_size, stat.st_mtime_ns, digest]
+    path = index_path(filepath)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=path.parent, suffix='.json', delete=False) as f:
+        json.dump(index, f)
+    os.replace(f.name, path)
+
+
+def known_digest(filepath):
+    """
+    Get the hash of a source file from the index of the columnar cache, if
+    the file has the same size and modification time as when it was hashed.
+    """
+    entry = read_index(filepath).get(Path(filepath).name)
+    stat = os.stat(filepath)
+    if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return entry[2]
+    return None
+
+
+def find_columnar(filepath, digest=None):
+    """
+    Find the columnar version of a log file, or None if there is none (for
+    the current contents of the file). The file is only hashed when its hash
+    isn't given or in the index, and there is a columnar version of a file
+    with its name.
+    """
+    filepath = Path(filepath)
+    if digest is None:
+        digest = known_digest(filepath)
+    if digest is None:
+        name = filepath.name.split('.')[0]
+        if not any((filepath.parent / 'columnar').glob(f'{name}-*')):
+            return None
+        digest = source_hash(filepath)
+        record_digest(filepath, digest)
+    path = columnar_path(filepath, digest)
+    return path if path.exists() else None
+
+
+def is_count(value):
+    return type(value) == int
+
+
+def is_entry(entry, key):
+    """
+    Check whether a slot or capacity entry fits the typed columns.
+    """
+    return (isinstance(entry, dict) and
+            type(entry.get(key)) == str and
+            type(entry.get('available')) == str and
+            all(is_count(entry[k]) for k in ['available_count', 'unavailable_count']
+                if k in entry))
+
+
+def parse_valid_at(value):
+    """
+    Parse a `valid_at` time stamp into microseconds since epoch. Returns None
+    for anything that isn't a time stamp with a time zone.
+    """
+    if type(value) != str:
+        return None
+    try:
+        t = dateutil.parser.isoparse(value)
+    except ValueError:
+        return None
+    if t.tzinfo is None:
+        return None
+    return (t - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def convert_log_file(filepath, force=False):
+    """
+    Convert an availability log file into its columnar version, if that doesn't
+    exist yet. Returns the path of the columnar version.
+    """
+    if pa is None:
+        raise RuntimeError('pyarrow is needed for the columnar cache')
+    digest = source_hash(filepath)
+    record_digest(filepath, digest)
+    path = columnar_path(filepath, digest)
+    if path.exists() and not force:
+        return path
+    print(f'[INFO] converting {filepath} to {path}')
+
+    records = {k: [] for k in ['location_id', 'valid_at', 'available',
+                               'available_count', 'present', 'json']}
+    children = {
+        'slots': {k: [] for k in ['row', 'start', 'available',
+                                  'available_count', 'unavailable_count']},
+        'capacity': {k: [] for k in ['row', 'date', 'available',
+                                     'available_count', 'unavailable_count']}
+    }
+    for (i, row) in enumerate(univaf_data.read_json_lines(
+            filepath, fields=univaf_data.AVAILABILITY_LOG_FIELDS)):
+        present = 0
+        valid_at = parse_valid_at(row.get('valid_at'))
+        typed = (type(row.get('location_id')) == str and
+                 ('valid_at' not in row or valid_at is not None) and
+                 type(row.get('available', '')) in [str, type(None)] and
+                 type(row.get('available_count', 0)) in [int, type(None)])
+        for (key, key_field) in [('capacity', 'date'), ('slots', 'start')]:
+            if row.get(key) is not None:
+                typed = (typed and isinstance(row[key], list) and
+                         all(is_entry(entry, key_field) for entry in row[key]))
+        if not typed:
+            for column in records.values():
+                column.append(None)
+            records['json'][-1] = json.dumps(row)
+            continue
+
+        for (key, bit) in [('valid_at', PRESENT_VALID_AT),
+                           ('available', PRESENT_AVAILABLE),
+                           ('available_count', PRESENT_AVAILABLE_COUNT),
+                           ('capacity', PRESENT_CAPACITY),
+                           ('slots', PRESENT_SLOTS)]:
+            if key in row:
+                present |= bit
+        for (key, key_field, bit) in [('capacity', 'date', HAS_CAPACITY_LIST),
+                                      ('slots', 'start', HAS_SLOTS_LIST)]:
+            if row.get(key) is None:
+                continue
+            present |= bit
+            child = children[key]
+            for entry in row[key]:
+                child['row'].append(i)
+                child[key_field].append(entry[key_field])
+                child['available'].append(entry['available'])
+                child['available_count'].append(entry.get('available_count'))
+                child['unavailable_count'].append(entry.get('unavailable_count'))
+        records['location_id'].append(row['location_id'])
+        records['valid_at'].append(valid_at)
+        records['available'].append(row.get('available'))
+        records['available_count'].append(row.get('available_count'))
+        records['present'].append(present)
+        records['json'].append(None)
+
+    schemas = {
+        'records': pa.schema([('location_id', pa.dictionary(pa.int32(), pa.string())),
+                              ('valid_at', pa.timestamp('us', tz='UTC')),
+                              ('available', pa.dictionary(pa.int8(), pa.string())),
+                              ('available_count', pa.int64()),
+                              ('present', pa.uint8()),
+                              ('json', pa.string())]),
+        'slots': pa.schema([('row', pa.int32()),
+                            ('start', pa.string()),
+                            ('available', pa.dictionary(pa.int8(), pa.string())),
+                            ('available_count', pa.int64()),
+                            ('unavailable_count', pa.int64())]),
+        'capacity': pa.schema([('row', pa.int32()),
+                               ('date', pa.dictionary(pa.int32(), pa.string())),
+                               ('available', pa.dictionary(pa.int8(), pa.string())),
+                               ('available_count', pa.int64()),
+                               ('unavailable_count', pa.int64())])
+    }
+    tables = {'records': records, 'slots': children['slots'],
+              'capacity': children['capacity']}
+
+    # write to a temporary directory first, so a columnar version is complete
+    # when it exists, and remove versions of previous source files
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(tempfile.mkdtemp(dir=path.parent))
+    for (name, columns) in tables.items():
+        table = pa.Table.from_pydict(columns, schema=schemas[name])
+        pq.write_table(table, tmp_path / f'{name}.parquet')
+    if path.exists():
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    for old_path in path.parent.glob(path.name[:-17] + '-*'):
+        if old_path != path:
+            shutil.rmtree(old_path)
+    return path
+
+
+def column_values(column):
+    """
+    Get the values of a column as a list, faster than `to_pylist` for
+    dictionary encoded columns and columns without nulls.
+    """
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)
+    if column.null_count == 0:
+        return column.to_numpy(zero_copy_only=False).tolist()
+    return column.to_pylist()
+
+
+def read_children(path, n, key_field):
+    """
+    Read slot or capacity entries, as lists of dicts per record.
+    """
+    table = pq.read_table(path)
+    entries = [[] for i in range(n)]
+    columns = [column_values(table.column(k)) for k in
+               ['row', key_field, 'available', 'available_count', 'unavailable_count']]
+    for (i, key, available, available_count, unavailable_count) in zip(*columns):
+        entry = {key_field: key, 'available': available}
+        if available_count is not None:
+            entry['available_count'] = available_count
+        if unavailable_count is not None:
+            entry['unavailable_count'] = unavailable_count
+        entries[i].append(entry)
+    return entries
+
+
+def read_columnar_batches(path, batch_size=100000):
+    """
+    Read the records of a columnar log file in batches of columns, without
+    making a dict of each record. A batch has the columns of the records
+    table as lists, except for:
+
+      valid_at      - NumPy array of microseconds since epoch (0 if missing)
+      slots_*       - the columns of the slot entries of the batch, where
+                      the entries of record i are at
+                      [slots_offsets[i], slots_offsets[i + 1])
+      capacity      - capacity entries as lists of dicts per record
+
+    `batch_record` makes a record of a batch into a dict.
+    """
+    with lib_metrics.timer('read_columnar'):
+        table = pq.read_table(path / 'records.parquet')
+        n = table.num_rows
+        slots = pq.read_table(path / 'slots.parquet')
+        capacity = read_children(path / 'capacity.parquet', n, 'date')
+    valid_at = table.column('valid_at').cast(pa.int64()).fill_null(0).to_numpy()
+    columns = {k: column_values(table.column(k)) for k in
+               ['location_id', 'available', 'available_count', 'present', 'json']}
+    slot_columns = {'slots_' + k: column_values(slots.column(k)) for k in
+                    ['start', 'available', 'available_count', 'unavailable_count']}
+    # entries are stored in the order of their records
+    slot_offsets = np.searchsorted(slots.column('row').to_numpy(), np.arange(n + 1))
+    for start in range(0, n, batch_size):
+        end = min(start + batch_size, n)
+        (first, last) = (slot_offsets[start], slot_offsets[end])
+        batch = {k: column[start:end] for (k, column) in columns.items()}
+        batch.update((k, column[first:last]) for (k, column) in slot_columns.items())
+        batch['valid_at'] = valid_at[start:end]
+        batch['slots_offsets'] = slot_offsets[start:end + 1] - first
+        batch['capacity'] = capacity[start:end]
+        yield batch
+
+
+def batch_record(batch, i):
+    """
+    Get record `i` of a batch (see `read_columnar_batches`) as a dict, with the
+    same keys and values as in the original, except for `valid_at` which is in
+    UTC.
+    """
+    if batch['json'][i] is not None:
+        return json.loads(batch['json'][i])
+    present = batch['present'][i]
+    row = {'location_id': batch['location_id'][i]}
+    if present & PRESENT_VALID_AT:
+        row['valid_at'] = (EPOCH + datetime.timedelta(microseconds=int(batch['valid_at'][i]))
+                           ).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    if present & PRESENT_AVAILABLE:
+        row['available'] = batch['available'][i]
+    if present & PRESENT_AVAILABLE_COUNT:
+        row['available_count'] = batch['available_count'][i]
+    if present & PRESENT_CAPACITY:
+        row['capacity'] = batch['capacity'][i] if present & HAS_CAPACITY_LIST else None
+    if present & PRESENT_SLOTS:
+        row['slots'] = None
+        if present & HAS_SLOTS_LIST:
+            row['slots'] = []
+            for j in range(batch['slots_offsets'][i], batch['slots_offsets'][i + 1]):
+                entry = {'start': batch['slots_start'][j], 'available': batch['slots_available'][j]}
+                if batch['slots_available_count'][j] is not None:
+                    entry['available_count'] = batch['slots_available_count'][j]
+                if batch['slots_unavailable_count'][j] is not None:
+                    entry['unavailable_count'] = batch['slots_unavailable_count'][j]
+                row['slots'].append(entry)
+    return row
+
+
+def read_columnar(path):
+    """
+    Read the records of a columnar log file. Records have the same keys and
+    values as in the original, except for `valid_at` which is in UTC.
+    """
+    for batch in read_columnar_batches(path):
+        for i in range(len(batch['present'])):
+            yield batch_record(batch, i)
+
+
+def availability_columnar(filepath, part=None, digest=None):
+    """
+    Get the columnar version of an availability log file to read records from
+    (see `read_availability_log`), or None if they're read from the file
+    itself.
+    """
+    if part is not None or pa is None:
+        return None
+    return find_columnar(filepath, digest)
+
+
+def read_availability_log(filepath, part=None, digest=None):
+    """
+    Read the records of an availability log file, from its columnar version if
+    there is one, or else from the file itself. Records only have the keys in
+    `univaf_data.AVAILABILITY_LOG_FIELDS`. The hash of the file can be given
+    as `digest` if it's known, see `find_columnar`.
+
+    A `part` of the file (see `univaf_data.split_log_file`) is always read
+    from the file itself.
+    """
+    path = availability_columnar(filepath, part, digest)
+    if path is not None:
+        return read_columnar(path)
+    return univaf_data.read_json_lines(filepath, fields=univaf_data.AVAILABILITY_LOG_FIELDS,
+                                       part=part)
+
+
+if __name__ == "__main__":
+    import lib_cli
+    args = lib_cli.create_agument_parser().parse_args()
+    dates = lib_cli.get_dates_in_range(args.start_date, args.end_date)
+    for date in dates:
+        convert_log_file(univaf_data.download_log_file('availability_log', date))
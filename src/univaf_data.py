@@ -1,18 +1,55 @@
 import boto3
 from botocore import UNSIGNED
 from botocore.client import Config
+import concurrent.futures
 from contextlib import contextmanager
+import functools
 import gzip
+import hashlib
+import io
 import json
 import os
 from pathlib import Path
+import urllib.error
 import urllib.request
 
+# Faster JSON decoders are used when they're installed, but are optional.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+# internal
+import lib_metrics
+
 UNIVAF_AWS_BUCKET = 'univaf-data-snapshots'
-UNIVAF_ARCHIVES_URL = 'https://archives.getmyvax.org'
+# Can be set to a local mirror of the archives (e.g. for testing).
+UNIVAF_ARCHIVES_URL = os.getenv('UNIVAF_ARCHIVES_URL', 'https://archives.getmyvax.org')
 DATA_PATH = Path(__file__).parent.parent.absolute() / 'data'
 CACHE_PATH = DATA_PATH / 'univaf_raw'
 
+# Size of the blocks to read from (compressed) log files. Larger blocks mean
+# fewer calls into gzip and less per-line overhead.
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Size of the (uncompressed) blocks that log files are split into when a copy
+# of them is compressed as independently decompressible gzip members (see
+# `blockify_log_file`), and the compression level it's written with.
+GZIP_MEMBER_SIZE = 16 * 1024 * 1024
+GZIP_LEVEL = 6
+
+# Fields of availability log records that the processing scripts use.
+AVAILABILITY_LOG_FIELDS = ('location_id', 'valid_at', 'available',
+                           'available_count', 'capacity', 'slots')
+
+# Size of the chunks to write while downloading, and the number of files
+# to download at the same time.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_WORKERS = 8
+
 USE_S3 = bool(os.getenv('AWS_ACCESS_KEY_ID') and os.getenv('AWS_SECRET_ACCESS_KEY'))
 S3_CLIENT = None
 
@@ -34,10 +71,13 @@ def download_file(bucket_path, destination_path, force=False, use_s3=USE_S3):
     print(f'Downloading logfile to: "{destination_path}"')
     Path(destination_path).parent.mkdir(parents=True, exist_ok=True)
 
+    # Download to a partial file first, so files in the cache are complete.
+    part_path = f'{destination_path}.part'
     if use_s3:
-        download_s3(bucket_path, destination_path)
+        download_s3(bucket_path, part_path)
     else:
-        download_http(bucket_path, destination_path)
+        download_http(bucket_path, part_path)
+    os.replace(part_path, destination_path)
 
 
 def download_s3(bucket_path, destination_path):
@@ -47,17 +87,78 @@ def download_s3(bucket_path, destination_path):
 
 
 def download_http(bucket_path, destination_path):
+    """
+    Download a file over HTTP. If `destination_path` already has part of the
+    file (from an interrupted download), only the rest of it is requested.
+    """
     url = f'{UNIVAF_ARCHIVES_URL.rstrip("/")}/{bucket_path}'
-    req = urllib.request.Request(url, headers={'User-Agent': 'univaf-appointment-data-insights/1.0'})
-    response = urllib.request.urlopen(req)
-    # taken from from https://stackoverflow.com/a/1517728
-    CHUNK = 16 * 1024
-    with open(destination_path, 'wb') as f:
+    headers = {'User-Agent': 'univaf-appointment-data-insights/1.0'}
+    # The ETag of a partial download is kept, so we only resume when the file
+    # on the server is still the same.
+    etag_path = f'{destination_path}.etag'
+    offset = os.path.getsize(destination_path) if os.path.exists(destination_path) else 0
+    if offset and os.path.exists(etag_path):
+        headers['Range'] = f'bytes={offset}-'
+        with open(etag_path) as f:
+            headers['If-Range'] = f.read()
+
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+    except urllib.error.HTTPError as error:
+        if error.code != 416:
+            raise
+        # The partial download doesn't fit the file on the server, restart.
+        os.remove(destination_path)
+        return download_http(bucket_path, destination_path)
+
+    with response:
+        if response.status == 206:
+            mode = 'ab'
+            total = response.headers.get('Content-Range', '').split('/')[-1]
+            etag = response.headers.get('ETag') or headers['If-Range']
+        else:
+            mode = 'wb'
+            total = response.headers.get('Content-Length')
+            etag = response.headers.get('ETag')
+        if etag:
+            with open(etag_path, 'w') as f:
+                f.write(etag)
+        with open(destination_path, mode) as f:
+            while True:
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+    size = os.path.getsize(destination_path)
+    if total and total.isdigit() and size != int(total):
+        raise IOError(f'Downloaded {size} of {total} bytes of "{url}"')
+    if etag and not etag_matches(etag, destination_path):
+        # Start over next time, rather than resuming a corrupt file.
+        os.remove(destination_path)
+        os.remove(etag_path)
+        raise IOError(f'Downloaded file does not match the ETag of "{url}"')
+    if os.path.exists(etag_path):
+        os.remove(etag_path)
+
+
+def etag_matches(etag, filepath):
+    """
+    Check a downloaded file against its ETag. Only ETags that are the MD5 hash
+    of the contents (as S3 uses for files that weren't uploaded in parts) can
+    be checked; any other ETag matches.
+    """
+    etag = etag.strip('"')
+    if len(etag) != 32 or any(c not in '0123456789abcdef' for c in etag.lower()):
+        return True
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
         while True:
-            chunk = response.read(CHUNK)
-            if not chunk:
+            block = f.read(READ_BLOCK_SIZE)
+            if not block:
                 break
-            f.write(chunk)
+            md5.update(block)
+    return md5.hexdigest() == etag.lower()
 
 
 def log_file_name(log_type, date):
@@ -75,6 +176,15 @@ def download_log_file(log_type, date):
     return download_path
 
 
+def download_log_files(log_type, dates, workers=DOWNLOAD_WORKERS):
+    """
+    Download the log files for several dates at the same time. Returns their
+    paths, in the same order as `dates`.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(functools.partial(download_log_file, log_type), dates))
+
+
 @contextmanager
 def open_file(filepath, compressed=None):
     if compressed is None:
@@ -83,8 +193,178 @@ def open_file(filepath, compressed=None):
         yield f
 
 
-def read_json_lines(filepath, compressed=None):
-    with open_file(filepath, compressed) as f:
-        for line in f:
-            if line and line != '\n':
-                yield json.loads(line)
+def blocks_path(filepath):
+    """
+    Path of the copy of a gzip file that is split into blocks (see
+    `blockify_log_file`), e.g. `x.ndjson.blocks.gz` for `x.ndjson.gz`.
+    """
+    return Path(filepath).with_suffix('.blocks.gz')
+
+
+def block_index_path(filepath):
+    return Path(filepath).with_suffix('.blocks.json')
+
+
+def read_block_index(filepath):
+    """
+    Get the (offset, length) of the gzip members of the copy of a file that
+    was split into blocks with `blockify_log_file`, or None if there is none
+    (or the file changed since).
+    """
+    index_path = block_index_path(filepath)
+    if not index_path.exists() or not blocks_path(filepath).exists():
+        return None
+    with index_path.open() as f:
+        index = json.load(f)
+    stat = os.stat(filepath)
+    if (index['size'] != stat.st_size or index['mtime_ns'] != stat.st_mtime_ns or
+            index['blocks_size'] != os.path.getsize(blocks_path(filepath))):
+        return None
+    return [tuple(member) for member in index['members']]
+
+
+def blockify_log_file(filepath, member_size=GZIP_MEMBER_SIZE, level=GZIP_LEVEL, workers=None):
+    """
+    Recompress a (cached) gzip file as a sequence of gzip members of about
+    `member_size` uncompressed bytes each, which end at line breaks. Each
+    member can be decompressed on its own, so the file can be split into
+    parts that are read in parallel (see `split_log_file`). The members are
+    written to a copy next to the file (see `blocks_path`), and their offsets
+    to an index (see `block_index_path`). The file itself isn't changed.
+
+    Does nothing if the file was already split.
+    """
+    filepath = Path(filepath)
+    if read_block_index(filepath) is not None:
+        return
+    print(f'[INFO] splitting {filepath} into blocks')
+    stat = os.stat(filepath)
+    tmp_path = f'{blocks_path(filepath)}.part'
+    members = []
+    # zlib releases the GIL, so blocks can be compressed in threads
+    max_pending = workers or os.cpu_count()
+    compress = functools.partial(gzip.compress, compresslevel=level, mtime=0)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_pending) as executor, \
+            gzip.open(filepath, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+        rest = b''
+        pending = []
+        while True:
+            block = f_in.read(member_size)
+            data = rest + block
+            # members end at line breaks, except for the last one
+            end = data.rfind(b'\n') + 1 if block else len(data)
+            (data, rest) = (data[:end], data[end:])
+            if data:
+                pending.append(executor.submit(compress, data))
+            # write members in order, with a bounded number of them in memory
+            while pending and (len(pending) > max_pending or not block):
+                member = pending.pop(0).result()
+                members.append((f_out.tell(), len(member)))
+                f_out.write(member)
+            if not block:
+                break
+    os.replace(tmp_path, blocks_path(filepath))
+    with open(f'{block_index_path(filepath)}.part', 'w') as f:
+        json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                   'blocks_size': os.path.getsize(blocks_path(filepath)), 'members': members}, f)
+    os.replace(f'{block_index_path(filepath)}.part', block_index_path(filepath))
+
+
+def split_log_file(filepath, n):
+    """
+    Split a file into (at most) `n` parts of whole gzip members of its copy in
+    blocks (see `blockify_log_file`) with about the same compressed size, as
+    (offset, length) tuples for `read_lines`. Files that weren't split into
+    blocks have a single part, None, which is the whole file.
+    """
+    members = read_block_index(filepath)
+    if members is None or n <= 1 or len(members) <= 1:
+        return [None]
+    size = members[-1][0] + members[-1][1]
+    parts = []
+    start = 0
+    for (offset, length) in members:
+        end = offset + length
+        if end >= size * (len(parts) + 1) / n or end == size:
+            parts.append((start, end - start))
+            start = end
+    return parts
+
+
+def read_lines(filepath, compressed=None, block_size=READ_BLOCK_SIZE, part=None):
+    """
+    Read the non-empty lines of a file as bytes, in large blocks. If `part` is
+    an (offset, length) tuple from `split_log_file`, only the lines of those
+    bytes of the file's copy in blocks are read.
+    """
+    if compressed is None:
+        compressed = str(filepath).endswith('.gz')
+    if part is None:
+        f = gzip.open(filepath, 'rb') if compressed else open(filepath, 'rb')
+    else:
+        with open(blocks_path(filepath), 'rb') as f_part:
+            f_part.seek(part[0])
+            data = io.BytesIO(f_part.read(part[1]))
+        f = gzip.GzipFile(fileobj=data, mode='rb') if compressed else data
+    with f:
+        read = lib_metrics.timed('gzip' if compressed else 'read', f.read)
+        rest = b''
+        while True:
+            block = read(block_size)
+            if not block:
+                break
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                if line:
+                    yield line
+        if rest:
+            yield rest
+
+
+def simdjson_loads():
+    # A parser can be re-used, as long as documents are fully converted to
+    # Python objects before parsing the next one.
+    parser = simdjson.Parser()
+    return lambda line: parser.parse(line).as_dict()
+
+
+def json_decoder(decoder=None):
+    """
+    Get a function that decodes a JSON document from bytes. `decoder` can be
+    one of 'orjson', 'simdjson' or 'json', or None to use the fastest one
+    available.
+    """
+    if decoder is None:
+        decoder = os.getenv('JSON_DECODER') or ('orjson' if orjson else 'json')
+    if decoder == 'orjson' and orjson is not None:
+        return orjson.loads
+    elif decoder == 'simdjson' and simdjson is not None:
+        return simdjson_loads()
+    elif decoder == 'json':
+        return json.loads
+    raise ValueError(f'JSON decoder "{decoder}" is not available')
+
+
+def read_json_lines(filepath, compressed=None, decoder=None, fields=None, part=None):
+    """
+    Read records from a (gzipped) file with one JSON document per line.
+
+    If `fields` is set, records only contain those of the given keys that they
+    have, which saves memory for callers that keep records around. If `part`
+    is set, only the records in that part of the file are read (see
+    `split_log_file`).
+    """
+    loads = lib_metrics.timed('json_decode', json_decoder(decoder))
+    n = 0
+    try:
+        for line in read_lines(filepath, compressed, part=part):
+            if line.isspace():
+                continue
+            row = loads(line)
+            if fields is not None:
+                row = {key: row[key] for key in fields if key in row}
+            n += 1
+            yield row
+    finally:
+        lib_metrics.count('json_records', n)
@@ -0,0 +1,58 @@
+import lib_state
+from lib_state import OpenSlots
+
+
+def make_slots():
+    return OpenSlots([(10, 1, 1, 0), (20, 1, 1, 0), (30, 2, 2, 0)])
+
+
+def test_touch_then_open():
+    location_slots = make_slots()
+    location_slots.touch(5)
+    location_slots.open(25, 6, 0)
+    assert list(location_slots) == [(10, 1, 5, 0), (20, 1, 5, 0), (25, 6, 6, 0), (30, 2, 5, 0)]
+
+
+def test_touch_then_close():
+    location_slots = make_slots()
+    location_slots.touch(5)
+    assert location_slots.close(1) == (20, 1, 5, 0)
+    assert list(location_slots) == [(10, 1, 5, 0), (30, 2, 5, 0)]
+
+
+def test_touch_then_discard_before():
+    location_slots = make_slots()
+    location_slots.touch(5)
+    location_slots.discard_before(25)
+    assert list(location_slots) == [(30, 2, 5, 0)]
+    assert len(location_slots.last) == len(location_slots.times)
+
+
+def test_checkpoint_after_touch(tmp_path):
+    touched = make_slots()
+    touched.touch(5)
+    touched.discard_before(15)
+    slots = {1: touched, 2: make_slots()}
+    path = str(tmp_path / 'state.npz')
+    lib_state.write_checkpoint(path, {}, slots)
+    (avs, restored) = lib_state.read_checkpoint(path)
+    assert avs == {}
+    assert {iid: list(location_slots) for (iid, location_slots) in restored.items()} == \
+        {1: [(20, 1, 5, 0), (30, 2, 5, 0)], 2: list(make_slots())}
+
+
+def test_checkpoint_availabilities(tmp_path):
+    avs = {1: [100, 200, -5, 3], 2: [100, 200, 0, '+'], 3: [100, 200, 0, None],
+           4: [100, 200, 0, -1], 5: [100, 200, 0, -2], 6: [100, 200, 0, 0]}
+    path = str(tmp_path / 'state.npz')
+    lib_state.write_checkpoint(path, avs, {})
+    assert lib_state.read_checkpoint(path) == (avs, {})
+
+
+def test_checkpoint_min_slot_time(tmp_path):
+    slots = {1: make_slots(), 2: OpenSlots([(5, 1, 1, 0)])}
+    path = str(tmp_path / 'state.npz')
+    lib_state.write_checkpoint(path, {}, slots)
+    (avs, restored) = lib_state.read_checkpoint(path, min_slot_time=15)
+    assert {iid: list(location_slots) for (iid, location_slots) in restored.items()} == \
+        {1: [(20, 1, 1, 0), (30, 2, 2, 0)]}
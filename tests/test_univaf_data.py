@@ -0,0 +1,119 @@
+import functools
+import gzip
+import hashlib
+import http.server
+import threading
+
+import pytest
+
+import univaf_data
+
+
+class ArchiveHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serve files with an MD5 ETag (like S3) and support for Range/If-Range
+    requests, and keep the Range header of each request.
+    """
+    ranges = []
+    etag = None
+
+    def do_GET(self):
+        try:
+            with open(self.translate_path(self.path), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        etag = self.etag or '"%s"' % hashlib.md5(data).hexdigest()
+        byte_range = self.headers.get('Range')
+        self.ranges.append(byte_range)
+        start = 0
+        if byte_range and self.headers.get('If-Range', etag) == etag:
+            start = int(byte_range[len('bytes='):].split('-')[0])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def archives(tmp_path, monkeypatch):
+    """
+    Serve a directory of log files as the archives, and download to another.
+    """
+    root = tmp_path / 'archives'
+    (root / 'availability_log').mkdir(parents=True)
+    handler = functools.partial(ArchiveHandler, directory=str(root))
+    ArchiveHandler.ranges = []
+    ArchiveHandler.etag = None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(univaf_data, 'UNIVAF_ARCHIVES_URL', 'http://127.0.0.1:%d/' % server.server_port)
+    monkeypatch.setattr(univaf_data, 'CACHE_PATH', tmp_path / 'univaf_raw')
+    monkeypatch.setattr(univaf_data, 'DOWNLOAD_CHUNK_SIZE', 1000)
+    yield root
+    server.shutdown()
+    server.server_close()
+
+
+def add_log_file(root, date, n=1000):
+    data = gzip.compress(''.join('{"location_id": "%s-%d"}\n' % (date, i) for i in range(n)).encode())
+    (root / 'availability_log' / univaf_data.log_file_name('availability_log', date)).write_bytes(data)
+    return data
+
+
+def test_download_log_files(archives):
+    dates = ['2021-06-0%d' % day for day in range(1, 6)]
+    contents = [add_log_file(archives, date, 1000 * i) for (i, date) in enumerate(dates, 1)]
+    paths = univaf_data.download_log_files('availability_log', dates, workers=3)
+    assert [path.read_bytes() for path in paths] == contents
+    assert not list(univaf_data.CACHE_PATH.glob('*.part*'))
+
+
+def test_resume_download(archives):
+    data = add_log_file(archives, '2021-06-01')
+    path = univaf_data.log_file_path('availability_log', '2021-06-01')
+    path.parent.mkdir(parents=True)
+    # an interrupted download of the same file
+    with open(f'{path}.part', 'wb') as f:
+        f.write(data[:1000])
+    with open(f'{path}.part.etag', 'w') as f:
+        f.write('"%s"' % hashlib.md5(data).hexdigest())
+    univaf_data.download_log_file('availability_log', '2021-06-01')
+    assert ArchiveHandler.ranges == ['bytes=1000-']
+    assert path.read_bytes() == data
+    assert not list(path.parent.glob('*.part*'))
+
+
+def test_restart_download_after_416(archives):
+    data = add_log_file(archives, '2021-06-01')
+    path = univaf_data.log_file_path('availability_log', '2021-06-01')
+    path.parent.mkdir(parents=True)
+    # a partial download that is longer than the file on the server
+    with open(f'{path}.part', 'wb') as f:
+        f.write(data + b'more')
+    with open(f'{path}.part.etag', 'w') as f:
+        f.write('"%s"' % hashlib.md5(data).hexdigest())
+    univaf_data.download_log_file('availability_log', '2021-06-01')
+    assert ArchiveHandler.ranges == ['bytes=%d-' % (len(data) + 4), None]
+    assert path.read_bytes() == data
+
+
+def test_download_etag_mismatch(archives):
+    add_log_file(archives, '2021-06-01')
+    ArchiveHandler.etag = '"%s"' % hashlib.md5(b'something else').hexdigest()
+    with pytest.raises(IOError):
+        univaf_data.download_log_file('availability_log', '2021-06-01')
+    assert not univaf_data.log_file_path('availability_log', '2021-06-01').exists()
+    assert not list(univaf_data.CACHE_PATH.glob('*.part*'))